@@ -1,11 +1,83 @@
+import time
+
+# Startup is measured from here (--measure-startup)
+STARTED = time.perf_counter()
+
+import argparse
 import customtkinter as ctk
+import os
 import socket
 import threading
 import sys
-import subprocess
-from tkinter import messagebox
+from tkinter import Canvas, filedialog, messagebox
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
+
+# Pillow (avatars.py, image previews), subprocess (local server) and the
+# TLS module are imported where they are first needed: none of them is
+# used before the login window is up, and TLS only when asked for
+from avatars import AVATAR_MAP, AvatarImages
+
+from chat_client import (
+    CLOSED,
+    CONNECTED,
+    FAILED,
+    RECONNECTING,
+    ChatClient,
+    open_connection
+)
+from framing import FRAME_BINARY
+from presence import (
+    FEATURE_PRESENCE,
+    FEATURE_JOIN_SNAPSHOT,
+    EVENT_PREFIX,
+    SNAPSHOT_PREFIX,
+    JOIN_SNAPSHOT_PREFIX,
+    SYNC_REQUEST,
+    PresenceState,
+    parse_event,
+    parse_join_snapshot,
+    parse_snapshot
+)
+from compression import FEATURE_DEFLATE
+from heartbeat import FEATURE_HEARTBEAT
+from files import (
+    FEATURE_FILES,
+    ACK_PREFIX as FILE_ACK,
+    CANCEL_PREFIX as FILE_CANCEL,
+    ERROR_PREFIX as FILE_ERROR,
+    NOTICE_PREFIX as FILE_NOTICE,
+    READY_PREFIX as FILE_READY,
+    CHUNK_SIZE,
+    MAX_FILE_SIZE,
+    PREVIEW_MAX,
+    WINDOW,
+    clean_name,
+    download,
+    file_digest,
+    format_offer,
+    human_size,
+    is_image,
+    pack_chunk,
+    parse_notice,
+    parse_status
+)
+from history import FEATURE_HISTORY, PAGE_PREFIX, PUBLIC, format_request, parse_page
+from rooms import (
+    FEATURE_ROOMS,
+    JOIN_PREFIX,
+    LEAVE_PREFIX,
+    SEND_PREFIX,
+    MESSAGE_PREFIX,
+    JOINED_PREFIX,
+    LEFT_PREFIX,
+    LIST_PREFIX,
+    parse_list,
+    parse_message as parse_room_message,
+    valid_room
+)
+from transcript import MINE, OTHER, SYSTEM, Entry, Transcript, estimate_height
+from updates import TICK, UpdateQueue
+from userlist import PAGE_SIZE, UserIndex
 
 
 # UI configuration
@@ -13,16 +85,492 @@ ctk.set_appearance_mode("System")
 ctk.set_default_color_theme("blue")
 
 
-AVATAR_MAP = {
-    "Boy": "👨‍💻", "Girl": "👩‍💻", "Robot": "🤖", "Alien": "👽",
-    "Fox": "🦊", "Tiger": "🐯", "Dog": "🐶", "Unicorn": "🦄",
-    "Soccer": "⚽", "Basket": "🏀", "Pizza": "🍕", "Guitar": "🎸",
-    "Rocket": "🚀", "Star": "⭐", "Ghost": "👻", "Cat": "🐱"
-}
+# Seconds an upload waits for the server before giving up
+UPLOAD_TIMEOUT = 30
+
+CLIENT_FEATURES = (
+    FEATURE_PRESENCE,
+    FEATURE_JOIN_SNAPSHOT,
+    FEATURE_HISTORY,
+    FEATURE_ROOMS,
+    FEATURE_DEFLATE,
+    FEATURE_HEARTBEAT,
+    FEATURE_FILES
+)
+
+# Transcript rows: spacing, and how far outside the viewport rows are kept ready
+ROW_GAP = 10
+ROW_PAD = 5
+OVERSCAN = 300
+
+
+class BubbleRow:
+    """The widgets of one chat bubble, filled in for whichever entry scrolls into view."""
+
+    kind = "bubble"
+
+    def __init__(self, view):
+        self.view = view
+        self.entry = None
+        self.frame = ctk.CTkFrame(view.canvas, fg_color="white")
+
+        self.avatar = ctk.CTkLabel(self.frame, text="")
+        self.bubble = ctk.CTkFrame(self.frame, corner_radius=12)
+        self.bubble.pack(side="left")
+
+        self.name = ctk.CTkLabel(
+            self.bubble,
+            text="",
+            font=("Arial", 10, "bold"),
+            text_color="gray30"
+        )
+        self.name.pack(anchor="w", padx=8, pady=(4, 0))
+
+        self.text = ctk.CTkLabel(
+            self.bubble,
+            text="",
+            font=("Arial", 12),
+            text_color="black",
+            wraplength=180,
+            justify="left"
+        )
+        self.text.pack(padx=8, pady=(2, 5))
+
+        self.meta = ctk.CTkLabel(
+            self.bubble,
+            text="",
+            font=("Arial", 8),
+            text_color="gray40"
+        )
+        self.meta.pack(anchor="e", padx=8, pady=(0, 5))
+
+        # Shared files only: Save button, download progress, image preview
+        self.extra = ctk.CTkFrame(self.bubble, fg_color="transparent")
+        self.button = ctk.CTkButton(
+            self.extra,
+            text="Save",
+            height=22,
+            width=60,
+            command=lambda: view.on_save(self.entry)
+        )
+        self.status = ctk.CTkLabel(
+            self.extra,
+            text="",
+            font=("Arial", 9),
+            text_color="gray"
+        )
+        self.bar = ctk.CTkProgressBar(self.extra, width=160, height=6)
+        self.preview = ctk.CTkLabel(self.extra, text="")
+
+        self.item = view.canvas.create_window(0, 0, window=self.frame, anchor="nw", state="hidden")
+
+    def show(self, entry):
+        self.entry = entry
+        mine = entry.kind == MINE
+        if mine:
+            self.avatar.pack_forget()
+        else:
+            self.avatar.configure(image=self.view.avatar_for(entry.sender))
+            self.avatar.pack(side="left", padx=5, anchor="n", before=self.bubble)
+
+        self.bubble.configure(fg_color="#DCF8C6" if mine else "#ECECEC")
+        self.name.configure(text="Me" if mine else entry.sender)
+        self.text.configure(text=entry.text)
+
+        meta = datetime.fromtimestamp(entry.sent_at).strftime("%H:%M")
+        if entry.tag:
+            meta += f" • {entry.tag}"
+        self.meta.configure(text=meta)
+
+        for widget in (self.button, self.status, self.bar, self.preview):
+            widget.pack_forget()
+        if entry.file is None:
+            self.extra.pack_forget()
+            return
+
+        self.extra.pack(anchor="w", padx=8, pady=(0, 5))
+        self.button.configure(state="disabled" if entry.busy else "normal")
+        self.button.pack(anchor="w")
+        if entry.status:
+            self.status.configure(text=entry.status)
+            self.status.pack(anchor="w")
+        if entry.progress is not None:
+            self.bar.set(entry.progress)
+            self.bar.pack(anchor="w", pady=(0, 3))
+        if entry.image is not None:
+            self.preview.configure(image=entry.image)
+            self.preview.pack(pady=(2, 0))
+
+    def set_avatar(self):
+        if self.entry.kind != MINE:
+            self.avatar.configure(image=self.view.avatar_for(self.entry.sender))
+
+    def place(self, y, width):
+        if self.entry.kind == MINE:
+            self.view.canvas.coords(self.item, width - ROW_PAD, y)
+            self.view.canvas.itemconfigure(self.item, anchor="ne", state="normal")
+        else:
+            self.view.canvas.coords(self.item, ROW_PAD, y)
+            self.view.canvas.itemconfigure(self.item, anchor="nw", state="normal")
+
+    def height(self):
+        return self.frame.winfo_reqheight() + ROW_GAP
+
+    def hide(self):
+        self.view.canvas.itemconfigure(self.item, state="hidden")
+        self.entry = None
+
+
+class SystemRow:
+    """A centered system line, with a progress bar while an upload runs."""
+
+    kind = "system"
+
+    def __init__(self, view):
+        self.view = view
+        self.entry = None
+        self.frame = ctk.CTkFrame(view.canvas, fg_color="white")
+        self.label = ctk.CTkLabel(
+            self.frame,
+            text="",
+            font=("Arial", 9),
+            text_color="gray"
+        )
+        self.label.pack()
+        self.bar = ctk.CTkProgressBar(self.frame, width=160, height=6)
+        self.item = view.canvas.create_window(0, 0, window=self.frame, anchor="n", state="hidden")
+
+    def show(self, entry):
+        self.entry = entry
+        self.label.configure(text=entry.text)
+        if entry.progress is None:
+            self.bar.pack_forget()
+        else:
+            self.bar.set(entry.progress)
+            self.bar.pack(pady=(0, 3))
+
+    def set_avatar(self):
+        pass
+
+    def place(self, y, width):
+        self.view.canvas.coords(self.item, width // 2, y)
+        self.view.canvas.itemconfigure(self.item, state="normal")
+
+    def height(self):
+        return self.frame.winfo_reqheight() + 2
+
+    def hide(self):
+        self.view.canvas.itemconfigure(self.item, state="hidden")
+        self.entry = None
+
+
+class TranscriptView:
+    """
+    Virtualized chat transcript. The messages live in a Transcript; only
+    the rows in (or just outside) the viewport have widgets, which are
+    recycled from a pool as the view scrolls. While the view is at the
+    bottom it follows new messages, otherwise it stays on the message at
+    the top of the viewport, even when older ones are added or dropped.
+    """
+
+    def __init__(self, parent, updates, avatar_for, on_save):
+        self.updates = updates
+        self.avatar_for = avatar_for
+        self.on_save = on_save
+        self.model = Transcript()
+
+        self.frame = ctk.CTkFrame(parent, fg_color="white")
+        self.canvas = Canvas(
+            self.frame,
+            bg="white",
+            highlightthickness=0,
+            yscrollincrement=20
+        )
+        self.scrollbar = ctk.CTkScrollbar(self.frame, command=self.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.canvas.bind("<Configure>", lambda e: self.schedule_layout())
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.canvas.bind_all(sequence, self.on_wheel, add="+")
+
+        self.pool = {BubbleRow.kind: [], SystemRow.kind: []}
+        self.shown = {}             # entry serial -> row showing it
+        self.follow = True
+        self.anchor = None          # (entry, offset) at the top of the viewport
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def append(self, entry):
+        """Add a new message at the bottom. Returns how many old ones were dropped."""
+        dropped = self.model.append(entry)
+        if entry.kind == MINE:
+            self.follow = True
+        self.schedule_layout()
+        return dropped
+
+    def prepend(self, entries):
+        """Add older messages at the top. Returns how many fit in the transcript."""
+        added = self.model.prepend(entries)
+        self.schedule_layout()
+        return added
+
+    def update_entry(self, entry):
+        """Redraw an entry after its text, progress or image changed."""
+        index = self.model.index_of(entry)
+        if index is None:
+            return
+        row = self.shown.get(entry.serial)
+        if row is not None and row.entry is entry:
+            row.show(entry)
+        else:
+            self.model.set_height(index, estimate_height(entry))
+        self.schedule_layout()
+
+    def refresh_avatars(self, user=None):
+        # Only rows on screen have avatars; the rest pick theirs up when shown
+        for row in self.shown.values():
+            if user is None or row.entry.sender == user:
+                row.set_avatar()
+
+    def clear(self):
+        for row in self.shown.values():
+            row.hide()
+            self.pool[row.kind].append(row)
+        self.shown.clear()
+        self.model.clear()
+        self.follow = True
+        self.anchor = None
+        self.schedule_layout()
+
+    def scroll_to_bottom(self):
+        self.follow = True
+        self.schedule_layout()
+
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.follow = self.canvas.yview()[1] >= 1.0
+        self.anchor = None
+        self.schedule_layout()
+
+    def on_wheel(self, event):
+        if not str(event.widget).startswith(str(self.canvas)):
+            return
+        if event.num == 4:
+            units = -1
+        elif event.num == 5:
+            units = 1
+        elif sys.platform == "darwin":
+            units = -event.delta
+        else:
+            units = -event.delta // 120
+        self.yview("scroll", units * 3, "units")
+
+    def schedule_layout(self):
+        # Many changes in a row (a history page, a burst of messages) share
+        # one layout, and with it one autoscroll, per update tick
+        self.updates.mark("transcript", self.layout)
+
+    def layout(self):
+        for _ in range(2):
+            rows = self.bind_rows()
+            # Rows shown for the first time replace their estimate with the real height
+            self.canvas.update_idletasks()
+            changed = False
+            for index, row in rows:
+                height = row.height()
+                if height != row.entry.height:
+                    self.model.set_height(index, height)
+                    changed = True
+            if not changed:
+                break
+        self.save_anchor()
+
+    def bind_rows(self):
+        model = self.model
+        width = self.canvas.winfo_width()
+        view_height = self.canvas.winfo_height()
+        total = max(model.total_height(), view_height)
+        self.canvas.configure(scrollregion=(0, 0, width, total))
+
+        if self.follow:
+            self.canvas.yview_moveto(1.0)
+        elif self.anchor is not None:
+            entry, offset = self.anchor
+            index = model.index_of(entry)
+            if index is not None:
+                self.canvas.yview_moveto((model.top(index) + offset) / total)
+
+        top = self.canvas.canvasy(0)
+        start, stop = model.visible(top - OVERSCAN, top + view_height + OVERSCAN)
+        wanted = {entry.serial for entry in model.entries[start:stop]}
+        for serial in list(self.shown):
+            if serial not in wanted:
+                row = self.shown.pop(serial)
+                row.hide()
+                self.pool[row.kind].append(row)
+
+        rows = []
+        for index in range(start, stop):
+            entry = model.entries[index]
+            row = self.shown.get(entry.serial)
+            if row is None or row.entry is not entry:
+                row = self.take_row(entry)
+                row.show(entry)
+                self.shown[entry.serial] = row
+            row.place(model.top(index), width)
+            rows.append((index, row))
+        return rows
+
+    def take_row(self, entry):
+        row_class = SystemRow if entry.kind == SYSTEM else BubbleRow
+        pool = self.pool[row_class.kind]
+        return pool.pop() if pool else row_class(self)
+
+    def save_anchor(self):
+        model = self.model
+        top = self.canvas.canvasy(0)
+        start, stop = model.visible(top, top + 1)
+        if start < stop:
+            self.anchor = (model.entries[start], top - model.top(start))
+        else:
+            self.anchor = None
+
+
+class UserListView:
+    """
+    The online users in the sidebar, sorted by name. Each shown user has
+    one button, kept in a map and changed in place: a presence change
+    creates or destroys one button, an avatar or selection change
+    reconfigures one. Past PAGE_SIZE users a search box filters by name
+    prefix and "More" shows the next page, so the list never has more
+    buttons than someone scrolled to.
+    """
+
+    def __init__(self, parent, search_parent, search_after, on_select, on_change, avatar_for):
+        self.on_select = on_select
+        self.on_change = on_change
+        self.avatar_for = avatar_for
+        self.index = UserIndex()
+        self.buttons = {}           # user -> [button, avatar image, highlighted]
+        self.limit = PAGE_SIZE
+        self.prefix = ""
+        self.searching = False
+
+        # Packed above the list while there are more users than one page
+        self.search_after = search_after
+        self.search = ctk.CTkEntry(
+            search_parent,
+            placeholder_text="Search",
+            height=25,
+            width=80
+        )
+        self.search.bind("<KeyRelease>", lambda e: self.on_search())
+
+        self.box = ctk.CTkFrame(parent, fg_color="transparent", height=0)
+        self.box.pack(fill="x")
+        self.more_btn = ctk.CTkButton(
+            parent,
+            text="More…",
+            fg_color="#444",
+            height=22,
+            width=80,
+            command=self.show_more
+        )
+        self.more_shown = False
+
+    def update(self, users, exclude, target):
+        self.index.update(user for user in users if user and user != exclude)
+
+        searching = len(self.index) > PAGE_SIZE
+        if searching != self.searching:
+            self.searching = searching
+            if searching:
+                self.search.pack(fill="x", padx=5, pady=(0, 2), after=self.search_after)
+            else:
+                self.search.pack_forget()
+
+        names, matches = self.index.page(self.prefix if searching else "", self.limit)
+        self.sync(names, target)
+
+        more = matches > len(names)
+        if more != self.more_shown:
+            self.more_shown = more
+            if more:
+                self.more_btn.pack(fill="x", pady=2, after=self.box)
+            else:
+                self.more_btn.pack_forget()
+
+    def sync(self, names, target):
+        """Make the buttons show exactly names, in order, touching only what changed."""
+        wanted = set(names)
+        for user in [user for user in self.buttons if user not in wanted]:
+            self.buttons.pop(user)[0].destroy()
+
+        # Buttons are always packed in name order, so a new one goes right
+        # before the button of the next name
+        following = None
+        for user in reversed(names):
+            image = self.avatar_for(user)
+            highlighted = user == target
+            state = self.buttons.get(user)
+            if state is None:
+                button = ctk.CTkButton(
+                    self.box,
+                    text=f" {user}",
+                    image=image,
+                    compound="left",
+                    fg_color="#3B8ED0" if highlighted else "transparent",
+                    anchor="w",
+                    height=30,
+                    width=80,
+                    command=lambda u=user: self.on_select(u)
+                )
+                if following is None:
+                    button.pack(fill="x", pady=2)
+                else:
+                    button.pack(fill="x", pady=2, before=following)
+                self.buttons[user] = [button, image, highlighted]
+            else:
+                button = state[0]
+                if state[1] is not image:
+                    button.configure(image=image)
+                    state[1] = image
+                if state[2] != highlighted:
+                    button.configure(fg_color="#3B8ED0" if highlighted else "transparent")
+                    state[2] = highlighted
+            following = button
+
+    def on_search(self):
+        prefix = self.search.get().strip()
+        if prefix != self.prefix:
+            self.prefix = prefix
+            self.limit = PAGE_SIZE
+            self.on_change()
+
+    def show_more(self):
+        self.limit += PAGE_SIZE
+        self.on_change()
+
+    def clear(self):
+        for button, image, highlighted in self.buttons.values():
+            button.destroy()
+        self.buttons.clear()
+        self.index.clear()
+        self.limit = PAGE_SIZE
+        self.prefix = ""
+        self.search.delete(0, "end")
+        if self.searching:
+            self.searching = False
+            self.search.pack_forget()
+        if self.more_shown:
+            self.more_shown = False
+            self.more_btn.pack_forget()
 
 
 class ChatClientGUI:
-    def __init__(self, root):
+    def __init__(self, root, tls_context=None):
         self.root = root
         self.root.title("Networks Chat")
         self.root.geometry("350x400")
@@ -30,50 +578,79 @@ class ChatClientGUI:
         self.HOST = "127.0.0.1"
         self.PORT = 5000
 
-        self.client_socket = None
+        # The connection (see chat_client.py), from the login to the logout
+        self.client = None
         self.server_process = None
 
+        # With TLS, the session of the last login lets the next one resume
+        self.tls_context = tls_context
+        self.tls_session = None
+        self.server_features = ()
+
+        # upload id -> {"acked": bytes, "result": None / ("ready"|"error", value)}
+        self.uploads = {}
+        self.upload_cond = threading.Condition()
+        self.next_upload_id = 1
+
         self.username = ""
         self.my_avatar = "Boy"
         self.connected = False
         self.target_user = "Everyone"
+        self.target_room = None
 
         self.users_online = []
         self.users_avatars_map = {}
-        self.msg_bubbles_cache = {}
+        self.presence = PresenceState(self.users_online, self.users_avatars_map)
 
-        self.expecting_disconnect = False
+        # Updates from the network thread, applied by the Tk loop every TICK
+        self.updates = UpdateQueue()
 
-        self.images = self.generate_avatars()
+        # [(room, member count), ...] from the server, and the rooms we are in
+        self.rooms_list = []
+        self.my_rooms = set()
 
-        self.create_main_chat_ui()
+        # Oldest history message shown, used to ask for the page before it
+        self.history_oldest = None
+
+        # After a reconnect the transcript stays, so the join history is not shown again
+        self.reconnecting = False
+        self.skip_join_history = False
+
+        # Rendered (or read from the atlas cache) when first shown
+        self.images = AvatarImages(
+            lambda img: ctk.CTkImage(light_image=img, dark_image=img, size=(35, 35))
+        )
+
+        # The login window goes up first: the avatars and the (hidden) chat
+        # window are built once it is on screen, see finish_startup
+        self.started = False
         self.root.withdraw()
         self.open_login_window()
+        self.login_win.bind("<Map>", self.on_login_mapped, add="+")
+        self.pump_updates()
 
-    def generate_avatars(self):
-        images = {}
-        try:
-            font = ImageFont.truetype("seguiemj.ttf", 64)
-        except Exception:
-            font = ImageFont.load_default()
-
-        for name, char in AVATAR_MAP.items():
-            img = Image.new("RGBA", (100, 100), (0, 0, 0, 0))
-            draw = ImageDraw.Draw(img)
-            draw.text(
-                (50, 50),
-                char,
-                font=font,
-                fill="white",
-                anchor="mm",
-                embedded_color=True
-            )
-            images[name] = ctk.CTkImage(
-                light_image=img,
-                dark_image=img,
-                size=(35, 35)
-            )
-        return images
+    def on_login_mapped(self, event):
+        # Children's <Map> events arrive here too
+        if event.widget is self.login_win and not self.started:
+            self.root.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+        if self.started:
+            return
+        self.started = True
+        for name, btn in self.grid_btns:
+            btn.configure(image=self.images[name])
+        self.create_main_chat_ui()
+
+    def pump_updates(self):
+        self.updates.drain()
+        self.root.after(int(TICK * 1000), self.pump_updates)
+
+    def request_sidebar(self):
+        self.updates.mark("sidebar", self.update_sidebar)
+
+    def request_avatar_refresh(self, user):
+        self.updates.mark(("avatar", user), lambda: self.refresh_bubble_images(user))
 
     # Login window
     def open_login_window(self):
@@ -146,14 +723,14 @@ class ChatClientGUI:
         window.focus_force()
 
     def render_avatar_grid(self, parent):
+        # The images are filled in by finish_startup
         self.grid_btns = []
         row = col = 0
 
-        for name, img in self.images.items():
+        for name in AVATAR_MAP:
             btn = ctk.CTkButton(
                 parent,
                 text="",
-                image=img,
                 width=40,
                 height=40,
                 fg_color="transparent",
@@ -191,6 +768,7 @@ class ChatClientGUI:
         if self.server_var.get() == 1:
             if not self.check_if_port_busy():
                 try:
+                    import subprocess
                     self.server_process = subprocess.Popen(
                         [sys.executable, "serverUI.py"]
                     )
@@ -218,9 +796,8 @@ class ChatClientGUI:
 
     def kill_remote_server(self):
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.HOST, self.PORT))
-            s.send("!!KILL_SERVER!!\n".encode())
+            s = self.connect_socket()
+            s.sendall("!!KILL_SERVER!!\n".encode())
             s.close()
         except Exception:
             pass
@@ -231,123 +808,252 @@ class ChatClientGUI:
         if not name:
             self.err_lbl.configure(text="Enter name!")
             return
+        if self.client is not None:
+            # Still logging in
+            return
+        # Joined before the login window was drawn
+        self.finish_startup()
+
+        # Connecting and logging in happen on the client's own thread,
+        # the outcome arrives in on_client_status
+        self.err_lbl.configure(text="Connecting...")
+        client = ChatClient(
+            self.HOST,
+            self.PORT,
+            name,
+            avatar=self.my_avatar,
+            features=CLIENT_FEATURES,
+            tls_context=self.tls_context,
+            tls_session=self.tls_session
+        )
 
-        try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((self.HOST, self.PORT))
-            self.client_socket.send(f"{name}\n".encode())
-
-            response = self.client_socket.recv(1024).decode()
-            if "Welcome" in response:
-                self.username = name
-                self.connected = True
-                self.expecting_disconnect = False
-
-                self.login_win.destroy()
-                self.root.deiconify()
-                self.force_focus(self.root)
-
-                self.reset_chat_ui()
-                self.send_avatar_cmd()
-
-                threading.Thread(
-                    target=self.listener_thread,
-                    daemon=True
-                ).start()
-            else:
-                self.err_lbl.configure(text="Error / Taken")
-                self.client_socket.close()
+        def on_message(text):
+            # A client that was logged out may still deliver a line or two
+            if client is self.client:
+                self.process_message(text)
 
-        except Exception as e:
-            self.err_lbl.configure(text=f"Failed: {e}")
+        client.on_message = on_message
+        client.on_status = lambda status, detail: self.on_client_status(client, status, detail)
+        self.client = client
+        client.start()
+
+    def on_client_status(self, client, status, detail):
+        # Called on the client's thread, before it reads any further
+        # message, so apply_client_status is queued ahead of them
+        if client is not self.client:
+            return
+        if status == CONNECTED:
+            self.server_features = client.server_features
+            self.connected = True
+        elif status in (RECONNECTING, FAILED, CLOSED):
+            self.connected = False
+            with self.upload_cond:
+                # Running uploads give up
+                self.upload_cond.notify_all()
+        self.updates.post(self.apply_client_status, client, status, detail)
+
+    def apply_client_status(self, client, status, detail):
+        if client is not self.client:
+            return
+
+        if status == CONNECTED:
+            # The new session sends its own presence and rooms
+            self.presence.reset()
+            self.rooms_list = []
+            self.my_rooms.clear()
+            if self.username:
+                # Same user again after a lost connection: the transcript
+                # stays, rooms are gone with the old session
+                self.reconnecting = False
+                self.skip_join_history = True
+                if self.target_room:
+                    self.set_target("Everyone")
+                self.request_sidebar()
+                self.add_message("System", "[System] Reconnected.", False, is_system=True)
+                return
+
+            self.username = client.username
+            self.skip_join_history = False
+            self.login_win.destroy()
+            self.root.deiconify()
+            self.force_focus(self.root)
+            self.reset_chat_ui()
+
+        elif status == RECONNECTING:
+            if not self.reconnecting:
+                self.reconnecting = True
+                self.add_message(
+                    "System",
+                    "[System] Connection lost, reconnecting...",
+                    False,
+                    is_system=True
+                )
+
+        elif status == FAILED:
+            if self.username:
+                self.handle_crash_disconnect()
+                return
+            self.client = None
+            self.err_lbl.configure(text="Error / Taken" if detail == "Error" else f"Failed: {detail}")
+
+        elif status == CLOSED:
+            self.handle_remote_disconnect(detail)
+
+    def connect_socket(self):
+        # Downloads and the server kill switch use connections of their own
+        session = self.client.tls_session if self.client is not None else self.tls_session
+        return open_connection(
+            self.HOST,
+            self.PORT,
+            tls_context=self.tls_context,
+            tls_session=session
+        )
+
+    def send_line(self, text):
+        if self.client is None:
+            raise ConnectionError("Not connected")
+        self.client.send(text)
 
     def reset_chat_ui(self):
         self.target_user = "Everyone"
-        self.users_online.clear()
-        self.users_avatars_map.clear()
-        self.msg_bubbles_cache.clear()
+        self.target_room = None
+        self.history_oldest = None
+        self.set_load_older(False)
 
-        for w in self.chat_display.winfo_children():
-            w.destroy()
-        for w in self.users_frame.winfo_children():
+        self.transcript.clear()
+        self.user_list.clear()
+        for w in self.rooms_frame.winfo_children():
             w.destroy()
+        self.rooms_shown = None
 
         self.header.configure(text="To: Everyone", text_color="black")
 
-    def listener_thread(self):
-        buffer = ""
-        while self.connected:
-            try:
-                data = self.client_socket.recv(1024).decode()
-                if not data:
-                    break
+    def process_message(self, data):
+        # Runs on the client's thread: it only parses, every change to the
+        # users, avatars and rooms is posted and made on the Tk thread
+        try:
+            if data.startswith(JOIN_SNAPSHOT_PREFIX):
+                self.updates.post(self.apply_join_snapshot, parse_join_snapshot(data))
+                return
 
-                buffer += data
-                while "\n" in buffer:
-                    message, buffer = buffer.split("\n", 1)
-                    if message:
-                        self.process_message(message)
+            if data.startswith(SNAPSHOT_PREFIX):
+                self.updates.post(self.apply_presence_snapshot, *parse_snapshot(data))
+                return
 
-            except Exception:
-                break
+            if data.startswith(EVENT_PREFIX):
+                self.updates.post(self.apply_presence_event, *parse_event(data))
+                return
 
-        if self.connected and not self.expecting_disconnect:
-            self.root.after(0, self.handle_crash_disconnect)
+            if data.startswith((FILE_ACK, FILE_READY, FILE_ERROR)):
+                self.update_upload(data)
+                return
 
-    def process_message(self, data):
-        try:
-            if data.startswith("CMD:DISCONNECT:"):
-                reason = data.split(":", 2)[2]
-                self.expecting_disconnect = True
-                self.root.after(
-                    0,
-                    lambda: self.handle_remote_disconnect(reason)
-                )
+            if data.startswith(FILE_NOTICE):
+                notice = parse_notice(data)
+                self.updates.post(self.add_file_message, notice)
+                return
+
+            if data.startswith(PAGE_PREFIX):
+                conversation, messages, more = parse_page(data)
+                if conversation == PUBLIC:
+                    self.updates.post(self.show_history, messages, more)
+                return
+
+            if data.startswith(MESSAGE_PREFIX):
+                room, sender, text = parse_room_message(data)
+                self.updates.post(self.add_message, sender, text, False, room=room)
+                return
+
+            if data.startswith(LIST_PREFIX):
+                self.updates.post(self.set_rooms, parse_list(data))
+                return
+
+            if data.startswith(JOINED_PREFIX):
+                self.updates.post(self.joined_room, data[len(JOINED_PREFIX):])
+                return
+
+            if data.startswith(LEFT_PREFIX):
+                self.updates.post(self.left_room, data[len(LEFT_PREFIX):])
                 return
 
             if data.startswith("LIST:"):
                 raw = data.split("LIST:")[1]
-                self.users_online = [
-                    u.strip() for u in raw.split(",") if u.strip()
-                ]
-                self.root.after(0, self.update_sidebar)
+                users = [u.strip() for u in raw.split(",") if u.strip()]
+                self.updates.post(self.set_users, users)
                 return
 
             if data.startswith("CMD:UPDATE_AVATAR:"):
                 parts = data.split(":")
                 if len(parts) >= 4:
-                    user, avatar = parts[2], parts[3]
-                    self.users_avatars_map[user] = avatar
-                    self.root.after(
-                        0,
-                        lambda u=user: self.refresh_bubble_images(u)
-                    )
-                    self.root.after(0, self.update_sidebar)
+                    self.updates.post(self.set_user_avatar, parts[2], parts[3])
                 return
 
             if data.startswith("[System]"):
-                self.root.after(
-                    0,
-                    lambda: self.add_message(
-                        "System", data, False, is_system=True
-                    )
-                )
+                self.updates.post(self.add_message, "System", data, False, is_system=True)
                 return
 
             if ":" in data:
                 sender, content = data.split(":", 1)
                 is_private = "(Private)" in content
                 clean_msg = content.replace("(Private)", "").strip()
-                self.root.after(
-                    0,
-                    lambda: self.add_message(
-                        sender, clean_msg, False, is_private=is_private
-                    )
-                )
+                self.updates.post(self.add_message, sender, clean_msg, False, is_private=is_private)
 
         except Exception:
             pass
 
+    def apply_join_snapshot(self, snapshot):
+        # Everything from the login in one pass, with one sidebar redraw
+        self.presence.apply_snapshot(snapshot["seq"], snapshot["users"])
+        if "rooms" in snapshot:
+            self.rooms_list = snapshot["rooms"]
+        if "history" in snapshot and not self.skip_join_history:
+            self.show_history(snapshot["history"], snapshot["more"])
+        self.refresh_after_snapshot()
+
+    def apply_presence_snapshot(self, seq, entries):
+        self.presence.apply_snapshot(seq, entries)
+        self.refresh_after_snapshot()
+
+    def apply_presence_event(self, seq, kind, user, avatar):
+        if not self.presence.apply_event(seq, kind, user, avatar):
+            # Missed some updates, ask for the full picture
+            try:
+                self.send_line(SYNC_REQUEST)
+            except OSError:
+                pass
+        if avatar:
+            self.request_avatar_refresh(user)
+        self.request_sidebar()
+
+    def set_users(self, users):
+        # Servers without presence deltas send the whole list
+        self.users_online[:] = users
+        self.request_sidebar()
+
+    def set_user_avatar(self, user, avatar):
+        self.users_avatars_map[user] = avatar
+        self.request_avatar_refresh(user)
+        self.request_sidebar()
+
+    def set_rooms(self, rooms):
+        self.rooms_list = rooms
+        self.request_sidebar()
+
+    def joined_room(self, room):
+        self.my_rooms.add(room)
+        self.set_room_target(room)
+
+    def left_room(self, room):
+        self.my_rooms.discard(room)
+        if self.target_room == room:
+            self.set_target("Everyone")
+        else:
+            self.request_sidebar()
+
+    def refresh_after_snapshot(self):
+        self.updates.mark("avatars", self.transcript.refresh_avatars)
+        self.request_sidebar()
+
     def handle_remote_disconnect(self, reason):
         self.connected = False
         messagebox.showinfo("Server Closed", reason)
@@ -387,12 +1093,13 @@ class ChatClientGUI:
             command=self.open_edit_profile
         ).pack(pady=5)
 
-        ctk.CTkLabel(
+        online_label = ctk.CTkLabel(
             self.sidebar,
             text="Online:",
             text_color="gray",
             font=("Arial", 10)
-        ).pack(pady=(10, 2), anchor="w", padx=5)
+        )
+        online_label.pack(pady=(10, 2), anchor="w", padx=5)
 
         self.users_frame = ctk.CTkScrollableFrame(
             self.sidebar,
@@ -401,6 +1108,53 @@ class ChatClientGUI:
         )
         self.users_frame.pack(fill="both", expand=True)
 
+        # The sidebar's widgets are kept and changed in place (see update_sidebar)
+        self.all_btn = ctk.CTkButton(
+            self.users_frame,
+            text="All",
+            fg_color="#3B8ED0",
+            anchor="w",
+            height=30,
+            width=80,
+            command=lambda: self.set_target("Everyone")
+        )
+        self.all_btn.pack(fill="x", pady=2)
+        self.all_highlighted = True
+
+        self.user_list = UserListView(
+            self.users_frame,
+            self.sidebar,
+            online_label,
+            self.set_target,
+            self.request_sidebar,
+            self.avatar_for
+        )
+
+        self.rooms_frame = ctk.CTkFrame(self.users_frame, fg_color="transparent", height=0)
+        self.rooms_frame.pack(fill="x")
+        self.rooms_shown = None
+
+        room_box = ctk.CTkFrame(self.sidebar, fg_color="transparent")
+        room_box.pack(fill="x", padx=5, pady=(5, 0))
+
+        self.room_entry = ctk.CTkEntry(
+            room_box,
+            placeholder_text="#room",
+            height=25,
+            width=70
+        )
+        self.room_entry.pack(side="left", fill="x", expand=True)
+        self.room_entry.bind("<Return>", lambda e: self.join_room_from_entry())
+
+        ctk.CTkButton(
+            room_box,
+            text="+",
+            height=25,
+            width=25,
+            fg_color="#444",
+            command=self.join_room_from_entry
+        ).pack(side="right", padx=(3, 0))
+
         ctk.CTkButton(
             self.sidebar,
             text="Disconnect",
@@ -428,11 +1182,16 @@ class ChatClientGUI:
         )
         self.header.pack(pady=5, anchor="w", padx=10)
 
-        self.chat_display = ctk.CTkScrollableFrame(
+        self.load_older_btn = ctk.CTkButton(
             panel,
-            fg_color="white"
+            text="Load older messages",
+            height=22,
+            fg_color="#9E9E9E",
+            command=self.request_older_history
         )
-        self.chat_display.pack(
+
+        self.transcript = TranscriptView(panel, self.updates, self.avatar_for, self.download_file)
+        self.transcript.pack(
             fill="both",
             expand=True,
             padx=5,
@@ -468,52 +1227,112 @@ class ChatClientGUI:
             command=self.send_message
         ).pack(side="right", padx=5)
 
+        ctk.CTkButton(
+            input_box,
+            text="📎",
+            width=30,
+            height=30,
+            fg_color="#757575",
+            command=self.attach_file
+        ).pack(side="right")
+
     def update_sidebar(self):
-        for w in self.users_frame.winfo_children():
+        everyone = self.target_user == "Everyone" and not self.target_room
+        if everyone != self.all_highlighted:
+            self.all_highlighted = everyone
+            self.all_btn.configure(fg_color="#3B8ED0" if everyone else "transparent")
+
+        self.user_list.update(self.users_online, self.username, self.target_user)
+        self.update_rooms()
+
+    def update_rooms(self):
+        # A handful of widgets: rebuilt, but only when something in them changed
+        shown = (
+            tuple(tuple(room) for room in self.rooms_list),
+            frozenset(self.my_rooms),
+            self.target_room
+        )
+        if shown == self.rooms_shown:
+            return
+        self.rooms_shown = shown
+
+        for w in self.rooms_frame.winfo_children():
             w.destroy()
 
-        highlight = (
-            "#3B8ED0" if self.target_user == "Everyone" else "transparent"
-        )
-        ctk.CTkButton(
-            self.users_frame,
-            text="All",
-            fg_color=highlight,
-            anchor="w",
-            height=30,
-            width=80,
-            command=lambda: self.set_target("Everyone")
-        ).pack(fill="x", pady=2)
+        if not self.rooms_list and not self.my_rooms:
+            return
 
-        for user in self.users_online:
-            if user == self.username or not user:
-                continue
+        ctk.CTkLabel(
+            self.rooms_frame,
+            text="Rooms:",
+            text_color="gray",
+            font=("Arial", 10)
+        ).pack(pady=(8, 2), anchor="w")
 
-            avatar = self.users_avatars_map.get(user, "Boy")
-            img = self.images.get(avatar, self.images["Boy"])
-            color = (
-                "#3B8ED0" if self.target_user == user else "transparent"
-            )
+        for room, members in self.rooms_list:
+            joined = room in self.my_rooms
+            row = ctk.CTkFrame(self.rooms_frame, fg_color="transparent")
+            row.pack(fill="x", pady=2)
+
+            if joined:
+                color = "#2E7D32" if self.target_room == room else "#444"
+                command = lambda r=room: self.set_room_target(r)
+            else:
+                # Not a member yet: clicking joins
+                color = "transparent"
+                command = lambda r=room: self.send_room_command(JOIN_PREFIX, r)
 
             ctk.CTkButton(
-                self.users_frame,
-                text=f" {user}",
-                image=img,
-                compound="left",
+                row,
+                text=f"# {room} ({members})",
                 fg_color=color,
                 anchor="w",
-                height=30,
-                width=80,
-                command=lambda u=user: self.set_target(u)
-            ).pack(fill="x", pady=2)
+                height=26,
+                width=60,
+                command=command
+            ).pack(side="left", fill="x", expand=True)
+
+            if joined:
+                ctk.CTkButton(
+                    row,
+                    text="×",
+                    fg_color="#757575",
+                    height=26,
+                    width=20,
+                    command=lambda r=room: self.send_room_command(LEAVE_PREFIX, r)
+                ).pack(side="right", padx=(2, 0))
 
     def set_target(self, target):
         self.target_user = target
+        self.target_room = None
         self.header.configure(
             text=f"To: {target}",
             text_color="#D32F2F" if target != "Everyone" else "#333"
         )
-        self.update_sidebar()
+        self.request_sidebar()
+
+    def set_room_target(self, room):
+        self.target_user = "Everyone"
+        self.target_room = room
+        self.header.configure(text=f"To: #{room}", text_color="#2E7D32")
+        self.request_sidebar()
+
+    def join_room_from_entry(self):
+        room = self.room_entry.get().strip().lstrip("#")
+        if not valid_room(room):
+            messagebox.showwarning(
+                "Rooms",
+                "Room names are 1-32 letters, digits, '-' or '_'."
+            )
+            return
+        self.room_entry.delete(0, "end")
+        self.send_room_command(JOIN_PREFIX, room)
+
+    def send_room_command(self, prefix, room):
+        try:
+            self.send_line(f"{prefix}{room}")
+        except Exception:
+            pass
 
     def add_message(
         self,
@@ -521,91 +1340,62 @@ class ChatClientGUI:
         text,
         is_mine,
         is_private=False,
-        is_system=False
+        is_system=False,
+        sent_at=None,
+        room=None,
+        file=None
     ):
+        # sent_at: unix time, file: notice of a shared file
         if is_system:
-            ctk.CTkLabel(
-                self.chat_display,
-                text=text,
-                font=("Arial", 9),
-                text_color="gray"
-            ).pack(pady=2)
-            self.scroll_to_bottom()
+            kind = SYSTEM
+        else:
+            kind = MINE if is_mine else OTHER
+        tag = "Priv" if is_private else (f"#{room}" if room else None)
+
+        entry = Entry(kind, sender, text, sent_at, tag, file)
+        if self.transcript.append(entry) and self.history_oldest is not None:
+            # The oldest messages were dropped, older pages would leave a gap
+            self.history_oldest = None
+            self.set_load_older(False)
+        return entry
+
+    def show_history(self, messages, more):
+        """Insert a page of older public messages above everything shown so far."""
+        if not self.connected or not messages:
             return
 
-        bg_color = "#DCF8C6" if is_mine else "#ECECEC"
-
-        row = ctk.CTkFrame(self.chat_display, fg_color="transparent")
-        row.pack(fill="x", pady=5, padx=5)
-
-        content = ctk.CTkFrame(row, fg_color="transparent")
-        content.pack(side="right" if is_mine else "left")
-
-        if not is_mine:
-            avatar = self.users_avatars_map.get(sender, "Boy")
-            img = self.images.get(avatar, self.images["Boy"])
-            lbl = ctk.CTkLabel(content, text="", image=img)
-            lbl.pack(side="left", padx=5, anchor="n")
-
-            self.msg_bubbles_cache.setdefault(sender, []).append(lbl)
-
-        bubble = ctk.CTkFrame(
-            content,
-            fg_color=bg_color,
-            corner_radius=12
-        )
-        bubble.pack(side="left")
-
-        display_name = "Me" if is_mine else sender
-        ctk.CTkLabel(
-            bubble,
-            text=display_name,
-            font=("Arial", 10, "bold"),
-            text_color="gray30"
-        ).pack(anchor="w", padx=8, pady=(4, 0))
-
-        ctk.CTkLabel(
-            bubble,
-            text=text,
-            font=("Arial", 12),
-            text_color="black",
-            wraplength=180,
-            justify="left"
-        ).pack(padx=8, pady=(2, 5))
-
-        meta = datetime.now().strftime("%H:%M")
-        if is_private:
-            meta += " • Priv"
-
-        ctk.CTkLabel(
-            bubble,
-            text=meta,
-            font=("Arial", 8),
-            text_color="gray40"
-        ).pack(anchor="e", padx=8, pady=(0, 5))
-
-        self.scroll_to_bottom()
-
-    def scroll_to_bottom(self):
-        self.chat_display.update_idletasks()
-        self.chat_display.after(
-            10,
-            lambda: self.chat_display._parent_canvas.yview_moveto(1.0)
-        )
+        entries = [
+            Entry(MINE if sender == self.username else OTHER, sender, text, sent_at)
+            for seq, sent_at, sender, text in messages
+        ]
+        if self.transcript.prepend(entries) < len(entries):
+            # The transcript is full
+            more = False
+        self.history_oldest = messages[0][0]
+        self.set_load_older(more)
+
+    def set_load_older(self, show):
+        if show:
+            self.load_older_btn.pack(pady=(0, 4), before=self.transcript.frame)
+        else:
+            self.load_older_btn.pack_forget()
 
-    def refresh_bubble_images(self, user):
-        if user not in self.msg_bubbles_cache:
+    def request_older_history(self):
+        if self.history_oldest is None:
             return
+        try:
+            self.send_line(format_request(PUBLIC, self.history_oldest, 50))
+        except Exception:
+            pass
 
-        new_img = self.images.get(
+    def avatar_for(self, user):
+        return self.images.get(
             self.users_avatars_map.get(user, "Boy"),
             self.images["Boy"]
         )
-        for lbl in self.msg_bubbles_cache[user]:
-            try:
-                lbl.configure(image=new_img)
-            except Exception:
-                pass
+
+    def refresh_bubble_images(self, user):
+        self.transcript.refresh_avatars(user)
 
     # Profile & connection management
     def open_edit_profile(self):
@@ -643,12 +1433,9 @@ class ChatClientGUI:
                 row += 1
 
     def send_avatar_cmd(self):
-        try:
-            self.client_socket.send(
-                f"CMD:AVATAR:{self.my_avatar}\n".encode()
-            )
-        except Exception:
-            pass
+        # The client sends it again after every reconnect
+        if self.client is not None:
+            self.client.set_avatar(self.my_avatar)
 
     def send_message(self):
         text = self.msg_entry.get()
@@ -656,7 +1443,10 @@ class ChatClientGUI:
             return
 
         full_message = text
-        if self.target_user != "Everyone":
+        if self.target_room:
+            full_message = f"{SEND_PREFIX}{self.target_room}:{text}"
+            self.add_message("Me", text, True, room=self.target_room)
+        elif self.target_user != "Everyone":
             full_message = f"to:{self.target_user} {text}"
             self.add_message(
                 "Me",
@@ -668,22 +1458,237 @@ class ChatClientGUI:
             self.add_message("Me", text, True)
 
         try:
-            self.client_socket.send(
-                f"{full_message}\n".encode()
-            )
+            self.send_line(full_message)
         except Exception:
-            self.perform_logout()
+            self.add_message("System", "[System] Not connected, message not sent.", False, is_system=True)
 
         self.msg_entry.delete(0, "end")
 
-    def perform_logout(self):
-        self.connected = False
-        if self.client_socket:
+    # File sharing
+    def attach_file(self):
+        if not self.connected:
+            return
+        if FEATURE_FILES not in self.server_features:
+            messagebox.showwarning("Files", "This server does not support file sharing.")
+            return
+
+        path = filedialog.askopenfilename(parent=self.root, title="Share a file")
+        if not path:
+            return
+
+        if self.target_room:
+            target = f"#{self.target_room}"
+        elif self.target_user != "Everyone":
+            target = f"@{self.target_user}"
+        else:
+            target = PUBLIC
+
+        upload_id = self.next_upload_id
+        self.next_upload_id += 1
+        name = clean_name(path)
+        entry = self.add_message("System", f"Sending {name}", False, is_system=True)
+        entry.progress = 0.0
+        self.transcript.update_entry(entry)
+        threading.Thread(
+            target=self.upload_file,
+            args=(upload_id, path, name, target, entry),
+            daemon=True
+        ).start()
+
+    def upload_file(self, upload_id, path, name, target, entry):
+        # Hashing and sending stay off the Tk thread; chat lines from
+        # send_line go out between two chunks
+        progress = self.progress_callback(entry, f"Sending {name}")
+        state = {"acked": None, "result": None}
+        with self.upload_cond:
+            self.uploads[upload_id] = state
+
+        try:
+            digest, size = file_digest(path)
+            if not 0 < size <= MAX_FILE_SIZE:
+                raise ValueError(f"files must be between 1 byte and {human_size(MAX_FILE_SIZE)}")
+            self.send_line(format_offer(upload_id, name, size, digest, target))
+
+            sent = 0
+            with open(path, "rb") as f:
+                while sent < size:
+                    # At most WINDOW bytes in flight; True if the server already has the file
+                    if self.wait_upload(state, lambda: state["acked"] is not None and sent - state["acked"] < WINDOW):
+                        break
+                    chunk = f.read(min(CHUNK_SIZE, size - sent))
+                    if not chunk:
+                        raise ValueError("the file changed while sending")
+                    self.client.send_frame(pack_chunk(upload_id, chunk), FRAME_BINARY)
+                    sent += len(chunk)
+                    progress(sent, size)
+
+            self.wait_upload(state, lambda: False)
+            text = f"Sent {name} ({human_size(size)})"
+        except Exception as e:
+            text = f"Could not send {name}: {e}"
+            if state["result"] is None and self.connected:
+                try:
+                    self.send_line(f"{FILE_CANCEL}{upload_id}")
+                except Exception:
+                    pass
+        finally:
+            with self.upload_cond:
+                self.uploads.pop(upload_id, None)
+
+        self.end_transfer(entry, text)
+
+    def wait_upload(self, state, ready):
+        """Wait for ready() or the server's verdict. True once the file is stored, raises if it failed."""
+        with self.upload_cond:
+            if not self.upload_cond.wait_for(
+                lambda: ready() or state["result"] is not None or not self.connected,
+                timeout=UPLOAD_TIMEOUT
+            ):
+                raise TimeoutError("the server stopped responding")
+
+        if not self.connected:
+            raise ConnectionError("disconnected")
+        result = state["result"]
+        if result is None:
+            return False
+        if result[0] == "error":
+            raise OSError(result[1])
+        return True
+
+    def update_upload(self, data):
+        for prefix in (FILE_ACK, FILE_READY, FILE_ERROR):
+            if data.startswith(prefix):
+                upload_id, value = parse_status(data, prefix)
+                break
+
+        with self.upload_cond:
+            state = self.uploads.get(upload_id)
+            if state is None:
+                return
+            if prefix == FILE_ACK:
+                state["acked"] = int(value)
+            elif prefix == FILE_READY:
+                state["result"] = ("ready", value)
+            else:
+                state["result"] = ("error", value)
+            self.upload_cond.notify_all()
+
+    def add_file_message(self, notice):
+        target = notice["to"]
+        self.add_message(
+            notice["from"],
+            f"📎 {notice['name']} ({human_size(notice['size'])})",
+            False,
+            is_private=target.startswith("@"),
+            room=target[1:] if target.startswith("#") else None,
+            file=notice
+        )
+
+    def download_file(self, entry):
+        path = filedialog.asksaveasfilename(
+            parent=self.root,
+            title="Save file",
+            initialfile=entry.file["name"]
+        )
+        if not path:
+            return
+
+        entry.busy = True
+        entry.status = "Downloading"
+        entry.progress = 0.0
+        self.transcript.update_entry(entry)
+        threading.Thread(
+            target=self.download_thread,
+            args=(entry, path),
+            daemon=True
+        ).start()
+
+    def download_thread(self, entry, path):
+        # A connection of its own, so chat keeps flowing while the file streams in
+        notice = entry.file
+        progress = self.progress_callback(entry, "Downloading")
+        partial = path + ".part"
+        preview = None
+        try:
+            sock = self.connect_socket()
+            try:
+                with open(partial, "wb") as f:
+                    download(sock, notice["file"], f, progress)
+            finally:
+                sock.close()
+            os.replace(partial, path)
+
+            if is_image(path) and notice["size"] <= PREVIEW_MAX:
+                preview = self.load_preview(path)
+            text = f"Saved {os.path.basename(path)}"
+        except Exception as e:
+            text = f"Download failed: {e}"
             try:
-                self.client_socket.close()
-            except Exception:
+                os.unlink(partial)
+            except OSError:
                 pass
 
+        self.end_transfer(entry, text, preview)
+
+    def load_preview(self, path):
+        # Decoded on the transfer thread; only the small thumbnail reaches Tk
+        try:
+            from PIL import Image
+            with Image.open(path) as img:
+                img.thumbnail((180, 180))
+                return img.copy()
+        except Exception:
+            return None
+
+    def progress_callback(self, entry, text):
+        """progress(done, total) for transfer threads; the bar is redrawn once per tick."""
+        def progress(done, total):
+            self.updates.mark(
+                ("progress", entry.serial),
+                lambda: self.show_progress(entry, text, done, total)
+            )
+
+        return progress
+
+    def show_progress(self, entry, text, done, total):
+        entry.progress = done / total
+        label = f"{text} {human_size(done)} / {human_size(total)}"
+        if entry.kind == SYSTEM:
+            entry.text = label
+        else:
+            entry.status = label
+        self.transcript.update_entry(entry)
+
+    def end_transfer(self, entry, text, preview=None):
+        """Called by transfer threads; replaces a progress update still pending for this tick."""
+        self.updates.mark(
+            ("progress", entry.serial),
+            lambda: self.finish_transfer(entry, text, preview)
+        )
+
+    def finish_transfer(self, entry, text, preview=None):
+        entry.progress = None
+        entry.busy = False
+        if entry.kind == SYSTEM:
+            entry.text = text
+        else:
+            entry.status = text
+        if preview is not None:
+            entry.image = ctk.CTkImage(light_image=preview, dark_image=preview, size=preview.size)
+        self.transcript.update_entry(entry)
+
+    def perform_logout(self):
+        self.connected = False
+        self.username = ""
+        self.reconnecting = False
+        with self.upload_cond:
+            # Running uploads give up
+            self.upload_cond.notify_all()
+        if self.client is not None:
+            self.tls_session = self.client.tls_session
+            self.client.stop()
+            self.client = None
+
         self.root.withdraw()
         self.open_login_window()
 
@@ -696,11 +1701,82 @@ class ChatClientGUI:
                 return
             self.server_process.terminate()
 
+        if self.client is not None:
+            self.client.stop()
         self.root.destroy()
         sys.exit()
 
 
+def measure_startup(root, app, name):
+    """
+    --measure-startup: show the login window, log in as name and print the
+    time from startup to the login window on screen, to the avatars and the
+    chat window being ready, to the login and to the first message from the
+    server on screen, then quit.
+    """
+    def report(stage):
+        print(f"{stage:<16} {(time.perf_counter() - STARTED) * 1000:8.1f} ms", flush=True)
+
+    shown = []
+
+    def mapped(event):
+        if event.widget is app.login_win and not shown:
+            shown.append(True)
+            report("login window")
+
+    app.login_win.bind("<Map>", mapped, add="+")
+    while not app.started:
+        root.update()
+        time.sleep(0.001)
+    report("ready")
+
+    apply_client_status = app.apply_client_status
+
+    def status(client, state, detail):
+        apply_client_status(client, state, detail)
+        if state == CONNECTED:
+            report("logged in")
+        elif state == FAILED:
+            print(f"login failed: {detail}")
+            app.on_close_app()
+
+    def first_message():
+        root.update_idletasks()
+        report("first message")
+        app.on_close_app()
+
+    process_message = app.process_message
+
+    def first(data):
+        # Only the first line is timed, then the listener calls the method again
+        app.process_message = process_message
+        process_message(data)
+        app.updates.mark("startup", lambda: root.after_idle(first_message))
+
+    app.apply_client_status = status
+    app.process_message = first
+    app.name_entry.insert(0, name)
+    app.connect_server()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GUI chat client")
+    parser.add_argument("--tls", action="store_true", help="connect over TLS")
+    parser.add_argument("--tls-ca", help="CA or self-signed server certificate to trust (PEM)")
+    parser.add_argument(
+        "--measure-startup",
+        metavar="NAME",
+        help="log in as NAME, print startup times and quit"
+    )
+    args = parser.parse_args()
+
+    tls_context = None
+    if args.tls or args.tls_ca:
+        from tls import client_context
+        tls_context = client_context(args.tls_ca)
+
     root = ctk.CTk()
-    app = ChatClientGUI(root)
+    app = ChatClientGUI(root, tls_context)
+    if args.measure_startup:
+        measure_startup(root, app, args.measure_startup)
     root.mainloop()
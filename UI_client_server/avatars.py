@@ -0,0 +1,143 @@
+"""
+Avatar images for the GUI client.
+
+Rendering the emoji avatars takes Pillow, a TrueType emoji font and a
+good part of the client's startup. They are rendered once into a sprite
+atlas (one row of TILE x TILE tiles, in AVATAR_MAP order) and cached as a
+PNG whose name is a hash of the font, the sizes, the avatar set and the
+Pillow version; later starts only decode that PNG. Pillow is imported on
+first use, and AvatarImages loads the atlas on the first lookup.
+
+Avatars drawn with Pillow's fallback font (the emoji font is missing) are
+not cached, so installing the font takes effect on the next start.
+"""
+import hashlib
+import os
+import tempfile
+
+AVATAR_MAP = {
+    "Boy": "👨‍💻", "Girl": "👩‍💻", "Robot": "🤖", "Alien": "👽",
+    "Fox": "🦊", "Tiger": "🐯", "Dog": "🐶", "Unicorn": "🦄",
+    "Soccer": "⚽", "Basket": "🏀", "Pizza": "🍕", "Guitar": "🎸",
+    "Rocket": "🚀", "Star": "⭐", "Ghost": "👻", "Cat": "🐱"
+}
+
+EMOJI_FONT = "seguiemj.ttf"
+FONT_SIZE = 64
+TILE = 100
+
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "networks_chat")
+
+
+def atlas_name(font=EMOJI_FONT, font_size=FONT_SIZE, tile=TILE):
+    import PIL
+    key = "|".join(
+        [font, str(font_size), str(tile), PIL.__version__]
+        + [f"{name}={char}" for name, char in AVATAR_MAP.items()]
+    )
+    return f"avatars-{hashlib.sha256(key.encode()).hexdigest()[:16]}.png"
+
+
+def render_atlas(font=EMOJI_FONT, font_size=FONT_SIZE, tile=TILE):
+    """(atlas image, whether the emoji font was found)."""
+    from PIL import Image, ImageDraw, ImageFont
+
+    try:
+        face = ImageFont.truetype(font, font_size)
+        found = True
+    except Exception:
+        face = ImageFont.load_default()
+        found = False
+
+    atlas = Image.new("RGBA", (tile * len(AVATAR_MAP), tile), (0, 0, 0, 0))
+    for i, char in enumerate(AVATAR_MAP.values()):
+        # Drawn on its own tile so a wide glyph cannot spill into the next one
+        img = Image.new("RGBA", (tile, tile), (0, 0, 0, 0))
+        ImageDraw.Draw(img).text(
+            (tile // 2, tile // 2),
+            char,
+            font=face,
+            fill="white",
+            anchor="mm",
+            embedded_color=True
+        )
+        atlas.paste(img, (i * tile, 0))
+    return atlas, found
+
+
+def save_atlas(atlas, path):
+    # Written to a temporary file first: two clients may start at once
+    directory = os.path.dirname(path)
+    temp_path = None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".png")
+        with os.fdopen(fd, "wb") as f:
+            atlas.save(f, "PNG")
+        os.replace(temp_path, path)
+    except OSError:
+        if temp_path is not None:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+
+
+def load_atlas(directory=None, font=EMOJI_FONT, font_size=FONT_SIZE, tile=TILE):
+    """Dict avatar name -> PIL image, from the cached atlas when there is one."""
+    from PIL import Image
+
+    path = os.path.join(directory or cache_dir(), atlas_name(font, font_size, tile))
+    atlas = None
+    try:
+        with Image.open(path) as cached:
+            if cached.size == (tile * len(AVATAR_MAP), tile):
+                atlas = cached.convert("RGBA")
+    except (OSError, ValueError):
+        pass
+
+    if atlas is None:
+        atlas, found = render_atlas(font, font_size, tile)
+        if found:
+            save_atlas(atlas, path)
+
+    return {
+        name: atlas.crop((i * tile, 0, (i + 1) * tile, tile))
+        for i, name in enumerate(AVATAR_MAP)
+    }
+
+
+class AvatarImages:
+    """
+    Avatar name -> toolkit image, made by make_image(PIL image). The atlas
+    is loaded on the first lookup and each image made on its own first
+    lookup, so nothing is rendered or decoded before an avatar is shown.
+    """
+
+    def __init__(self, make_image, directory=None):
+        self.make_image = make_image
+        self.directory = directory
+        self.tiles = None
+        self.images = {}
+
+    def __contains__(self, name):
+        return name in AVATAR_MAP
+
+    def __getitem__(self, name):
+        image = self.images.get(name)
+        if image is None:
+            if name not in AVATAR_MAP:
+                raise KeyError(name)
+            if self.tiles is None:
+                self.tiles = load_atlas(self.directory)
+            image = self.images[name] = self.make_image(self.tiles[name])
+        return image
+
+    def get(self, name, default=None):
+        return self[name] if name in AVATAR_MAP else default
+
+    def items(self):
+        return [(name, self[name]) for name in AVATAR_MAP]
@@ -0,0 +1,114 @@
+"""
+Benchmark for the broadcast fan-out path.
+
+Registers N in-process recipients with serverUI's registry and measures
+how many broadcasts per second broadcast_packet() sustains, including
+draining every recipient's outbound queue into /dev/null. Compares:
+
+- per-recipient encode: the old path, every recipient gets its own
+  f"{message}\\n".encode() and the writer joins its batch before writing
+- encode once: serverUI.broadcast_packet() shares one frame between all
+  queues and the writer uses one scatter-gather writev() per batch
+
+Run:
+python bench_broadcast.py
+"""
+import argparse
+import os
+import time
+
+import serverUI
+from framing import FRAMED, LEGACY
+from outbound import IOV_MAX, OutboundQueue, flatten
+
+
+class SinkConnection:
+    """Stands in for a client: a real outbound queue drained into /dev/null."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.features = set()
+        self.queue = OutboundQueue(high_water=1 << 40, low_water=1 << 39)
+
+    def send(self, data, control=False, key=None):
+        self.queue.put(data, control, key)
+        return len(data)
+
+
+def drain_joined(conns, fd):
+    for conn in conns:
+        batch = conn.queue.take(block=False)
+        if batch:
+            os.write(fd, b"".join(batch))
+
+
+def drain_writev(conns, fd):
+    for conn in conns:
+        batch = conn.queue.take(block=False)
+        if batch:
+            buffers = flatten(batch)
+            for i in range(0, len(buffers), IOV_MAX):
+                os.writev(fd, buffers[i:i + IOV_MAX])
+
+
+def per_recipient_broadcast(conns, message, codec):
+    for conn in conns:
+        if codec is LEGACY:
+            conn.send(f"{message}\n".encode())
+        else:
+            conn.send(codec.encode(message))
+
+
+def shared_broadcast(conns, message, codec):
+    serverUI.broadcast_packet(message)
+
+
+def run(recipients, messages, codec, size, coalesce, broadcast, drain):
+    serverUI.registry = serverUI.SessionRegistry()
+    conns = [SinkConnection(codec) for _ in range(recipients)]
+    for i, conn in enumerate(conns):
+        serverUI.registry.register(conn, f"user{i}")
+
+    message = "sender:" + "x" * size
+    fd = os.open(os.devnull, os.O_WRONLY)
+    try:
+        started = time.perf_counter()
+        for i in range(messages):
+            broadcast(conns, message, codec)
+            # Writers usually find several frames queued per wakeup
+            if (i + 1) % coalesce == 0:
+                drain(conns, fd)
+        drain(conns, fd)
+        return time.perf_counter() - started
+    finally:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Broadcast fan-out benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--deliveries", type=int, default=300_000, help="target deliveries per run")
+    parser.add_argument("--payloads", type=int, nargs="+", default=[200, 4000], help="message body sizes in bytes")
+    parser.add_argument("--coalesce", type=int, default=8, help="broadcasts queued per writer wakeup")
+    args = parser.parse_args()
+
+    variants = [
+        ("per-recipient encode", per_recipient_broadcast, drain_joined),
+        ("encode once + writev", shared_broadcast, drain_writev),
+    ]
+
+    for payload in args.payloads:
+        for codec in (LEGACY, FRAMED):
+            print(f"{codec.name} clients, {payload} byte messages")
+            for recipients in args.sizes:
+                messages = max(args.coalesce, args.deliveries // recipients)
+                for label, broadcast, drain in variants:
+                    elapsed = run(
+                        recipients, messages, codec, payload,
+                        args.coalesce, broadcast, drain
+                    )
+                    print(
+                        f"  {recipients:>6} recipients  {label:<22} "
+                        f"{messages / elapsed:>10,.1f} msg/s "
+                        f"{messages * recipients / elapsed:>12,.0f} deliveries/s"
+                    )
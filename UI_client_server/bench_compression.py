@@ -0,0 +1,143 @@
+"""
+Benchmark for negotiated compression: bandwidth saved against CPU spent.
+
+Encodes typical server traffic (chat lines, LIST: user lists, presence
+snapshots, history pages) and compares, per message:
+
+- raw: plain FRAME_TEXT frames (the framed codec)
+- deflate: per-message raw deflate without a dictionary
+- deflate + dict: what the server sends to "deflate" clients
+  (compression.DEFLATE: preset dictionary, COMPRESS_MIN threshold)
+- stream: one zlib context per connection, flushed per message. Smaller
+  frames on long conversations, but a broadcast has to be compressed once
+  per recipient instead of once in total
+
+Prints bytes on the wire, the ratio to raw, and the encode and decode CPU
+per message; for the stream variant the encode column is multiplied by
+--recipients to show the cost of one broadcast.
+
+Run:
+python bench_compression.py
+"""
+import argparse
+import random
+import time
+import zlib
+
+from compression import COMPRESS_LEVEL, DEFLATE, MEM_LEVEL, WINDOW_BITS
+from framing import FRAME_DEFLATE, FRAMED, HEADER
+from history import format_page
+from presence import format_snapshot
+from registry import Session
+
+WORDS = (
+    "the and you that for are with this have what not but can was just will "
+    "all from about your know like get out when how there one time think good "
+    "yes now see back today going really thanks well right here please hello "
+    "hi hey ok okay lol meeting lunch tomorrow project deadline server client "
+    "message room socket thread python network packet latency works broken"
+).split()
+
+
+def chat_lines(rng, count):
+    lines = []
+    for _ in range(count):
+        sender = f"user{rng.randrange(500)}"
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 60)))
+        lines.append(f"{sender}:{text}")
+    return lines
+
+
+def workloads(rng, population):
+    names = [f"user{i}" for i in range(population)]
+    sessions = [Session(None, name, rng.choice(("Boy", "Girl", "Cat", "Robot"))) for name in names]
+    history = [
+        [seq, 1_700_000_000 + seq, f"user{rng.randrange(population)}", line.split(":", 1)[1]]
+        for seq, line in enumerate(chat_lines(rng, 1000), 1)
+    ]
+    # Consecutive lists differ by one join, like on a busy server
+    joins = range(population - 20, population)
+    return [
+        ("chat lines", chat_lines(rng, 2000)),
+        (f"LIST: ({population} users)", ["LIST:" + ",".join(names[:count]) for count in joins]),
+        (f"presence snapshot ({population})", [format_snapshot(seq, sessions[:count]) for seq, count in enumerate(joins)]),
+        ("history page (50)", [format_page("all", history[i:i + 50], True) for i in range(0, 1000, 50)]),
+    ]
+
+
+def plain_deflate(text):
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL)
+    body = compressor.compress(text.encode()) + compressor.flush()
+    return HEADER.pack(len(body), FRAME_DEFLATE) + body
+
+
+def run_stateless(messages, encode, decode):
+    started = time.perf_counter()
+    frames = [encode(text) for text in messages]
+    encoded = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for frame in frames:
+        decode(frame)
+    decoded = time.perf_counter() - started
+    return sum(len(frame) for frame in frames), encoded, decoded
+
+
+def run_stream(messages):
+    # Set up once per connection, so it can afford zlib's full 32 KiB window
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    inflater = zlib.decompressobj(-15)
+
+    started = time.perf_counter()
+    frames = [
+        compressor.compress(text.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        for text in messages
+    ]
+    encoded = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for frame in frames:
+        inflater.decompress(frame)
+    decoded = time.perf_counter() - started
+    return sum(HEADER.size + len(frame) for frame in frames), encoded, decoded
+
+
+def decode_frame(codec):
+    def decode(frame):
+        length, frame_type = HEADER.unpack_from(frame)
+        return codec.decode(frame_type, frame[HEADER.size:])
+    return decode
+
+
+def inflate_plain(frame):
+    return zlib.decompress(frame[HEADER.size:], -15)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compression bandwidth and CPU benchmark")
+    parser.add_argument("--population", type=int, default=1000, help="users in lists and snapshots")
+    parser.add_argument("--recipients", type=int, default=100, help="broadcast size for the stream column")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    variants = [
+        ("raw", lambda messages: run_stateless(messages, FRAMED.encode, decode_frame(FRAMED))),
+        ("deflate", lambda messages: run_stateless(messages, plain_deflate, inflate_plain)),
+        ("deflate + dict", lambda messages: run_stateless(messages, DEFLATE.encode, decode_frame(DEFLATE))),
+        ("stream", run_stream),
+    ]
+
+    rng = random.Random(args.seed)
+    for title, messages in workloads(rng, args.population):
+        raw_bytes = sum(len(text.encode()) + HEADER.size for text in messages)
+        print(f"{title}: {len(messages)} messages, {raw_bytes / len(messages):,.0f} bytes each")
+        for label, run in variants:
+            size, encoded, decoded = run(messages)
+            encode_us = encoded / len(messages) * 1e6
+            note = ""
+            if label == "stream":
+                note = f"  ({encode_us * args.recipients:,.1f} us per broadcast to {args.recipients})"
+            print(
+                f"  {label:<15} {size:>12,} bytes {size / raw_bytes:>7.1%}  "
+                f"encode {encode_us:>8.2f} us/msg  decode {decoded / len(messages) * 1e6:>7.2f} us/msg{note}"
+            )
@@ -0,0 +1,93 @@
+"""
+Microbenchmark for the incoming-stream decoder.
+
+Compares the old approach (recv().decode() followed by repeated
+split("\\n", 1) on the remaining buffer, with 1 KiB reads as before and
+with full segment reads) with framing.StreamDecoder in line
+and frame mode, for a burst of small messages and for 64 KiB messages.
+
+Run:
+python bench_decoder.py
+"""
+import argparse
+import time
+
+from framing import FRAMED, LEGACY, StreamDecoder
+
+
+class ReplaySocket:
+    """Feeds a prepared byte stream through recv()/recv_into() in TCP sized chunks."""
+
+    def __init__(self, data, chunk):
+        self.view = memoryview(data)
+        self.pos = 0
+        self.chunk = chunk
+
+    def recv(self, size):
+        size = min(size, self.chunk)
+        data = self.view[self.pos:self.pos + size].tobytes()
+        self.pos += len(data)
+        return data
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.chunk, len(self.view) - self.pos)
+        buffer[:size] = self.view[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+
+def naive_split(sock, recv_size):
+    count = 0
+    buffer = ""
+    while True:
+        data = sock.recv(recv_size).decode(errors="replace")
+        if not data:
+            return count
+        buffer += data
+        while "\n" in buffer:
+            message, buffer = buffer.split("\n", 1)
+            count += 1
+
+
+def stream_decoder(sock, framed):
+    count = 0
+    decoder = StreamDecoder(framed=framed)
+    while decoder.recv_into(sock):
+        for _, payload in decoder.messages():
+            payload.decode(errors="replace")
+            count += 1
+    return count
+
+
+def run(label, data, messages, chunk, func, *args):
+    sock = ReplaySocket(data, chunk)
+    started = time.perf_counter()
+    count = func(sock, *args)
+    elapsed = time.perf_counter() - started
+    assert count == messages, (label, count, messages)
+    print(
+        f"  {label:<22} {messages / elapsed:>12,.0f} msg/s "
+        f"{len(data) / elapsed / 1e6:>9.1f} MB/s"
+    )
+
+
+def scenario(title, text, messages, chunk):
+    line_stream = b"".join(LEGACY.encode(text) for _ in range(messages))
+    frame_stream = b"".join(FRAMED.encode(text) for _ in range(messages))
+
+    print(f"{title}: {messages} x {len(text.encode())} bytes, {chunk} byte segments")
+    run("naive split (1 KiB)", line_stream, messages, chunk, naive_split, 1024)
+    run("naive split (segment)", line_stream, messages, chunk, naive_split, chunk)
+    run("decoder (lines)", line_stream, messages, chunk, stream_decoder, False)
+    run("decoder (frames)", frame_stream, messages, chunk, stream_decoder, True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream decoder microbenchmark")
+    parser.add_argument("--small", type=int, default=100_000, help="messages in the small burst")
+    parser.add_argument("--large", type=int, default=200, help="number of 64 KiB messages")
+    parser.add_argument("--chunk", type=int, default=16 * 1024, help="bytes per simulated recv")
+    args = parser.parse_args()
+
+    scenario("Small-message burst", "alice:hello there, how is it going? 😀", args.small, args.chunk)
+    scenario("64 KiB messages", "x" * (64 * 1024 - 1), args.large, args.chunk)
@@ -0,0 +1,228 @@
+"""
+Headless benchmark for the GUI client's update pipeline.
+
+Feeds server lines straight into ChatClientGUI.process_message with
+customtkinter, PIL and tkinter replaced by do-nothing stand-ins that count
+every call, so it runs without a display and measures only the client's
+own work. Workloads:
+
+- chat: a burst of public chat lines
+- presence: LIST: user lists and CMD:UPDATE_AVATAR: lines of a large
+  server, as servers without presence deltas send them
+- mixed: chat with presence deltas (joins, leaves, avatar changes) in
+  between
+
+Each workload runs twice:
+
+- per line: the update queue is drained after every line, like the one
+  root.after() callback per line the client used to schedule
+- ticked: the queue is drained every updates.TICK seconds, as the GUI does
+
+Prints lines per second and, per 1000 lines, the drains (Tk callbacks),
+sidebar redraws, transcript layouts and calls into the stubbed widgets.
+
+Run:
+python bench_gui.py --lines 100000
+"""
+import argparse
+import random
+import sys
+import time
+import types
+
+ROW_HEIGHT = 60
+VIEW_WIDTH = 400
+VIEW_HEIGHT = 600
+
+
+class Stub:
+    """Stands in for every widget, image and toolkit function; counts calls."""
+
+    calls = 0
+
+    def __call__(self, *args, **kwargs):
+        Stub.calls += 1
+        return self
+
+    def __getattr__(self, name):
+        return self
+
+    def __iter__(self):
+        return iter(())
+
+    def winfo_reqheight(self):
+        return ROW_HEIGHT
+
+
+STUB = Stub()
+
+
+class StubCanvas:
+    """Just enough of a Tk canvas for the transcript's scroll arithmetic."""
+
+    def __init__(self, *args, **kwargs):
+        self.top = 0
+        self.region = 0
+        self.items = 0
+
+    def __getattr__(self, name):
+        # pack, bind, bind_all, coords, itemconfigure, update_idletasks, ...
+        return STUB
+
+    def configure(self, scrollregion=None, **kwargs):
+        Stub.calls += 1
+        if scrollregion is not None:
+            self.region = scrollregion[3]
+            self.top = max(0, min(self.top, self.region - VIEW_HEIGHT))
+
+    def create_window(self, *args, **kwargs):
+        Stub.calls += 1
+        self.items += 1
+        return self.items
+
+    def winfo_width(self):
+        return VIEW_WIDTH
+
+    def winfo_height(self):
+        return VIEW_HEIGHT
+
+    def canvasy(self, y):
+        return self.top + y
+
+    def yview(self, *args):
+        Stub.calls += 1
+        if not args:
+            if not self.region:
+                return 0.0, 1.0
+            return self.top / self.region, (self.top + VIEW_HEIGHT) / self.region
+        return None
+
+    def yview_moveto(self, fraction):
+        Stub.calls += 1
+        self.top = max(0, min(fraction * self.region, self.region - VIEW_HEIGHT))
+
+
+def stub_module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__getattr__ = lambda attribute: STUB
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def import_gui():
+    # Always stubbed, even where the toolkits are installed: no display needed
+    stub_module("customtkinter")
+    stub_module("tkinter", Canvas=StubCanvas)
+    pil = stub_module("PIL")
+    for name in ("Image", "ImageDraw", "ImageFont"):
+        setattr(pil, name, stub_module(f"PIL.{name}"))
+    import avatars
+    avatars.load_atlas = lambda directory=None: {name: STUB for name in avatars.AVATAR_MAP}
+    import GUI_client
+    return GUI_client
+
+
+def make_app(gui):
+    app = gui.ChatClientGUI(STUB)
+    app.finish_startup()
+    app.username = "me"
+    app.connected = True
+    return app
+
+
+WORDS = "hello hi yes no lunch meeting server client socket thread works broken ok thanks".split()
+
+
+def chat_line(rng, population):
+    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 30)))
+    return f"user{rng.randrange(population)}:{text}"
+
+
+def workloads(rng, lines, population):
+    avatars = ("Boy", "Girl", "Cat", "Robot", "Fox")
+    names = [f"user{i}" for i in range(population)]
+
+    chat = [chat_line(rng, population) for _ in range(lines)]
+
+    user_list = "LIST:" + ",".join(names)
+    presence = []
+    for _ in range(lines // 10):
+        if rng.random() < 0.5:
+            presence.append(user_list)
+        else:
+            presence.append(f"CMD:UPDATE_AVATAR:{rng.choice(names)}:{rng.choice(avatars)}")
+
+    snapshot = [[name, rng.choice(avatars)] for name in names]
+    mixed = ["CMD:PRESENCE_SNAPSHOT:0:" + str(snapshot).replace("'", '"')]
+    seq = 0
+    for _ in range(lines):
+        if rng.random() < 0.9:
+            mixed.append(chat_line(rng, population))
+            continue
+        seq += 1
+        name = rng.choice(names)
+        kind = rng.choice(("JOIN", "LEAVE", "AVATAR"))
+        if kind == "LEAVE":
+            mixed.append(f"CMD:PRESENCE:{seq}:LEAVE:{name}")
+        else:
+            mixed.append(f"CMD:PRESENCE:{seq}:{kind}:{name}:{rng.choice(avatars)}")
+
+    return [("chat", chat), ("presence", presence), ("mixed", mixed)]
+
+
+def run(gui, lines, per_line):
+    app = make_app(gui)
+    counts = {"drains": 0, "sidebar": 0, "layout": 0}
+
+    def counted(key, fn):
+        def wrapper(*args, **kwargs):
+            counts[key] += 1
+            return fn(*args, **kwargs)
+        return wrapper
+
+    # Marks look the methods up when they are made, so the wrappers are used
+    app.update_sidebar = counted("sidebar", app.update_sidebar)
+    app.transcript.layout = counted("layout", app.transcript.layout)
+    updates = app.updates
+    Stub.calls = 0
+
+    started = time.perf_counter()
+    next_tick = started + gui.TICK
+    for line in lines:
+        app.process_message(line)
+        if per_line:
+            updates.drain()
+            counts["drains"] += 1
+        elif time.perf_counter() >= next_tick:
+            updates.drain()
+            counts["drains"] += 1
+            next_tick = time.perf_counter() + gui.TICK
+    while len(updates):
+        updates.drain()
+        counts["drains"] += 1
+    elapsed = time.perf_counter() - started
+
+    counts["tk calls"] = Stub.calls
+    return elapsed, counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless GUI update pipeline benchmark")
+    parser.add_argument("--lines", type=int, default=100000, help="chat lines per workload")
+    parser.add_argument("--population", type=int, default=1000, help="users online")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    gui = import_gui()
+    rng = random.Random(args.seed)
+    for title, lines in workloads(rng, args.lines, args.population):
+        print(f"{title}: {len(lines):,} lines, {args.population} users")
+        for label, per_line in (("per line", True), ("ticked", False)):
+            elapsed, counts = run(gui, lines, per_line)
+            per_k = {key: value * 1000 / len(lines) for key, value in counts.items()}
+            print(
+                f"  {label:<9} {len(lines) / elapsed:>10,.0f} lines/s  per 1000 lines: "
+                f"drains {per_k['drains']:>7,.1f}  sidebar {per_k['sidebar']:>7,.1f}  "
+                f"layouts {per_k['layout']:>7,.1f}  tk calls {per_k['tk calls']:>10,.0f}"
+            )
@@ -0,0 +1,438 @@
+"""
+Load generator and latency benchmark for the chat servers.
+
+Opens many simulated clients from one asyncio process. They run the same
+protocol code as the real clients (ClientSession from chat_client.py):
+optional CMD:HELLO negotiation, the username, then a configurable mix of
+broadcasts, "to:<user> msg" private
+messages and CMD:AVATAR: changes. Every chat message carries the time it
+was sent ("LT|<ns>|"), so the receiving client can measure the delivery
+latency. Sender and receiver share one clock because they live in the same
+process.
+
+Reports connect rate, sent and delivered throughput, p50/p99/p999 delivery
+latency and, with --server-pid, the server's CPU and RSS (read from /proc,
+including worker processes). --json writes the same numbers as JSON, so
+server modes and releases can be compared.
+
+--protocol basic drives basic_client_server/server.py instead. That server
+only forwards private messages; other chat lines are just logged.
+
+The server limits every client to 20 messages per second (see
+ratelimit.py); start it with a higher --message-rate, or 0, for --rate
+above that.
+
+Run (server started separately):
+python serverUI.py --mode async
+python bench_load.py --clients 1000 --duration 20 --json results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from chat_client import MESSAGE, SEND, WELCOME, ClientSession
+from presence import FEATURE_PRESENCE
+
+MARKER = b"LT|"
+AVATARS = ("Boy", "Girl", "Cat", "Dog")
+DEFAULT_MIX = "broadcast=70,private=25,avatar=5"
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarize_ms(values_ns):
+    values = sorted(values_ns)
+    if not values:
+        return {"count": 0}
+    to_ms = 1e-6
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) * to_ms,
+        "p50": percentile(values, 0.50) * to_ms,
+        "p99": percentile(values, 0.99) * to_ms,
+        "p999": percentile(values, 0.999) * to_ms,
+        "max": values[-1] * to_ms,
+    }
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        op = op.strip()
+        if op not in ("broadcast", "private", "avatar", "idle"):
+            raise argparse.ArgumentTypeError(f"Unknown workload operation: {op}")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+class Stats:
+    def __init__(self):
+        self.measuring = False
+        self.since_ns = None        # only messages sent after this count
+        self.sent = {"broadcast": 0, "private": 0, "avatar": 0}
+        self.expected = 0
+        self.delivered = 0
+        self.latencies = []
+        self.connect_times = []
+        self.connect_failures = 0
+
+
+class SimClient(asyncio.Protocol):
+    def __init__(self, bench, name):
+        self.bench = bench
+        self.name = name
+        self.transport = None
+        self.session = ClientSession(
+            name,
+            (FEATURE_PRESENCE,) if bench.protocol == "gui" else (),
+            hello=not bench.args.legacy,
+            raw=bench.protocol == "basic"
+        )
+        self.replies = asyncio.Queue()   # how the login ended: (event kind, value)
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(self.session.start())
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.replies.put_nowait((None, None))
+
+    def data_received(self, data):
+        try:
+            events = self.session.feed(data)
+        except ValueError:
+            self.transport.abort()
+            return
+        for kind, value in events:
+            if kind == MESSAGE:
+                self.on_message(value[1])
+            elif kind == SEND:
+                self.transport.write(value)
+            else:
+                # Welcome, rejected, fallback to the old protocol, disconnect
+                self.replies.put_nowait((kind, value))
+
+    def on_message(self, payload):
+        stats = self.bench.stats
+        if not stats.measuring:
+            return
+
+        now = time.perf_counter_ns()
+        index = payload.find(MARKER)
+        while index >= 0:
+            end = payload.find(b"|", index + 3)
+            if end < 0:
+                break
+            try:
+                stamp = int(payload[index + 3:end])
+            except ValueError:
+                stamp = 0
+            if stamp >= stats.since_ns:
+                stats.latencies.append(now - stamp)
+                stats.delivered += 1
+            index = payload.find(MARKER, end)
+
+    async def wait_reply(self, timeout):
+        return await asyncio.wait_for(self.replies.get(), timeout)
+
+    def send(self, message):
+        if not self.closed:
+            self.transport.write(self.session.encode(message))
+
+
+class LoadBench:
+    def __init__(self, args):
+        self.args = args
+        self.protocol = args.protocol
+        self.stats = Stats()
+        self.clients = []
+        self.limit = asyncio.Semaphore(args.connect_concurrency)
+
+    async def login(self, index):
+        args = self.args
+        loop = asyncio.get_running_loop()
+        client = SimClient(self, f"{args.prefix}{index}")
+        started = time.perf_counter_ns()
+        try:
+            async with self.limit:
+                await loop.create_connection(lambda: client, args.host, args.port)
+                reply, _ = await client.wait_reply(args.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.stats.connect_failures += 1
+            if client.transport is not None:
+                client.transport.abort()
+            return
+
+        if reply != WELCOME:
+            self.stats.connect_failures += 1
+            client.transport.abort()
+            return
+
+        self.stats.connect_times.append(time.perf_counter_ns() - started)
+        self.clients.append(client)
+
+    async def ramp_up(self):
+        args = self.args
+        tasks = []
+        interval = 1 / args.connect_rate if args.connect_rate else 0
+        for index in range(args.clients):
+            tasks.append(asyncio.create_task(self.login(index)))
+            if interval:
+                await asyncio.sleep(interval)
+        await asyncio.gather(*tasks)
+
+    def message(self):
+        stamp = f"LT|{time.perf_counter_ns()}|"
+        return stamp + "x" * max(0, self.args.size - len(stamp))
+
+    async def drive(self, client, ops, weights, deadline):
+        loop = asyncio.get_running_loop()
+        stats = self.stats
+        interval = 1 / self.args.rate
+        # Spread the clients over the first interval instead of firing in lockstep
+        next_at = loop.time() + random.uniform(0, interval)
+
+        while next_at < deadline and not client.closed:
+            await asyncio.sleep(max(0, next_at - loop.time()))
+            next_at += interval
+
+            op = random.choices(ops, weights)[0]
+            if op == "broadcast":
+                client.send(self.message())
+                if stats.measuring:
+                    stats.sent["broadcast"] += 1
+                    if self.protocol == "gui":
+                        stats.expected += len(self.clients) - 1
+            elif op == "private":
+                target = random.choice(self.clients)
+                if target is client:
+                    continue
+                client.send(f"to:{target.name} {self.message()}")
+                if stats.measuring:
+                    stats.sent["private"] += 1
+                    stats.expected += 1
+            elif op == "avatar" and self.protocol == "gui":
+                client.send(f"CMD:AVATAR:{random.choice(AVATARS)}")
+                if stats.measuring:
+                    stats.sent["avatar"] += 1
+
+    async def run(self):
+        args = self.args
+        loop = asyncio.get_running_loop()
+        sampler = ServerSampler(args.server_pid) if args.server_pid else None
+
+        ramp_started = time.perf_counter()
+        await self.ramp_up()
+        ramp_time = time.perf_counter() - ramp_started
+
+        ops = list(args.mix)
+        weights = [args.mix[op] for op in ops]
+        deadline = loop.time() + args.warmup + args.duration
+        drivers = [
+            asyncio.create_task(self.drive(client, ops, weights, deadline))
+            for client in self.clients
+        ]
+
+        await asyncio.sleep(args.warmup)
+        if sampler:
+            sampler.start()
+        self.stats.since_ns = time.perf_counter_ns()
+        self.stats.measuring = True
+        measure_started = time.perf_counter()
+        sampling = asyncio.create_task(sampler.run()) if sampler else None
+
+        await asyncio.gather(*drivers)
+        measured = time.perf_counter() - measure_started
+        # Let in-flight messages arrive before the books are closed
+        await asyncio.sleep(args.drain)
+        self.stats.measuring = False
+
+        server = None
+        if sampler:
+            sampling.cancel()
+            server = sampler.finish()
+
+        for client in self.clients:
+            client.transport.close()
+
+        return self.report(ramp_time, measured, server)
+
+    def report(self, ramp_time, measured, server):
+        args = self.args
+        stats = self.stats
+        sent = sum(stats.sent.values())
+        return {
+            "label": args.label,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {
+                "protocol": args.protocol,
+                "host": args.host,
+                "port": args.port,
+                "framing": "legacy" if args.legacy else "negotiated",
+                "clients": args.clients,
+                "rate_per_client": args.rate,
+                "mix": args.mix,
+                "size": args.size,
+                "duration": args.duration,
+                "warmup": args.warmup,
+            },
+            "connect": {
+                "succeeded": len(stats.connect_times),
+                "failed": stats.connect_failures,
+                "per_second": len(stats.connect_times) / ramp_time if ramp_time else None,
+                "latency_ms": summarize_ms(stats.connect_times),
+            },
+            "throughput": {
+                "seconds": measured,
+                "sent": dict(stats.sent),
+                "sent_per_second": sent / measured,
+                "expected_deliveries": stats.expected,
+                "delivered": stats.delivered,
+                "delivered_per_second": stats.delivered / measured,
+            },
+            "latency_ms": summarize_ms(stats.latencies),
+            "server": server,
+        }
+
+
+class ServerSampler:
+    """CPU time and RSS of a server process and its children, from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.rss_peak = 0
+        self.cpu_started = None
+        self.wall_started = None
+
+    def pids(self):
+        family = {self.pid}
+        parents = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    pass
+        grew = True
+        while grew:
+            grew = False
+            for pid, parent in parents.items():
+                if parent in family and pid not in family:
+                    family.add(pid)
+                    grew = True
+        return sorted(family)
+
+    def sample(self):
+        cpu = 0
+        rss = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                cpu += int(fields[11]) + int(fields[12])    # utime + stime
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1])
+                            break
+            except (OSError, IndexError, ValueError):
+                pass
+        self.rss_peak = max(self.rss_peak, rss)
+        return cpu / self.clock_ticks, rss
+
+    def start(self):
+        self.cpu_started, _ = self.sample()
+        self.wall_started = time.perf_counter()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(0.5)
+            self.sample()
+
+    def finish(self):
+        cpu, rss = self.sample()
+        wall = time.perf_counter() - self.wall_started
+        return {
+            "pids": self.pids(),
+            "cpu_seconds": cpu - self.cpu_started,
+            "cpu_percent": (cpu - self.cpu_started) / wall * 100,
+            "rss_kb": rss,
+            "rss_peak_kb": self.rss_peak,
+        }
+
+
+def print_report(result):
+    connect = result["connect"]
+    throughput = result["throughput"]
+    latency = result["latency_ms"]
+    print(
+        f"connected {connect['succeeded']} clients ({connect['failed']} failed), "
+        f"{connect['per_second'] or 0:,.0f} logins/s"
+    )
+    print(
+        f"sent {throughput['sent_per_second']:,.0f} msg/s, delivered "
+        f"{throughput['delivered_per_second']:,.0f} msg/s "
+        f"({throughput['delivered']:,} of {throughput['expected_deliveries']:,} expected)"
+    )
+    if latency["count"]:
+        print(
+            f"latency ms: p50 {latency['p50']:.2f}  p99 {latency['p99']:.2f}  "
+            f"p999 {latency['p999']:.2f}  max {latency['max']:.2f}"
+        )
+    server = result["server"]
+    if server:
+        print(
+            f"server: {server['cpu_percent']:.0f}% CPU, RSS {server['rss_kb'] / 1024:.1f} MiB "
+            f"(peak {server['rss_peak_kb'] / 1024:.1f} MiB), pids {server['pids']}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--protocol",
+        choices=("gui", "basic"),
+        default="gui",
+        help="gui: serverUI.py, basic: basic_client_server/server.py"
+    )
+    parser.add_argument("--legacy", action="store_true", help="skip the CMD:HELLO framing handshake")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--connect-rate", type=float, default=0, help="new connections per second, 0 = no limit")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="logins in flight at once")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per client")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"default: {DEFAULT_MIX}")
+    parser.add_argument("--size", type=int, default=64, help="chat message size in bytes")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds of load before measuring")
+    parser.add_argument("--drain", type=float, default=1.0, help="seconds to wait for in-flight messages")
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for a login reply")
+    parser.add_argument("--prefix", default="load", help="username prefix")
+    parser.add_argument("--server-pid", type=int, help="sample CPU and RSS of this process and its children")
+    parser.add_argument("--label", default="", help="free text stored with the results, e.g. server mode")
+    parser.add_argument("--json", metavar="PATH", help="write the results as JSON ('-' for stdout)")
+    args = parser.parse_args()
+
+    result = asyncio.run(LoadBench(args).run())
+
+    if args.json == "-":
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(result, f, indent=2)
@@ -0,0 +1,169 @@
+"""
+Benchmark for TLS reconnects: full handshakes against resumed sessions.
+
+Generates a throwaway self-signed certificate, starts serverUI.py with it
+and lets --threads clients reconnect as fast as they can: TCP connect,
+TLS handshake, HELLO negotiation, login, wait for the welcome, close.
+Variants:
+
+- tcp: the same without TLS, for reference
+- full: every connection does a full handshake (certificate, key exchange)
+- resumed: every client offers the session ticket of its previous
+  connection, as a GUI client does when it reconnects
+
+Prints reconnects per second, p50/p99 reconnect time, the share of
+sessions the server resumed and the server's CPU per reconnect.
+Resumption skips the certificate signature, so it saves most with RSA
+keys (--key rsa); with P-256 keys the key exchange dominates. With
+--workers, resumed sessions hop between workers and only resume when a
+reconnect lands on the worker that issued the ticket.
+
+Run:
+python bench_tls.py --duration 5 --threads 8
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_load import ServerSampler, summarize_ms
+from framing import LEGACY, StreamDecoder, client_handshake, read_message
+from tls import TLSSocket, client_context, generate_self_signed
+
+HOST = "127.0.0.1"
+
+
+def start_server(args, cert=None, key=None):
+    command = [
+        sys.executable, "serverUI.py", "--mode", args.mode,
+        "--port", str(args.port), "--workers", str(args.workers)
+    ]
+    if cert:
+        command += ["--tls-cert", cert, "--tls-key", key]
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, args.port), timeout=1).close()
+            # Give the other workers a moment to bind as well
+            time.sleep(0.5 if args.workers > 1 else 0)
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("The server did not start")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def reconnect(port, name, context, session):
+    """One login round trip. Returns (session, resumed)."""
+    sock = socket.create_connection((HOST, port))
+    try:
+        resumed = False
+        if context is not None:
+            sock = TLSSocket(sock, context, server_side=False, server_hostname=HOST, session=session)
+            sock.do_handshake()
+            resumed = sock.session_reused
+
+        handshake = client_handshake(sock)
+        codec, _, decoder = handshake or (LEGACY, None, StreamDecoder())
+        sock.sendall(codec.encode(name))
+        message = read_message(sock, decoder)
+        if message is None or b"Welcome" not in message[1]:
+            raise RuntimeError(f"Login failed for {name}")
+        return (sock.session if context is not None else None), resumed
+    finally:
+        sock.close()
+
+
+def run_variant(args, context, resume):
+    deadline = time.perf_counter() + args.duration
+    times = []
+    resumed = [0]
+    errors = [0]
+    lock = threading.Lock()
+
+    def client(index):
+        session = None
+        local_times = []
+        local_resumed = 0
+        count = 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter_ns()
+            try:
+                new_session, reused = reconnect(
+                    args.port, f"tls{index}_{count}", context, session if resume else None
+                )
+            except (OSError, RuntimeError):
+                with lock:
+                    errors[0] += 1
+                continue
+            local_times.append(time.perf_counter_ns() - started)
+            local_resumed += reused
+            session = new_session
+            count += 1
+        with lock:
+            times.extend(local_times)
+            resumed[0] += local_resumed
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return times, resumed[0], errors[0], time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TLS full vs resumed handshake benchmark")
+    parser.add_argument("--mode", choices=("threaded", "async"), default="async")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=5650)
+    parser.add_argument("--key", choices=("rsa", "ec"), default="rsa", help="certificate key type")
+    parser.add_argument("--threads", type=int, default=8, help="concurrently reconnecting clients")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per variant")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory(prefix="chat-tls-") as directory:
+        cert = os.path.join(directory, "cert.pem")
+        key = os.path.join(directory, "key.pem")
+        generate_self_signed(cert, key, key_type=args.key)
+        context = client_context(cert)
+
+        print(f"{args.threads} clients, {args.mode} server, {args.workers} worker(s), {args.key} key")
+        for label, tls, resume in (("tcp", False, False), ("full", True, False), ("resumed", True, True)):
+            proc = start_server(args, cert, key) if tls else start_server(args)
+            try:
+                sampler = ServerSampler(proc.pid)
+                sampler.start()
+                times, resumed, errors, wall = run_variant(args, context if tls else None, resume)
+                server = sampler.finish()
+            finally:
+                stop_server(proc)
+
+            summary = summarize_ms(times)
+            count = summary["count"]
+            if not count:
+                print(f"  {label:<8} no successful reconnects ({errors} errors)")
+                continue
+            print(
+                f"  {label:<8} {count / wall:>8,.0f} reconnects/s  "
+                f"p50 {summary['p50']:>6.2f} ms  p99 {summary['p99']:>6.2f} ms  "
+                f"resumed {resumed / count:>6.1%}  "
+                f"server CPU {server['cpu_seconds'] / count * 1e6:>7.0f} us/reconnect"
+                + (f"  ({errors} errors)" if errors else "")
+            )
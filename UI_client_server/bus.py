@@ -0,0 +1,287 @@
+"""
+Local message bus between serverUI worker processes.
+
+With --workers N the parent process runs a BusHub on a Unix socket and
+starts N workers that share the chat port through SO_REUSEPORT. Every
+worker connects a BusClient to the hub, so users on different workers see
+one chat:
+
+- claim / release: the hub owns the cluster-wide username table, so a
+  name can only be logged in once no matter which worker accepted it
+- presence: joins, leaves and avatar changes, relayed to the other
+  workers, which keep remote users in their registry
+- broadcast: chat lines, relayed to the other workers
+- private: routed only to the worker that owns the target user, or back
+  as not_found (with the message, for the sender's worker to keep in the
+  target's mailbox) if they are offline
+- room, rooms, room_message: room memberships and room chat lines,
+  relayed to the other workers (rooms_request asks them for theirs)
+- shutdown: the kill command stops every worker
+
+Messages are small JSON objects sent as length-prefixed frames.
+"""
+import concurrent.futures
+import itertools
+import json
+import socket
+import threading
+
+from framing import StreamDecoder, encode_frame
+from registry import name_key
+
+CLAIM_TIMEOUT = 5.0     # seconds a login waits for the hub to answer
+
+
+def encode(message):
+    return encode_frame(json.dumps(message, separators=(",", ":")).encode())
+
+
+class BusPeer:
+    """One framed JSON connection, safe to send on from several threads."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = StreamDecoder(framed=True)
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        data = encode(message)
+        with self.lock:
+            self.sock.sendall(data)
+
+    def messages(self):
+        """Yield decoded messages until the other side goes away."""
+        while self.decoder.recv_into(self.sock):
+            for _, payload in self.decoder.messages():
+                yield json.loads(payload)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class Claim:
+    __slots__ = ("peer", "name", "avatar", "joined")
+
+    def __init__(self, peer, name, avatar):
+        self.peer = peer
+        self.name = name
+        self.avatar = avatar
+        self.joined = False
+
+
+class BusHub:
+    """
+    Runs in the parent process. Relays events between workers and owns
+    the name table; when a worker dies its users are announced as gone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.workers = {}   # BusPeer -> worker id
+        self.claims = {}    # name key -> Claim
+        self.server = None
+
+    def start(self):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.serve, args=(BusPeer(sock),), daemon=True).start()
+
+    def serve(self, peer):
+        try:
+            for message in peer.messages():
+                self.dispatch(peer, message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.drop(peer)
+            peer.close()
+
+    def dispatch(self, peer, message):
+        op = message.get("op")
+
+        if op == "hello":
+            with self.lock:
+                self.workers[peer] = message["node"]
+                users = [
+                    [claim.name, claim.avatar, self.workers.get(claim.peer)]
+                    for claim in self.claims.values()
+                    if claim.joined and claim.peer is not peer
+                ]
+                self.reply(peer, {"op": "snapshot", "users": users})
+
+        elif op == "claim":
+            key = name_key(message["name"])
+            with self.lock:
+                ok = key not in self.claims
+                if ok:
+                    self.claims[key] = Claim(peer, message["name"], message.get("avatar"))
+            self.reply(peer, {"op": "claimed", "id": message["id"], "ok": ok})
+
+        elif op == "release":
+            key = name_key(message["name"])
+            with self.lock:
+                claim = self.claims.get(key)
+                if claim is not None and claim.peer is peer:
+                    del self.claims[key]
+
+        elif op == "presence":
+            key = name_key(message["name"])
+            with self.lock:
+                claim = self.claims.get(key)
+                if claim is not None and claim.peer is peer:
+                    if message["kind"] == "LEAVE":
+                        del self.claims[key]
+                    else:
+                        claim.joined = True
+                        claim.avatar = message.get("avatar")
+                message["node"] = self.workers.get(peer)
+            self.relay(peer, message)
+
+        elif op in ("broadcast", "shutdown", "room", "rooms", "rooms_request", "room_message", "file"):
+            self.relay(peer, message)
+
+        elif op in ("private", "not_found"):
+            # Private messages go to the target's worker, failures back to the sender's
+            owner_name = message["target"] if op == "private" else message["sender"]
+            claim = self.claims.get(name_key(owner_name))
+            if claim is not None and claim.joined:
+                self.reply(claim.peer, message)
+            elif op == "private":
+                self.reply(peer, {
+                    "op": "not_found",
+                    "sender": message["sender"],
+                    "target": message["target"],
+                    "message": message["message"],
+                })
+
+    def relay(self, origin, message):
+        with self.lock:
+            targets = [peer for peer in self.workers if peer is not origin]
+        data = encode(message)
+        for peer in targets:
+            try:
+                with peer.lock:
+                    peer.sock.sendall(data)
+            except OSError:
+                pass
+
+    def reply(self, peer, message):
+        try:
+            peer.send(message)
+        except OSError:
+            pass
+
+    def drop(self, peer):
+        with self.lock:
+            node = self.workers.pop(peer, None)
+            gone = [key for key, claim in self.claims.items() if claim.peer is peer]
+            claims = [self.claims.pop(key) for key in gone]
+
+        for claim in claims:
+            if claim.joined:
+                self.relay(peer, {"op": "presence", "kind": "LEAVE", "name": claim.name, "node": node})
+
+
+def resolve(future, result):
+    """Set a claim's result; False if the claim was cancelled already."""
+    try:
+        future.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        return False
+    return True
+
+
+class BusClient:
+    """
+    A worker's connection to the hub. handlers maps an op ("presence",
+    "broadcast", "private", "not_found", "snapshot", "shutdown", and the
+    room ops) to a
+    callable that gets the message dict; they run on the bus reader
+    thread. on_lost is called once if the hub goes away.
+    """
+
+    def __init__(self, path, node, handlers, on_lost=None):
+        self.node = node
+        self.handlers = handlers
+        self.on_lost = on_lost
+        self.lock = threading.Lock()
+        self.pending = {}   # claim id -> (Future, name)
+        self.ids = itertools.count(1)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self.peer = BusPeer(sock)
+        self.publish("hello", node=node)
+        threading.Thread(target=self.reader_loop, daemon=True).start()
+
+    def claim(self, name, avatar="Boy"):
+        """
+        Reserve a username cluster-wide. Returns a Future that resolves to
+        a bool. A caller that stops waiting cancels it; if the hub grants
+        the name after that, it is released again.
+        """
+        future = concurrent.futures.Future()
+        claim_id = next(self.ids)
+        with self.lock:
+            self.pending[claim_id] = (future, name)
+        if not self.publish("claim", id=claim_id, name=name, avatar=avatar):
+            with self.lock:
+                self.pending.pop(claim_id, None)
+            future.set_result(False)
+        return future
+
+    def release(self, name):
+        self.publish("release", name=name)
+
+    def publish(self, op, **fields):
+        fields["op"] = op
+        try:
+            self.peer.send(fields)
+            return True
+        except OSError:
+            return False
+
+    def reader_loop(self):
+        try:
+            for message in self.peer.messages():
+                op = message.get("op")
+                if op == "claimed":
+                    with self.lock:
+                        future, name = self.pending.pop(message["id"], (None, None))
+                    if future is not None and not resolve(future, message["ok"]) and message["ok"]:
+                        # Nobody is waiting for this name any more
+                        self.release(name)
+                    continue
+
+                handler = self.handlers.get(op)
+                if handler is not None:
+                    try:
+                        handler(message)
+                    except Exception:
+                        pass
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for future, _ in pending.values():
+                resolve(future, False)
+            if self.on_lost is not None:
+                self.on_lost()
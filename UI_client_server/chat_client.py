@@ -0,0 +1,422 @@
+"""
+Chat client core, shared by the GUI client, the CLI client
+(basic_client_server/client.py) and the load generator (bench_load.py).
+
+ClientSession is the client side of the protocol without any I/O: it
+produces the bytes to send and turns received bytes into events, through
+the HELLO negotiation, the login and the chat that follows. The load
+generator drives it from asyncio.
+
+ChatClient runs a ClientSession over a socket, on a thread of its own, so
+the caller's thread (e.g. the Tk loop) never blocks on the network. It
+reports through two callbacks, both called on its thread:
+
+- on_status(status, detail):
+    CONNECTING      detail: the number of the attempt, from 0
+    CONNECTED       logged in; detail: the server's welcome line
+    RECONNECTING    the connection was lost; detail: seconds until the next attempt
+    FAILED          the first login did not work (or the connection was
+                    lost with reconnect off); detail: why
+    CLOSED          the server ended the session (CMD:DISCONNECT); detail: its reason
+    STOPPED         stop() was called
+- on_message(text): every text message from the server after the login,
+  except heartbeat pings, which are answered here
+
+Connecting, the handshake and the login each have a timeout. Once logged
+in, a lost connection is retried with exponential backoff and jitter (half
+of min(RECONNECT_MAX, RECONNECT_BASE * 2^attempt) plus a random part of the
+other half), so clients of a restarted server do not all come back at the
+same moment. Every new connection logs in with the same username and
+restores the avatar. A session the server closed on purpose is not retried.
+"""
+import random
+import socket
+import threading
+
+from framing import (
+    ERROR_PREFIX,
+    FRAME_TEXT,
+    FRAMED,
+    LEGACY,
+    PROTOCOL_VERSION,
+    StreamDecoder,
+    build_hello,
+    encode_frame,
+    parse_hello
+)
+from compression import select_codec
+from heartbeat import PING, PONG
+
+CONNECT_TIMEOUT = 10.0      # seconds for connecting, the handshake and the login each
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30.0
+
+DISCONNECT_PREFIX = "CMD:DISCONNECT:"
+AVATAR_PREFIX = "CMD:AVATAR:"
+
+# ChatClient statuses
+CONNECTING = "connecting"
+CONNECTED = "connected"
+RECONNECTING = "reconnecting"
+FAILED = "failed"
+CLOSED = "closed"
+STOPPED = "stopped"
+
+# ClientSession events: (kind, value)
+SEND = "send"           # bytes to send
+WELCOME = "welcome"     # logged in; the welcome line
+REJECTED = "rejected"   # login or connection refused; the server's reply
+FALLBACK = "fallback"   # the server does not speak HELLO: reconnect without it
+MESSAGE = "message"     # (frame type, payload) after the login
+DISCONNECT = "disconnect"   # the server ends the session; its reason
+
+
+class RawCodec:
+    """basic_client_server without framing: one send() per message, no delimiter."""
+    name = "raw"
+    framed = False
+
+    def encode(self, text):
+        return text.encode()
+
+    def decode(self, frame_type, payload):
+        return frame_type, payload
+
+
+RAW = RawCodec()
+
+
+class ClientSession:
+    """
+    One connection's worth of protocol state. hello=False skips the
+    handshake (old servers); raw=True speaks the basic server's legacy
+    protocol, where every recv() is one message.
+    """
+
+    def __init__(self, username, features=(), hello=True, raw=False):
+        self.username = username
+        self.features = tuple(features)
+        self.codec = RAW if raw else LEGACY
+        self.decoder = None if raw else StreamDecoder()
+        self.server_features = set()
+        self.logged_in = False
+        self.negotiating = hello
+
+    def start(self):
+        """The bytes that open the connection: a HELLO, or the username right away."""
+        if self.negotiating:
+            return f"{build_hello(PROTOCOL_VERSION, self.features)}\n".encode()
+        return self.codec.encode(self.username)
+
+    def encode(self, text):
+        return self.codec.encode(text)
+
+    def encode_frame(self, payload, frame_type):
+        """A non-text frame (e.g. a file chunk); needs the framed protocol."""
+        if not self.codec.framed:
+            raise ConnectionError("The server does not support binary frames")
+        return encode_frame(payload, frame_type)
+
+    def feed(self, data):
+        """Process received bytes; returns the resulting events."""
+        events = []
+        if self.decoder is None:
+            self.handle(FRAME_TEXT, bytes(data), events)
+            return events
+
+        self.decoder.feed(data)
+        for frame_type, payload in self.decoder.messages():
+            self.handle(frame_type, payload, events)
+        return events
+
+    def handle(self, frame_type, payload, events):
+        if self.logged_in:
+            frame_type, payload = self.codec.decode(frame_type, payload)
+            if frame_type == FRAME_TEXT:
+                if payload == PING.encode():
+                    events.append((SEND, self.codec.encode(PONG)))
+                    return
+                if payload.startswith(DISCONNECT_PREFIX.encode()):
+                    reason = payload[len(DISCONNECT_PREFIX):].decode(errors="replace")
+                    events.append((DISCONNECT, reason))
+                    return
+            events.append((MESSAGE, (frame_type, payload)))
+            return
+
+        line = payload.decode(errors="replace").strip()
+        if line.startswith(ERROR_PREFIX):
+            # CMD:ERROR:<code>:<text>
+            events.append((REJECTED, line[len(ERROR_PREFIX):].partition(":")[2]))
+            return
+
+        if self.negotiating:
+            self.negotiating = False
+            hello = parse_hello(line)
+            if hello is None:
+                # It took the HELLO for a username
+                events.append((FALLBACK, line))
+                return
+            version, agreed = hello
+            if version >= PROTOCOL_VERSION:
+                # Everything after the HELLO reply is framed
+                if self.decoder is None:
+                    self.decoder = StreamDecoder()
+                self.decoder.framed = True
+                self.codec = select_codec(FRAMED, agreed)
+                self.server_features = agreed
+            events.append((SEND, self.codec.encode(self.username)))
+            return
+
+        if "Welcome" in line:
+            self.logged_in = True
+            events.append((WELCOME, line))
+        else:
+            events.append((REJECTED, line))
+
+
+def reconnect_delay(attempt, base=RECONNECT_BASE, cap=RECONNECT_MAX):
+    ceiling = min(cap, base * 2 ** attempt)
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+def open_connection(host, port, timeout=CONNECT_TIMEOUT, tls_context=None, tls_session=None):
+    """
+    A connected socket, with TLS if a context is given (resuming
+    tls_session when the server allows); times out after timeout seconds.
+    """
+    sock = socket.create_connection((host, port), timeout=timeout)
+    if tls_context is None:
+        return sock
+
+    from tls import TLSSocket
+    tls = TLSSocket(
+        sock,
+        tls_context,
+        server_side=False,
+        server_hostname=host,
+        session=tls_session
+    )
+    try:
+        tls.do_handshake()
+    except Exception:
+        sock.close()
+        raise
+    return tls
+
+
+class LoginRejected(Exception):
+    pass
+
+
+class SessionClosed(Exception):
+    pass
+
+
+class ChatClient:
+    def __init__(
+        self,
+        host,
+        port,
+        username,
+        avatar=None,
+        features=(),
+        on_message=None,
+        on_status=None,
+        tls_context=None,
+        tls_session=None,
+        raw=False,
+        reconnect=True,
+        timeout=CONNECT_TIMEOUT
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.avatar = avatar
+        self.features = tuple(features)
+        self.on_message = on_message or (lambda text: None)
+        self.on_status = on_status or (lambda status, detail: None)
+        self.tls_context = tls_context
+        self.tls_session = tls_session
+        self.raw = raw
+        self.reconnect = reconnect
+        self.timeout = timeout
+
+        self.sock = None
+        self.session = None
+        self.send_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def connected(self):
+        return self.session is not None and self.session.logged_in
+
+    @property
+    def server_features(self):
+        return self.session.server_features if self.session is not None else set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Close the connection and end the client thread (without waiting for it)."""
+        self.stopping.set()
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def send(self, text):
+        """Send one chat line or command; raises ConnectionError while not logged in."""
+        self.send_bytes(lambda session: session.encode(text))
+
+    def send_frame(self, payload, frame_type):
+        self.send_bytes(lambda session: session.encode_frame(payload, frame_type))
+
+    def send_bytes(self, encode):
+        with self.send_lock:
+            sock, session = self.sock, self.session
+            if sock is None or session is None or not session.logged_in:
+                raise ConnectionError("Not connected")
+            sock.sendall(encode(session))
+
+    def set_avatar(self, avatar):
+        """Change the avatar now and after every reconnect."""
+        self.avatar = avatar
+        try:
+            self.send(f"{AVATAR_PREFIX}{avatar}")
+        except OSError:
+            pass
+
+    def open_socket(self):
+        """A new connection to the same server, e.g. for a file download."""
+        return open_connection(self.host, self.port, self.timeout, self.tls_context, self.tls_session)
+
+    def run(self):
+        attempt = 0
+        logged_in_once = False
+        while not self.stopping.is_set():
+            self.on_status(CONNECTING, attempt)
+            try:
+                welcome, pending = self.login()
+            except (OSError, ValueError, LoginRejected) as e:
+                self.close_socket()
+                if self.stopping.is_set():
+                    break
+                if not logged_in_once or not self.reconnect:
+                    self.on_status(FAILED, str(e) or type(e).__name__)
+                    return
+            else:
+                logged_in_once = True
+                attempt = 0
+                self.on_status(CONNECTED, welcome)
+                try:
+                    self.listen(pending)
+                except SessionClosed as e:
+                    self.close_socket()
+                    self.on_status(CLOSED, str(e))
+                    return
+                self.close_socket()
+                if self.stopping.is_set():
+                    break
+                if not self.reconnect:
+                    self.on_status(FAILED, "Connection lost")
+                    return
+
+            delay = reconnect_delay(attempt)
+            attempt += 1
+            self.on_status(RECONNECTING, delay)
+            if self.stopping.wait(delay):
+                break
+
+        self.on_status(STOPPED, None)
+
+    def login(self):
+        """
+        Connect, negotiate and log in. Returns the welcome line and the
+        events that arrived with it; raises OSError, ValueError (bad data)
+        or LoginRejected.
+        """
+        session = ClientSession(self.username, self.features, raw=self.raw)
+        while True:
+            sock = open_connection(self.host, self.port, self.timeout, self.tls_context, self.tls_session)
+            self.sock = sock
+            if self.stopping.is_set():
+                raise ConnectionError("Stopped")
+            sock.sendall(session.start())
+
+            events = self.exchange(sock, session)
+            if events is not None:
+                break
+            # No HELLO support: a fresh connection in the old protocol
+            sock.close()
+            session = ClientSession(self.username, raw=self.raw, hello=False)
+
+        sock.settimeout(None)
+        if self.tls_context is not None:
+            self.tls_session = sock.session
+        with self.send_lock:
+            self.session = session
+        if self.avatar and not self.raw:
+            self.send(f"{AVATAR_PREFIX}{self.avatar}")
+        return events[0][1], events[1:]
+
+    def exchange(self, sock, session):
+        """Run the handshake and login; the events from the welcome on, or None to fall back."""
+        while True:
+            data = sock.recv(64 * 1024)
+            if not data:
+                raise ConnectionError("The server closed the connection")
+            events = session.feed(data)
+            for index, (kind, value) in enumerate(events):
+                if kind == SEND:
+                    sock.sendall(value)
+                elif kind == FALLBACK:
+                    return None
+                elif kind == REJECTED:
+                    raise LoginRejected(value)
+                elif kind == WELCOME:
+                    return events[index:]
+
+    def listen(self, events):
+        sock, session = self.sock, self.session
+        while True:
+            for kind, value in events:
+                if kind == MESSAGE:
+                    frame_type, payload = value
+                    if frame_type == FRAME_TEXT:
+                        self.on_message(payload.decode(errors="replace"))
+                elif kind == SEND:
+                    try:
+                        with self.send_lock:
+                            sock.sendall(value)
+                    except OSError:
+                        return
+                elif kind == DISCONNECT:
+                    raise SessionClosed(value)
+
+            try:
+                data = sock.recv(64 * 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            try:
+                events = session.feed(data)
+            except ValueError:
+                # Garbage on the wire: start over on a new connection
+                return
+
+    def close_socket(self):
+        with self.send_lock:
+            sock, self.sock = self.sock, None
+            self.session = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
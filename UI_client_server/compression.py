@@ -0,0 +1,132 @@
+"""
+Negotiated per-message compression.
+
+Clients that offer the "deflate" feature in the HELLO handshake may get
+FRAME_DEFLATE frames: the UTF-8 text compressed as a raw deflate stream
+with a preset dictionary of strings the chat protocol sends all the time
+(presence commands, system notices, avatar names, history JSON). Both
+directions may compress; the receiver inflates before handling the text.
+
+Every message is compressed on its own, so a broadcast is still encoded
+once and the same bytes go to every recipient's queue. A streaming
+context per connection would squeeze out a little more on long
+conversations, but it costs one compression per recipient (see
+bench_compression.py). Messages under COMPRESS_MIN bytes, and anything
+that does not get smaller, go out as plain FRAME_TEXT.
+
+The dictionary is part of the wire format: changing it needs a new
+feature name.
+"""
+import zlib
+
+from framing import (
+    FRAME_DEFLATE,
+    FRAME_TEXT,
+    HEADER,
+    MAX_FRAME_SIZE,
+    SPLIT_FRAME_SIZE,
+    FramedCodec,
+    FramingError
+)
+
+FEATURE_DEFLATE = "deflate"
+
+COMPRESS_MIN = 128      # bytes; smaller messages are not worth the CPU
+
+# Chat messages are short: a 4 KiB window and small hash tables make
+# setting up each compressor several times cheaper than zlib's defaults,
+# for about the same ratio (bench_compression.py)
+COMPRESS_LEVEL = 1
+WINDOW_BITS = 12
+MEM_LEVEL = 4
+
+AVATARS = (
+    "Boy", "Girl", "Robot", "Alien", "Fox", "Tiger", "Dog", "Unicorn",
+    "Soccer", "Basket", "Pizza", "Guitar", "Rocket", "Star", "Ghost", "Cat"
+)
+
+# zlib finds matches in the dictionary's last bytes cheapest, so the most
+# frequent strings come last
+DICTIONARY = " ".join((
+    "the and you that for are with this have what not but can was just will "
+    "all from about your know like get out when how there one time think "
+    "good yes now see back today going really thanks well right here please "
+    "hello hi hey ok okay lol",
+    " ".join(AVATARS),
+    '{"conversation":"all","messages":[[',
+    '"more":true} "more":false}',
+    "CMD:ROOMS:[[ CMD:ROOM_JOINED: CMD:ROOM_LEFT: CMD:ROOM_MSG:",
+    "CMD:HISTORY_PAGE:",
+    "CMD:UPDATE_AVATAR:",
+    "CMD:PRESENCE_SNAPSHOT:",
+    "CMD:PRESENCE:",
+    ":JOIN: :LEAVE: :AVATAR:",
+    " is offline, the message will be delivered at their next login.",
+    " not found. left. joined!",
+    "[System] ",
+    " (Private)",
+    "LIST:",
+)).encode()
+
+
+def compress(payload):
+    compressor = zlib.compressobj(
+        COMPRESS_LEVEL, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL, zdict=DICTIONARY
+    )
+    return compressor.compress(payload) + compressor.flush()
+
+
+def inflate(payload, limit=MAX_FRAME_SIZE):
+    """Decompress one FRAME_DEFLATE payload, refusing to grow past limit."""
+    # The largest window, so peers may pick any window size
+    inflater = zlib.decompressobj(-15, zdict=DICTIONARY)
+    try:
+        data = inflater.decompress(payload, limit)
+    except zlib.error as e:
+        raise FramingError(f"Bad compressed frame: {e}") from None
+    if inflater.unconsumed_tail:
+        raise FramingError(f"Compressed frame inflates past {limit} bytes")
+    return data
+
+
+class DeflateCodec(FramedCodec):
+    name = "deflate"
+
+    def __init__(self, threshold=COMPRESS_MIN):
+        self.threshold = threshold
+
+    def _frame(self, text, split):
+        payload = text.encode()
+        frame_type = FRAME_TEXT
+        if len(payload) >= self.threshold:
+            packed = compress(payload)
+            if len(packed) < len(payload):
+                payload, frame_type = packed, FRAME_DEFLATE
+
+        if len(payload) > MAX_FRAME_SIZE:
+            raise FramingError(f"Frame too large: {len(payload)} bytes")
+        header = HEADER.pack(len(payload), frame_type)
+        if split and len(payload) >= SPLIT_FRAME_SIZE:
+            return header, payload
+        return header + payload
+
+    def encode(self, text):
+        return self._frame(text, split=False)
+
+    def encode_shared(self, text):
+        return self._frame(text, split=True)
+
+    def decode(self, frame_type, payload):
+        if frame_type == FRAME_DEFLATE:
+            return FRAME_TEXT, inflate(payload)
+        return frame_type, payload
+
+
+DEFLATE = DeflateCodec()
+
+
+def select_codec(codec, features):
+    """The codec to use once the handshake agreed on features."""
+    if codec.framed and FEATURE_DEFLATE in features:
+        return DEFLATE
+    return codec
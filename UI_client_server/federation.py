@@ -0,0 +1,386 @@
+"""
+Server-to-server federation.
+
+Several serverUI nodes (usually on different machines) link up over TCP
+into one chat namespace. Every node dials the peers it was given and keeps
+one link per peer, reconnecting with backoff when a link drops. The links
+carry the same JSON frames as the worker bus (bus.py), and FederationNode
+offers the same claim()/release()/publish() interface as BusClient, so
+serverUI treats both the same way.
+
+Routing uses a user -> node directory instead of flooding:
+
+- Each username has a home node, picked by rendezvous hashing over the
+  live nodes. The home node keeps the authoritative owner entry, so a
+  login only asks one node whether the name is free.
+- Presence events tell every node which node a user lives on; private
+  messages then go straight to the owner's node, one hop.
+- Broadcasts are sent once to every peer, which only fans them out to
+  its own clients.
+
+Private messages for users who are offline everywhere are kept in the
+sender's node's mailbox, so they are delivered when the user next logs in
+on that node.
+
+Shared files stay on the node that stored them; nodes have no common file
+store. A node refuses to share a file with everyone, with a room that has
+members on other nodes or with a user on another node, instead of telling
+only its own users about it.
+
+When a node goes away its peers announce its users as gone, and the
+directory entries it was home for are re-created on their new home by
+the owning nodes. While links are coming up or going down, two nodes may
+briefly disagree on a name's home.
+"""
+import concurrent.futures
+import hashlib
+import itertools
+import random
+import socket
+import threading
+import time
+
+from bus import BusPeer, encode, resolve
+from registry import name_key
+
+RECONNECT_MIN = 0.5     # seconds before the first redial
+RECONNECT_MAX = 10.0    # backoff cap for an unreachable peer
+DIAL_TIMEOUT = 5.0
+
+# Room memberships and room chat lines go to every peer, like broadcasts
+ROOM_OPS = ("room", "rooms", "rooms_request", "room_message")
+
+
+def home_node(key, nodes):
+    """Rendezvous hashing: every node picks the same home from the same members."""
+    return max(
+        nodes,
+        key=lambda node: hashlib.blake2b(f"{node}\0{key}".encode(), digest_size=8).digest()
+    )
+
+
+def parse_address(text, default_host="127.0.0.1"):
+    host, _, port = text.strip().rpartition(":")
+    return host or default_host, int(port)
+
+
+class Link:
+    __slots__ = ("peer", "node", "dialer")
+
+    def __init__(self, peer, node, dialer):
+        self.peer = peer
+        self.node = node
+        self.dialer = dialer
+
+    def send(self, message):
+        try:
+            self.peer.send(message)
+            return True
+        except OSError:
+            return False
+
+
+class FederationNode:
+    """
+    This node's side of the federation. handlers works like BusClient's:
+    "presence", "snapshot", "broadcast", "private", "not_found" and the
+    room ops are called on link reader threads with the message dict.
+    """
+
+    def __init__(self, name, host, port, peers, handlers):
+        self.name = name
+        self.handlers = handlers
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.links = {}         # node name -> Link
+        self.users = {}         # name key -> [name, avatar, node] for everyone online
+        self.directory = {}     # name key -> owner node, for names homed here
+        self.pending = {}       # claim id -> (Future, home node, name)
+        self.ids = itertools.count(1)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen()
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+        for address in peers:
+            threading.Thread(target=self.dial_loop, args=(address,), daemon=True).start()
+
+    # ---------------------------------------------------------------
+    # Links
+    # ---------------------------------------------------------------
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.run_link, args=(sock, False), daemon=True).start()
+
+    def dial_loop(self, address):
+        delay = RECONNECT_MIN
+        while True:
+            node = None
+            try:
+                sock = socket.create_connection(address, timeout=DIAL_TIMEOUT)
+                sock.settimeout(None)
+                node = self.run_link(sock, True)
+            except OSError:
+                pass
+
+            if node is not None:
+                delay = RECONNECT_MIN
+                # The peer's own dial may have won; redial only once that link is gone
+                with self.changed:
+                    while node in self.links:
+                        self.changed.wait()
+
+            # Jitter keeps restarted peers from being hammered in lockstep
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def run_link(self, sock, dialed):
+        """Serve one link until it drops. Returns the peer's node name."""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        peer = BusPeer(sock)
+        node = None
+        try:
+            peer.send({"op": "hello", "node": self.name})
+            messages = peer.messages()
+            hello = next(messages, None)
+            if not hello or hello.get("op") != "hello" or hello.get("node") == self.name:
+                return None
+            node = hello["node"]
+
+            link = self.attach(peer, node, self.name if dialed else node)
+            if link is not None:
+                try:
+                    for message in messages:
+                        self.dispatch(link, message)
+                finally:
+                    self.detach(link)
+        except (OSError, ValueError):
+            pass
+        finally:
+            peer.close()
+        return node
+
+    def attach(self, peer, node, dialer):
+        with self.lock:
+            current = self.links.get(node)
+            if current is not None:
+                # Both sides dialed: keep the link dialed by the smaller name
+                if min(current.dialer, dialer) != dialer:
+                    return None
+                current.peer.close()
+
+            link = self.links[node] = Link(peer, node, dialer)
+            local = [
+                entry for entry in self.users.values() if entry[2] == self.name
+            ]
+            self.changed.notify_all()
+
+        print(f"[FEDERATION] linked to {node}", flush=True)
+        link.send({"op": "snapshot", "users": local})
+        self.rehome()
+        return link
+
+    def detach(self, link):
+        with self.lock:
+            if self.links.get(link.node) is not link:
+                # Replaced by a duplicate link that won
+                return
+            del self.links[link.node]
+            gone = [key for key, entry in self.users.items() if entry[2] == link.node]
+            entries = [self.users.pop(key) for key in gone]
+            failed = [cid for cid, (_, home, _) in self.pending.items() if home == link.node]
+            futures = [self.pending.pop(cid)[0] for cid in failed]
+            self.changed.notify_all()
+
+        print(f"[FEDERATION] lost {link.node}, {len(entries)} users gone", flush=True)
+        for future in futures:
+            resolve(future, False)
+        for name, avatar, node in entries:
+            self.deliver("presence", {"kind": "LEAVE", "name": name, "avatar": avatar, "node": node})
+        self.rehome()
+
+    def members(self):
+        with self.lock:
+            return [self.name] + list(self.links)
+
+    def rehome(self):
+        """After a membership change, move directory entries to their new home."""
+        members = self.members()
+        with self.lock:
+            for key in list(self.directory):
+                if home_node(key, members) != self.name:
+                    del self.directory[key]
+            local = [
+                (key, entry[0]) for key, entry in self.users.items() if entry[2] == self.name
+            ]
+
+        for key, name in local:
+            home = home_node(key, members)
+            if home == self.name:
+                with self.lock:
+                    self.directory[key] = self.name
+            else:
+                self.send_to(home, {"op": "assert", "name": name})
+
+    def send_to(self, node, message):
+        link = self.links.get(node)
+        return link is not None and link.send(message)
+
+    # ---------------------------------------------------------------
+    # Incoming
+    # ---------------------------------------------------------------
+
+    def dispatch(self, link, message):
+        op = message.get("op")
+
+        if op == "claim":
+            ok = self.reserve(name_key(message["name"]), link.node)
+            link.send({"op": "claimed", "id": message["id"], "ok": ok})
+
+        elif op == "claimed":
+            with self.lock:
+                future, _, name = self.pending.pop(message["id"], (None, None, None))
+            if future is not None and not resolve(future, message["ok"]) and message["ok"]:
+                # The login gave up waiting: the name must not stay reserved
+                link.send({"op": "release", "name": name})
+
+        elif op == "assert":
+            with self.lock:
+                self.directory[name_key(message["name"])] = link.node
+
+        elif op == "release":
+            key = name_key(message["name"])
+            with self.lock:
+                if self.directory.get(key) == link.node:
+                    del self.directory[key]
+
+        elif op == "presence":
+            message["node"] = link.node
+            self.track(message["kind"], message["name"], message.get("avatar"), link.node)
+            self.deliver("presence", message)
+
+        elif op == "snapshot":
+            users = [[name, avatar, link.node] for name, avatar, _ in message["users"]]
+            with self.lock:
+                for entry in users:
+                    self.users[name_key(entry[0])] = entry
+            self.deliver("snapshot", {"users": users})
+
+        elif op in ("broadcast", "private", "not_found") or op in ROOM_OPS:
+            self.deliver(op, message)
+
+    def deliver(self, op, message):
+        handler = self.handlers.get(op)
+        if handler is not None:
+            try:
+                handler(message)
+            except Exception:
+                pass
+
+    def reserve(self, key, node):
+        """Directory check on a name's home node."""
+        with self.lock:
+            owner = self.directory.get(key)
+            if owner is not None and owner != node and (owner == self.name or owner in self.links):
+                return False
+            entry = self.users.get(key)
+            if entry is not None and entry[2] != node:
+                return False
+            self.directory[key] = node
+            return True
+
+    def track(self, kind, name, avatar, node):
+        key = name_key(name)
+        with self.lock:
+            if kind == "LEAVE":
+                entry = self.users.get(key)
+                if entry is not None and entry[2] == node:
+                    del self.users[key]
+            else:
+                self.users[key] = [name, avatar, node]
+
+    # ---------------------------------------------------------------
+    # Outgoing (same interface as bus.BusClient)
+    # ---------------------------------------------------------------
+
+    def claim(self, name, avatar="Boy"):
+        """
+        Ask the name's home node to reserve it. Returns a Future of bool;
+        cancelling it releases a grant that arrives afterwards.
+        """
+        key = name_key(name)
+        future = concurrent.futures.Future()
+        with self.lock:
+            home = home_node(key, [self.name] + list(self.links))
+            if home == self.name:
+                future.set_result(self.reserve(key, self.name))
+                return future
+            claim_id = next(self.ids)
+            self.pending[claim_id] = (future, home, name)
+
+        if not self.send_to(home, {"op": "claim", "id": claim_id, "name": name}):
+            with self.lock:
+                self.pending.pop(claim_id, None)
+            future.set_result(False)
+        return future
+
+    def release(self, name):
+        self.unreserve(name)
+
+    def unreserve(self, name):
+        key = name_key(name)
+        home = home_node(key, self.members())
+        if home == self.name:
+            with self.lock:
+                if self.directory.get(key) == self.name:
+                    del self.directory[key]
+        else:
+            self.send_to(home, {"op": "release", "name": name})
+
+    def publish(self, op, **fields):
+        fields["op"] = op
+
+        if op == "presence":
+            self.track(fields["kind"], fields["name"], fields.get("avatar"), self.name)
+            if fields["kind"] == "LEAVE":
+                self.unreserve(fields["name"])
+            self.send_all(fields)
+
+        elif op == "broadcast" or op in ROOM_OPS:
+            self.send_all(fields)
+
+        elif op in ("private", "not_found"):
+            # Straight to the node that owns the user it is addressed to
+            owner_name = fields["target"] if op == "private" else fields["sender"]
+            entry = self.users.get(name_key(owner_name))
+            node = entry[2] if entry is not None else None
+            if node == self.name:
+                self.deliver(op, fields)
+            elif node is None or not self.send_to(node, fields):
+                if op == "private":
+                    self.deliver("not_found", {
+                        "sender": fields["sender"],
+                        "target": fields["target"],
+                        "message": fields["message"],
+                    })
+
+        # "shutdown" stays local: stopping one node must not stop its peers,
+        # and so does "file": the peers could not serve the file
+
+    def send_all(self, message):
+        data = encode(message)
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            try:
+                with link.peer.lock:
+                    link.peer.sock.sendall(data)
+            except OSError:
+                pass
@@ -0,0 +1,287 @@
+"""
+File and image sharing.
+
+Clients that offer the "files" feature upload over their chat connection,
+in chunks, and download over a separate connection, so a big download
+never holds up chat.
+
+Upload, on the chat connection:
+
+    C: CMD:FILE_OFFER:{"id":1,"name":"a.png","size":123,"sha256":"...","to":"all"}
+    S: CMD:FILE_ACK:<id>:<bytes stored>         go ahead, then progress
+    C: binary frames: 4 byte upload id + up to CHUNK_SIZE bytes of the file
+    S: CMD:FILE_READY:<id>:<sha256>             stored and shared
+    S: CMD:FILE_ERROR:<id>:<reason>             at any point
+    C: CMD:FILE_CANCEL:<id>
+
+"to" is "all", "@<user>" or "#<room>". The uploader keeps at most WINDOW
+bytes unacknowledged and the server acks every ACK_EVERY bytes, so an
+upload neither floods the server nor queues up in the uploader's socket:
+its own chat lines go out between two chunks.
+
+The server stores files by SHA-256. A file it already has (someone shared
+it before) is not uploaded again: FILE_READY follows the offer directly.
+Recipients that support files get
+
+    CMD:FILE:{"file":"<sha256>","name":...,"size":...,"from":...,"to":...}
+
+and others a [System] line.
+
+Download: a new connection sends "CMD:FILE_GET:<sha256>" as its first line
+instead of a HELLO. The server answers "CMD:FILE_SIZE:<bytes>", sends the
+file with sendfile() (zero copy from the page cache) and closes. The hash
+is the capability: only users who were shown the file know it.
+"""
+import hashlib
+import json
+import os
+import re
+import struct
+import tempfile
+
+FEATURE_FILES = "files"
+
+OFFER_PREFIX = "CMD:FILE_OFFER:"
+CANCEL_PREFIX = "CMD:FILE_CANCEL:"
+ACK_PREFIX = "CMD:FILE_ACK:"
+READY_PREFIX = "CMD:FILE_READY:"
+ERROR_PREFIX = "CMD:FILE_ERROR:"
+NOTICE_PREFIX = "CMD:FILE:"
+GET_PREFIX = "CMD:FILE_GET:"
+SIZE_PREFIX = "CMD:FILE_SIZE:"
+
+CHUNK_SIZE = 64 * 1024
+WINDOW = 1024 * 1024                # bytes an uploader may have unacknowledged
+ACK_EVERY = 256 * 1024
+MAX_FILE_SIZE = 100 * 1024 * 1024
+MAX_UPLOADS = 4                     # concurrent uploads per connection
+MAX_NAME = 200
+
+CHUNK_HEADER = struct.Struct("!I")  # upload id
+
+IMAGE_TYPES = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp")
+PREVIEW_MAX = 4 * 1024 * 1024       # images up to this size are shown inline
+
+DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+def valid_digest(text):
+    return DIGEST.fullmatch(text) is not None
+
+
+def clean_name(name):
+    """A file name safe to show and to save: no directories, no control characters."""
+    name = os.path.basename(name.replace("\\", "/"))
+    name = "".join(ch for ch in name if ch.isprintable()).strip()
+    return name[:MAX_NAME] or "file"
+
+
+def human_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_TYPES)
+
+
+def file_digest(path):
+    """(sha256 hex digest, size) of a file on disk."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+
+def format_offer(upload_id, name, size, digest, target):
+    offer = {"id": upload_id, "name": name, "size": size, "sha256": digest, "to": target}
+    return OFFER_PREFIX + json.dumps(offer, separators=(",", ":"))
+
+
+def parse_offer(message):
+    """Return the validated offer dict; raises ValueError for malformed offers."""
+    try:
+        offer = json.loads(message[len(OFFER_PREFIX):])
+        upload_id = int(offer["id"])
+        size = int(offer["size"])
+        digest = str(offer["sha256"])
+        target = str(offer["to"])
+        name = clean_name(str(offer["name"]))
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Malformed file offer") from None
+    if not 0 <= upload_id < 2 ** 32 or size < 0 or not valid_digest(digest):
+        raise ValueError("Malformed file offer")
+    return {"id": upload_id, "name": name, "size": size, "sha256": digest, "to": target}
+
+
+def format_status(prefix, upload_id, value):
+    return f"{prefix}{upload_id}:{value}"
+
+
+def parse_status(message, prefix):
+    """(upload id, value) of a FILE_ACK, FILE_READY or FILE_ERROR line."""
+    upload_id, value = message[len(prefix):].split(":", 1)
+    return int(upload_id), value
+
+
+def format_notice(digest, name, size, sender, target):
+    notice = {"file": digest, "name": name, "size": size, "from": sender, "to": target}
+    return NOTICE_PREFIX + json.dumps(notice, separators=(",", ":"))
+
+
+def parse_notice(message):
+    notice = json.loads(message[len(NOTICE_PREFIX):])
+    notice["name"] = clean_name(notice["name"])
+    return notice
+
+
+def pack_chunk(upload_id, data):
+    return CHUNK_HEADER.pack(upload_id) + data
+
+
+def unpack_chunk(payload):
+    """(upload id, chunk data) of a binary frame; the data is not copied."""
+    if len(payload) < CHUNK_HEADER.size:
+        raise ValueError("Short file chunk")
+    (upload_id,) = CHUNK_HEADER.unpack_from(payload)
+    return upload_id, memoryview(payload)[CHUNK_HEADER.size:]
+
+
+class Upload:
+    """A file being received: written to a temporary file and hashed on the way."""
+
+    def __init__(self, store, offer):
+        self.store = store
+        self.offer = offer
+        self.size = offer["size"]
+        self.received = 0
+        self.acked = 0
+        self.digest = hashlib.sha256()
+        fd, self.temp_path = tempfile.mkstemp(dir=store.temp_dir)
+        self.file = os.fdopen(fd, "wb")
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def write(self, data):
+        if self.received + len(data) > self.size:
+            raise ValueError("More data than offered")
+        self.file.write(data)
+        self.digest.update(data)
+        self.received += len(data)
+
+    def finish(self):
+        """Move the finished file into the store; raises ValueError if it is not what was offered."""
+        self.file.close()
+        if self.digest.hexdigest() != self.offer["sha256"]:
+            os.unlink(self.temp_path)
+            raise ValueError("Checksum mismatch")
+        path = self.store.path(self.offer["sha256"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Two uploads of the same file may race; both produce the same bytes
+        os.replace(self.temp_path, path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+
+class BlobStore:
+    """
+    Content addressed file store: <directory>/<first 2 hex digits>/<sha256>.
+    Files are immutable once stored, so readers need no locking.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.temp_dir = os.path.join(directory, "incoming")
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def has(self, digest):
+        return valid_digest(digest) and os.path.exists(self.path(digest))
+
+    def begin(self, offer):
+        return Upload(self, offer)
+
+    def open(self, digest):
+        """Binary file object of a stored file, or None."""
+        if not valid_digest(digest):
+            return None
+        try:
+            return open(self.path(digest), "rb")
+        except OSError:
+            return None
+
+
+def download(sock, digest, f, progress=None):
+    """
+    Fetch a stored file over sock, a fresh connection to the server, into
+    the binary file f; progress(received, size) is called as data arrives.
+    Returns the size. Raises OSError if the server refuses or the data is
+    not the file that was asked for.
+    """
+    sock.sendall(f"{GET_PREFIX}{digest}\n".encode())
+    buffer = b""
+    while b"\n" not in buffer:
+        data = sock.recv(CHUNK_SIZE)
+        if not data:
+            raise ConnectionError("The server closed the connection")
+        buffer += data
+
+    line, _, data = buffer.partition(b"\n")
+    line = line.decode(errors="replace")
+    if not line.startswith(SIZE_PREFIX):
+        # CMD:ERROR:<code>:<text>
+        raise FileNotFoundError(line.split(":", 3)[-1])
+    size = int(line[len(SIZE_PREFIX):])
+
+    hasher = hashlib.sha256()
+    received = 0
+    while True:
+        if data:
+            f.write(data)
+            hasher.update(data)
+            received += len(data)
+            if progress is not None:
+                progress(received, size)
+        if received >= size:
+            break
+        data = sock.recv(CHUNK_SIZE * 4)
+        if not data:
+            break
+
+    if received != size or hasher.hexdigest() != digest:
+        raise OSError("The download is incomplete or corrupt")
+    return size
+
+
+def send_file(sock, f, size):
+    """Send size bytes of f: zero copy where the socket allows it (not over TLS)."""
+    if not size:
+        # sendfile() refuses a count of 0
+        return
+    sendfile = getattr(sock, "sendfile", None)
+    if sendfile is not None:
+        sendfile(f, 0, size)
+        return
+    while True:
+        block = f.read(CHUNK_SIZE * 4)
+        if not block:
+            break
+        sock.sendall(block)
@@ -0,0 +1,297 @@
+"""
+Wire protocol helpers shared by the chat servers and clients.
+
+Legacy protocol: one UTF-8 message per line, terminated by "\\n".
+
+Framed protocol (version 2): every message is a frame made of a 4 byte
+big-endian payload length, one frame type byte and the payload itself.
+Messages may contain newlines or binary data, and the receiver slices
+frames by offset instead of scanning every byte.
+
+Negotiation: a client that speaks the framed protocol sends
+"CMD:HELLO:<version>[:<feature>,...]" as its first line. The server answers
+with a HELLO line carrying the version it picked and the features both
+sides support, and from then on both directions use frames. A server that
+does not know HELLO treats the line as a username, so clients reconnect
+and fall back to the legacy protocol when the reply is not a HELLO.
+
+A server that refuses the connection (e.g. when overloaded) answers with
+one "CMD:ERROR:<code>:<text>" line instead and closes it.
+"""
+import struct
+
+PROTOCOL_VERSION = 2
+LEGACY_VERSION = 1
+HELLO_PREFIX = "CMD:HELLO:"
+ERROR_PREFIX = "CMD:ERROR:"
+
+HEADER = struct.Struct("!IB")           # payload length, frame type
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+FRAME_TEXT = 1      # UTF-8 text, same meaning as one legacy line
+FRAME_BINARY = 2    # opaque payload
+FRAME_DEFLATE = 3   # compressed UTF-8 text, see compression.py
+
+MAX_LINE_SIZE = 1024 * 1024
+
+# Bodies at least this large are sent as a separate buffer after the header
+SPLIT_FRAME_SIZE = 16 * 1024
+
+
+class FramingError(ValueError):
+    pass
+
+
+def encode_frame(payload, frame_type=FRAME_TEXT):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FramingError(f"Frame too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+class LegacyCodec:
+    name = "legacy"
+    framed = False
+
+    def encode(self, text):
+        # Newlines would split the message for a line based peer
+        return f"{text.replace(chr(10), ' ')}\n".encode()
+
+    encode_shared = encode
+
+    def decode(self, frame_type, payload):
+        """Turn a received frame into (frame_type, payload) for the handlers."""
+        return frame_type, payload
+
+
+class FramedCodec:
+    name = "framed"
+    framed = True
+
+    def encode(self, text):
+        return encode_frame(text.encode())
+
+    def encode_shared(self, text):
+        """
+        Encode once for many recipients. Large bodies come back as a
+        (header, body) tuple so they are never copied into a joined frame.
+        """
+        payload = text.encode()
+        if len(payload) < SPLIT_FRAME_SIZE:
+            return encode_frame(payload)
+        if len(payload) > MAX_FRAME_SIZE:
+            raise FramingError(f"Frame too large: {len(payload)} bytes")
+        return HEADER.pack(len(payload), FRAME_TEXT), payload
+
+    def decode(self, frame_type, payload):
+        return frame_type, payload
+
+
+LEGACY = LegacyCodec()
+FRAMED = FramedCodec()
+
+
+def build_hello(version=PROTOCOL_VERSION, features=()):
+    return f"{HELLO_PREFIX}{version}:{','.join(features)}"
+
+
+def parse_hello(line):
+    """Return (version, features) for a HELLO line, or None for anything else."""
+    if not line.startswith(HELLO_PREFIX):
+        return None
+
+    version, _, features = line[len(HELLO_PREFIX):].partition(":")
+    try:
+        version = int(version)
+    except ValueError:
+        return None
+    return version, {f for f in features.split(",") if f}
+
+
+def negotiate(client_line, supported_features=()):
+    """
+    Server side of the handshake.
+    Returns (reply_line, codec, features) for a HELLO, or None for a legacy
+    first line (which then is the username).
+    """
+    hello = parse_hello(client_line)
+    if hello is None:
+        return None
+
+    version, features = hello
+    version = min(version, PROTOCOL_VERSION)
+    agreed = features & set(supported_features) if version >= PROTOCOL_VERSION else set()
+    codec = FRAMED if version >= PROTOCOL_VERSION else LEGACY
+    return build_hello(version, sorted(agreed)), codec, agreed
+
+
+class StreamDecoder:
+    """
+    Incremental decoder that splits a byte stream into messages, either
+    newline terminated lines or length-prefixed frames. The mode can be
+    switched between messages, which is what happens right after the HELLO
+    handshake.
+
+    Data is received straight into a preallocated bytearray (recv_into(),
+    or get_buffer()/buffer_updated() for asyncio.BufferedProtocol), and
+    messages are located by offset, so a burst of N messages costs O(N)
+    instead of re-copying the remaining buffer after every message. Bytes
+    are only decoded once a message is complete, so multi-byte UTF-8
+    characters split across TCP segments survive.
+    """
+
+    def __init__(self, framed=False, size=64 * 1024):
+        self.framed = framed
+        self.buffer = bytearray(size)
+        self.start = 0      # first unconsumed byte
+        self.end = 0        # end of received data
+        self.scanned = 0    # line mode: no newline before this offset
+        self.wanted = 0     # frame mode: bytes needed for the pending frame
+
+    def get_buffer(self, sizehint=-1):
+        """Return a writable view of the free space after the received data."""
+        needed = max(sizehint, self.wanted - (self.end - self.start), 4096)
+        if len(self.buffer) - self.end < needed:
+            self._make_room(needed)
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+
+    def recv_into(self, sock):
+        """Receive from a blocking socket into the buffer; returns 0 on EOF."""
+        nbytes = sock.recv_into(self.get_buffer())
+        self.end += nbytes
+        return nbytes
+
+    def feed(self, data):
+        view = self.get_buffer(len(data))
+        view[:len(data)] = data
+        self.end += len(data)
+
+    def _make_room(self, needed):
+        live = self.end - self.start
+        if self.start:
+            # Move the unconsumed tail to the front instead of growing
+            self.buffer[:live] = self.buffer[self.start:self.end]
+            self.scanned -= self.start
+            self.start = 0
+            self.end = live
+        if len(self.buffer) - self.end < needed:
+            self.buffer.extend(bytes(needed - (len(self.buffer) - self.end)))
+
+    def next_message(self):
+        """Return the next complete (frame_type, payload) or None."""
+        if self.framed:
+            frames = self._take_frames(limit=1)
+            return frames[0] if frames else None
+
+        newline = self.buffer.find(b"\n", max(self.start, self.scanned), self.end)
+        if newline < 0:
+            self._need_more_line_data()
+            return None
+
+        with memoryview(self.buffer) as view:
+            line = view[self.start:newline].tobytes()
+        self._consumed(newline + 1)
+        return FRAME_TEXT, line
+
+    def messages(self):
+        """
+        Yield every complete message that is buffered. Switching to frame
+        mode while iterating takes effect from the next message on.
+        """
+        if not self.framed:
+            newline = self.buffer.rfind(b"\n", max(self.start, self.scanned), self.end)
+            if newline < 0:
+                self._need_more_line_data()
+                return
+
+            # Copy every complete line out at once and let bytes.split do the work
+            with memoryview(self.buffer) as view:
+                lines = view[self.start:newline].tobytes().split(b"\n")
+            for line in lines:
+                self.start += len(line) + 1
+                yield FRAME_TEXT, line
+                if self.framed:
+                    break
+            self._consumed(self.start)
+
+        if self.framed:
+            yield from self._take_frames()
+
+    def _take_frames(self, limit=None):
+        frames = []
+        buf = self.buffer
+        start = self.start
+        end = self.end
+        header_size = HEADER.size
+        unpack = HEADER.unpack_from
+        wanted = 0
+
+        with memoryview(buf) as view:
+            while end - start >= header_size:
+                length, frame_type = unpack(buf, start)
+                if length > MAX_FRAME_SIZE:
+                    raise FramingError(f"Frame too large: {length} bytes")
+                body = start + header_size
+                if body + length > end:
+                    # Lets get_buffer() make room for the whole frame at once
+                    wanted = header_size + length
+                    break
+                start = body + length
+                frames.append((frame_type, view[body:start].tobytes()))
+                if limit and len(frames) >= limit:
+                    break
+
+        self.wanted = wanted
+        self._consumed(start)
+        return frames
+
+    def _need_more_line_data(self):
+        self.scanned = self.end
+        if self.end - self.start > MAX_LINE_SIZE:
+            raise FramingError("Line too long")
+
+    def _consumed(self, offset):
+        self.start = offset
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+
+
+def client_handshake(sock, features=()):
+    """
+    Client side of the handshake on a freshly connected blocking socket.
+    Returns (codec, agreed_features, decoder), or None when the server does
+    not understand HELLO; the caller should then reconnect in legacy mode.
+    Raises ConnectionRefusedError with the server's reason if it refused us.
+    """
+    sock.sendall(f"{build_hello(PROTOCOL_VERSION, features)}\n".encode())
+
+    decoder = StreamDecoder()
+    message = read_message(sock, decoder)
+    if message is None:
+        return None
+
+    line = message[1].decode(errors="replace").strip()
+    if line.startswith(ERROR_PREFIX):
+        raise ConnectionRefusedError(line[len(ERROR_PREFIX):].partition(":")[2])
+
+    hello = parse_hello(line)
+    if hello is None:
+        return None
+
+    version, agreed = hello
+    if version >= PROTOCOL_VERSION:
+        decoder.framed = True
+        return FRAMED, agreed, decoder
+    return LEGACY, set(), decoder
+
+
+def read_message(sock, decoder):
+    """Block until the decoder yields one message; returns None on EOF."""
+    while True:
+        message = decoder.next_message()
+        if message is not None:
+            return message
+        if not decoder.recv_into(sock):
+            return None
@@ -0,0 +1,151 @@
+"""
+Heartbeats and idle connection reaping.
+
+A client that vanishes without closing its connection (a laptop going to
+sleep, a pulled cable) never sends a FIN, so its reader would wait in
+recv() forever while the server keeps queueing broadcasts for it.
+
+Clients that offer the "heartbeat" feature answer CMD:PING with CMD:PONG.
+Once a connection has been silent for the ping interval the server pings
+it, and once it has been silent for the idle timeout it is aborted, which
+removes the client like any other disconnect. Older clients cannot answer
+pings; for them the same timing is handed to TCP keepalive, and
+connections that never log in are reaped at the idle timeout.
+
+Any incoming data counts as a sign of life, so busy clients are never
+pinged. Readers only store a timestamp; the deadlines live in one hashed
+timer wheel driven by a single thread, so scheduling, cancelling and
+checking a connection are O(1) no matter how many are open.
+"""
+import math
+import socket
+import threading
+import time
+
+FEATURE_HEARTBEAT = "heartbeat"
+
+PING = "CMD:PING"
+PONG = "CMD:PONG"
+
+PING_INTERVAL = 30.0    # seconds of silence before a client is pinged
+IDLE_TIMEOUT = 90.0     # seconds of silence before it is disconnected
+TICK = 1.0              # timer wheel resolution in seconds
+WHEEL_SLOTS = 512       # one revolution covers 512 ticks; longer timers wait for later rounds
+KEEPALIVE_PROBES = 4
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: every timer sits in the slot of its deadline tick
+    modulo the wheel size, so advancing one tick only looks at one slot.
+    Keys must be hashable; a key has at most one pending timer.
+    """
+
+    def __init__(self, tick=TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]     # key -> deadline tick
+        self.where = {}                             # key -> slot index
+        self.now = 0                                # ticks advanced so far
+        self.lock = threading.Lock()
+
+    def schedule(self, key, delay):
+        """Arm (or re-arm) the timer for key to expire after delay seconds."""
+        deadline = self.now + max(1, math.ceil(delay / self.tick))
+        index = deadline % len(self.slots)
+        with self.lock:
+            self._cancel(key)
+            self.slots[index][key] = deadline
+            self.where[key] = index
+
+    def cancel(self, key):
+        with self.lock:
+            self._cancel(key)
+
+    def _cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self):
+        """Move one tick forward and return the keys whose timers expired."""
+        with self.lock:
+            self.now += 1
+            slot = self.slots[self.now % len(self.slots)]
+            expired = [key for key, deadline in slot.items() if deadline <= self.now]
+            for key in expired:
+                del slot[key]
+                del self.where[key]
+        return expired
+
+    def __len__(self):
+        return len(self.where)
+
+
+def enable_keepalive(sock, idle=PING_INTERVAL, timeout=IDLE_TIMEOUT, probes=KEEPALIVE_PROBES):
+    """Let the kernel detect dead peers: probe after idle seconds, give up at about timeout."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Not every platform can tune the timing (e.g. TCP_KEEPIDLE is missing on older macOS)
+    options = (
+        ("TCP_KEEPIDLE", idle),
+        ("TCP_KEEPINTVL", (timeout - idle) / probes),
+        ("TCP_KEEPCNT", probes),
+    )
+    for name, value in options:
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), max(1, int(value)))
+
+
+class HeartbeatMonitor:
+    """
+    Watches connections (objects with last_seen, features and username
+    attributes). Calls ping(conn) when a heartbeat client has been silent
+    for interval seconds and reap(conn) once a connection has been silent
+    for timeout seconds. Both are called on the monitor thread.
+    """
+
+    def __init__(self, ping, reap, interval=PING_INTERVAL, timeout=IDLE_TIMEOUT, tick=TICK):
+        self.ping = ping
+        self.reap = reap
+        self.interval = interval
+        self.timeout = max(timeout, interval)
+        self.wheel = TimerWheel(tick)
+        self.thread = None
+
+    def watch(self, conn):
+        conn.last_seen = time.monotonic()
+        self.wheel.schedule(conn, self.interval)
+
+    def forget(self, conn):
+        self.wheel.cancel(conn)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        started = time.monotonic()
+        ticks = 0
+        while True:
+            ticks += 1
+            delay = started + ticks * self.wheel.tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            for conn in self.wheel.advance():
+                try:
+                    self.expire(conn)
+                except Exception:
+                    pass
+
+    def expire(self, conn):
+        silent = time.monotonic() - conn.last_seen
+        if silent >= self.timeout:
+            self.reap(conn)
+        elif silent < self.interval:
+            # Heard from since the timer was set
+            self.wheel.schedule(conn, self.interval - silent)
+        elif FEATURE_HEARTBEAT in conn.features:
+            self.ping(conn)
+            self.wheel.schedule(conn, self.timeout - silent)
+        elif conn.username is None:
+            self.wheel.schedule(conn, self.timeout - silent)
+        # Logged in clients without heartbeats are left to TCP keepalive
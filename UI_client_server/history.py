@@ -0,0 +1,349 @@
+"""
+Bounded message history.
+
+The server keeps the last ring_size messages of every conversation in an
+in-memory ring buffer (at most max_conversations of them, least recently
+used first out) and, with a directory, also appends every message to a
+segmented log on disk:
+
+    <first seq>.log   records: !IQd header (length, seq, time) + JSON body
+    <first seq>.idx   one !QII entry per record (seq, offset, conversation hash)
+
+A segment is sealed once it grows past segment_bytes, and only the newest
+max_segments are kept, so memory and disk use stay bounded however long
+the server runs. Older pages are found through the fixed-size index
+entries and read through mmap. Segments that cannot contain a
+conversation are skipped without touching their files.
+
+Conversations are "all" for the public chat and one key per pair of users
+for private messages. Clients that negotiated the "history" feature get
+a backfill of the public chat when they join, and can page further back:
+
+    CMD:HISTORY:<conversation>:<before seq, 0 = newest>:<limit>
+    CMD:HISTORY_PAGE:{"conversation": ..., "messages": [[seq, time, sender, text], ...], "more": bool}
+
+where the conversation is "all" or "@<user>" for the private chat with
+that user.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+from registry import name_key
+
+FEATURE_HISTORY = "history"
+
+REQUEST_PREFIX = "CMD:HISTORY:"
+PAGE_PREFIX = "CMD:HISTORY_PAGE:"
+
+PUBLIC = "all"
+MAX_PAGE = 200
+
+RING_SIZE = 200
+MAX_CONVERSATIONS = 1024
+SEGMENT_BYTES = 4 * 1024 * 1024
+MAX_SEGMENTS = 64
+
+RECORD = struct.Struct("!IQd")      # body length, seq, unix time
+INDEX_ENTRY = struct.Struct("!QII")  # seq, offset in the .log, conversation hash
+
+
+def private_conversation(user, other):
+    """Store key of the private chat between two users, the same from both sides."""
+    first, second = sorted((name_key(user), name_key(other)))
+    return f"dm:{first}\x1f{second}"
+
+
+def conversation_key(requester, conversation):
+    """Map a client's conversation name ("all" or "@user") to its store key."""
+    if conversation.startswith("@"):
+        return private_conversation(requester, conversation[1:])
+    return PUBLIC
+
+
+def conversation_hash(key):
+    return zlib.crc32(key.encode())
+
+
+def format_request(conversation, before=0, limit=50):
+    return f"{REQUEST_PREFIX}{conversation}:{before}:{limit}"
+
+
+def parse_request(message):
+    """Return (conversation, before, limit) for a history request."""
+    conversation, before, limit = message[len(REQUEST_PREFIX):].rsplit(":", 2)
+    return conversation, int(before), max(1, min(int(limit), MAX_PAGE))
+
+
+def format_page(conversation, messages, more):
+    page = {"conversation": conversation, "messages": messages, "more": more}
+    return PAGE_PREFIX + json.dumps(page, separators=(",", ":"))
+
+
+def parse_page(message):
+    """Return (conversation, [(seq, time, sender, text), ...], more)."""
+    page = json.loads(message[len(PAGE_PREFIX):])
+    return page["conversation"], [tuple(entry) for entry in page["messages"]], page["more"]
+
+
+class Segment:
+    """One .log/.idx pair. Sealed segments are read through cached mmaps."""
+
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        self.log_path = os.path.join(directory, f"{first_seq:020d}.log")
+        self.index_path = os.path.join(directory, f"{first_seq:020d}.idx")
+        self.log_size = 0
+        self.index_size = 0
+        self.hashes = set()
+        self.maps = None
+
+    def map(self):
+        """(log, index) mmaps covering everything written so far."""
+        if self.maps is not None and len(self.maps[1]) == self.index_size:
+            return self.maps
+        self.unmap()
+        if not self.index_size:
+            return None
+        with open(self.log_path, "rb") as log_file, open(self.index_path, "rb") as index_file:
+            self.maps = (
+                mmap.mmap(log_file.fileno(), self.log_size, access=mmap.ACCESS_READ),
+                mmap.mmap(index_file.fileno(), self.index_size, access=mmap.ACCESS_READ),
+            )
+        return self.maps
+
+    def unmap(self):
+        if self.maps is not None:
+            for view in self.maps:
+                view.close()
+            self.maps = None
+
+    def delete(self):
+        self.unmap()
+        for path in (self.log_path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def find(self, conv_hash, key, before, limit):
+        """The newest limit entries of a conversation with seq < before, oldest first."""
+        maps = self.map()
+        if maps is None:
+            return []
+        log, index = maps
+
+        found = []
+        for seq, offset, entry_hash in INDEX_ENTRY.iter_unpack(index):
+            if seq >= before:
+                break
+            if entry_hash == conv_hash:
+                found.append((seq, offset))
+
+        entries = []
+        for seq, offset in reversed(found):
+            length, _, stamp = RECORD.unpack_from(log, offset)
+            body = log[offset + RECORD.size:offset + RECORD.size + length]
+            conversation, sender, text = json.loads(body)
+            # Different conversations can share a crc32
+            if conversation == key:
+                entries.append((seq, stamp, sender, text))
+                if len(entries) >= limit:
+                    break
+        entries.reverse()
+        return entries
+
+
+class HistoryStore:
+    def __init__(
+        self,
+        directory=None,
+        ring_size=RING_SIZE,
+        max_conversations=MAX_CONVERSATIONS,
+        segment_bytes=SEGMENT_BYTES,
+        max_segments=MAX_SEGMENTS
+    ):
+        self.directory = directory
+        self.ring_size = ring_size
+        self.max_conversations = max_conversations
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+
+        self.lock = threading.Lock()
+        self.rings = OrderedDict()      # conversation key -> deque of entries
+        self.segments = []
+        self.log_file = None
+        self.index_file = None
+        self.next_seq = 1
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    # -----------------------------------------------------------------
+    # Recovery
+    # -----------------------------------------------------------------
+
+    def _load(self):
+        first_seqs = sorted(
+            int(name[:-4]) for name in os.listdir(self.directory)
+            if name.endswith(".idx") and name[:-4].isdigit()
+        )
+        for first_seq in first_seqs:
+            segment = Segment(self.directory, first_seq)
+            self._recover(segment)
+            if segment.index_size:
+                self.segments.append(segment)
+            else:
+                segment.delete()
+
+        if self.segments:
+            last = self.segments[-1]
+            _, index = last.map()
+            self.next_seq = INDEX_ENTRY.unpack_from(index, last.index_size - INDEX_ENTRY.size)[0] + 1
+            self._open_active(last)
+
+    def _recover(self, segment):
+        """Drop a torn tail left by a crash mid-append."""
+        try:
+            log_size = os.path.getsize(segment.log_path)
+            index_size = os.path.getsize(segment.index_path)
+        except OSError:
+            return
+
+        index_size -= index_size % INDEX_ENTRY.size
+        with open(segment.index_path, "r+b") as index_file, open(segment.log_path, "r+b") as log_file:
+            entries = index_file.read(index_size)
+            valid = 0
+            for seq, offset, conv_hash in INDEX_ENTRY.iter_unpack(entries):
+                log_file.seek(offset)
+                header = log_file.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                length, record_seq, _ = RECORD.unpack(header)
+                end = offset + RECORD.size + length
+                if record_seq != seq or end > log_size:
+                    break
+                segment.hashes.add(conv_hash)
+                segment.log_size = end
+                valid += INDEX_ENTRY.size
+
+            index_file.truncate(valid)
+            log_file.truncate(segment.log_size)
+            segment.index_size = valid
+
+    # -----------------------------------------------------------------
+    # Writing
+    # -----------------------------------------------------------------
+
+    def _open_active(self, segment):
+        self._close_files()
+        self.log_file = open(segment.log_path, "ab")
+        self.index_file = open(segment.index_path, "ab")
+
+    def _close_files(self):
+        for f in (self.log_file, self.index_file):
+            if f is not None:
+                f.close()
+        self.log_file = self.index_file = None
+
+    def _rotate(self, first_seq):
+        segment = Segment(self.directory, first_seq)
+        self.segments.append(segment)
+        self._open_active(segment)
+        while len(self.segments) > self.max_segments:
+            self.segments.pop(0).delete()
+        return segment
+
+    def append(self, key, sender, text):
+        """Record one message. Returns its sequence number."""
+        stamp = time.time()
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self._ring(key).append((seq, stamp, sender, text))
+
+            if self.directory:
+                segment = self.segments[-1] if self.segments else None
+                if segment is None or segment.log_size >= self.segment_bytes:
+                    segment = self._rotate(seq)
+
+                body = json.dumps([key, sender, text], separators=(",", ":")).encode()
+                conv_hash = conversation_hash(key)
+                self.log_file.write(RECORD.pack(len(body), seq, stamp) + body)
+                self.log_file.flush()
+                self.index_file.write(INDEX_ENTRY.pack(seq, segment.log_size, conv_hash))
+                self.index_file.flush()
+
+                segment.log_size += RECORD.size + len(body)
+                segment.index_size += INDEX_ENTRY.size
+                segment.hashes.add(conv_hash)
+            return seq
+
+    # -----------------------------------------------------------------
+    # Reading
+    # -----------------------------------------------------------------
+
+    def _ring(self, key):
+        ring = self.rings.get(key)
+        if ring is not None:
+            self.rings.move_to_end(key)
+            return ring
+
+        # First use since start (or since it was evicted): reload from disk
+        ring = deque(self._read_disk(key, self.next_seq, self.ring_size), maxlen=self.ring_size)
+        self.rings[key] = ring
+        if len(self.rings) > self.max_conversations:
+            self.rings.popitem(last=False)
+        return ring
+
+    def _read_disk(self, key, before, limit):
+        if not self.segments:
+            return []
+        conv_hash = conversation_hash(key)
+        entries = []
+        for segment in reversed(self.segments):
+            if segment.first_seq >= before or conv_hash not in segment.hashes:
+                continue
+            entries[:0] = segment.find(conv_hash, key, before, limit - len(entries))
+            if len(entries) >= limit:
+                break
+        return entries
+
+    def page(self, key, before=0, limit=50):
+        """
+        Up to limit messages of a conversation older than before (0 = the
+        newest), oldest first, and whether older ones exist.
+        """
+        with self.lock:
+            if not before:
+                before = self.next_seq
+            ring = self._ring(key)
+
+            # The ring always holds the newest entries of the conversation
+            entries = [entry for entry in ring if entry[0] < before]
+            if len(entries) > limit:
+                return entries[-limit:], True
+
+            # Only a full ring can have older messages behind it, on disk
+            if not self.directory or len(ring) < self.ring_size:
+                return entries, False
+
+            wanted = limit - len(entries)
+            oldest = entries[0][0] if entries else before
+            older = self._read_disk(key, min(oldest, before), wanted + 1)
+            more = len(older) > wanted
+            if wanted:
+                entries = older[-wanted:] + entries
+            return entries, more
+
+    def close(self):
+        with self.lock:
+            self._close_files()
+            for segment in self.segments:
+                segment.unmap()
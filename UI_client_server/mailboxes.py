@@ -0,0 +1,275 @@
+"""
+Store-and-forward mailboxes for private messages to offline users.
+
+A "to:<user>" message for someone who is not logged in anywhere is kept in
+that user's mailbox and delivered when they next log in. With a directory
+every recipient has one append-only file:
+
+    <hash of the name>.mbox   records: !Id header (length, unix time) + JSON [sender, text]
+
+Files are locked with flock() while they are written or drained, so the
+worker processes of one server (--workers) can share the directory and a
+user gets their mail on whichever worker they log in to. Without a
+directory the same records are kept in memory.
+
+Limits keep the store bounded: max_bytes per mailbox, max_total_bytes for
+the whole store (new messages are refused once it is full) and a ttl after
+which undelivered messages are dropped.
+
+Delivery streams the mailbox in batches of about batch_bytes, so a user
+with thousands of waiting messages costs a few large writes, not one
+small send per message.
+"""
+import hashlib
+import io
+import json
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking (Windows); a single server process is fine
+    fcntl = None
+
+from registry import name_key
+
+MAX_MAILBOX_BYTES = 1024 * 1024
+MAX_TOTAL_BYTES = 64 * 1024 * 1024
+MAILBOX_TTL = 7 * 24 * 3600     # seconds an undelivered message is kept
+BATCH_BYTES = 64 * 1024
+USAGE_REFRESH = 10.0            # seconds between rescans of the directory size
+
+RECORD = struct.Struct("!Id")   # body length, unix time
+
+# Results of MailboxStore.deposit()
+QUEUED = "queued"
+FULL = "full"
+
+
+def encode_record(sender, text, stamp):
+    body = json.dumps([sender, text], separators=(",", ":")).encode()
+    return RECORD.pack(len(body), stamp) + body
+
+
+class MailboxStore:
+    def __init__(
+        self,
+        directory=None,
+        max_bytes=MAX_MAILBOX_BYTES,
+        max_total_bytes=MAX_TOTAL_BYTES,
+        ttl=MAILBOX_TTL
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.ttl = ttl
+
+        # Striped locks: one recipient's delivery never blocks everyone else
+        self.locks = [threading.Lock() for _ in range(16)]
+        self.memory = {}            # name key -> [bytearray of records, last write time]
+        self.usage = 0
+        self.usage_checked = 0.0
+        self.usage_lock = threading.Lock()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.expire()
+
+    def path(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, f"{digest}.mbox")
+
+    def lock_for(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    def open_locked(self, key, create):
+        """Open and flock a mailbox file, or None if it does not exist."""
+        path = self.path(key)
+        flags = os.O_RDWR | (os.O_CREAT if create else 0)
+        while True:
+            try:
+                fd = os.open(path, flags, 0o600)
+            except FileNotFoundError:
+                return None
+            f = os.fdopen(fd, "r+b")
+            if fcntl is None:
+                return f
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # Another worker may have drained and removed it while we waited
+            try:
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    # -----------------------------------------------------------------
+    # Size limits
+    # -----------------------------------------------------------------
+
+    def expire(self):
+        """Drop mailboxes whose newest message is older than the ttl."""
+        cutoff = time.time() - self.ttl
+        if not self.directory:
+            for key, (_, written) in list(self.memory.items()):
+                if written < cutoff:
+                    self.memory.pop(key, None)
+            return
+
+        total = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".mbox"):
+                    continue
+                try:
+                    stat = entry.stat()
+                    if stat.st_mtime < cutoff:
+                        os.remove(entry.path)
+                    else:
+                        total += stat.st_size
+                except OSError:
+                    pass
+        self.usage = total
+
+    def total_bytes(self):
+        # Other workers write to the directory too, so rescan now and then
+        with self.usage_lock:
+            now = time.monotonic()
+            if now - self.usage_checked > USAGE_REFRESH:
+                self.usage_checked = now
+                self.expire()
+            if not self.directory:
+                return sum(len(records) for records, _ in list(self.memory.values()))
+            return self.usage
+
+    # -----------------------------------------------------------------
+    # Writing
+    # -----------------------------------------------------------------
+
+    def deposit(self, recipient, sender, text):
+        """Queue a message for an offline user. Returns QUEUED or FULL."""
+        key = name_key(recipient)
+        now = time.time()
+        record = encode_record(sender, text, now)
+
+        if self.total_bytes() + len(record) > self.max_total_bytes:
+            return FULL
+
+        with self.lock_for(key):
+            if not self.directory:
+                entry = self.memory.get(key)
+                if entry is None or entry[1] < now - self.ttl:
+                    entry = self.memory[key] = [bytearray(), now]
+                if len(entry[0]) + len(record) > self.max_bytes:
+                    return FULL
+                entry[0] += record
+                entry[1] = now
+                return QUEUED
+
+            f = self.open_locked(key, create=True)
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if size and os.fstat(f.fileno()).st_mtime < now - self.ttl:
+                    # Everything in it has expired
+                    f.truncate(0)
+                    size = 0
+                if size + len(record) > self.max_bytes:
+                    return FULL
+                f.seek(size)
+                f.write(record)
+            finally:
+                f.close()
+
+        with self.usage_lock:
+            self.usage += len(record)
+        return QUEUED
+
+    # -----------------------------------------------------------------
+    # Delivery
+    # -----------------------------------------------------------------
+
+    def pending(self, recipient):
+        key = name_key(recipient)
+        if not self.directory:
+            return key in self.memory
+        return os.path.exists(self.path(key))
+
+    def deliver(self, recipient, send_batch, batch_bytes=BATCH_BYTES):
+        """
+        Stream a user's mailbox to send_batch(records), a list of
+        (time, sender, text) per call. Delivered records are removed; if
+        send_batch returns False (the user left) the rest stays queued.
+        Returns the number of messages delivered.
+        """
+        key = name_key(recipient)
+        with self.lock_for(key):
+            if not self.directory:
+                entry = self.memory.pop(key, None)
+                if entry is None:
+                    return 0
+                stream = io.BytesIO(entry[0])
+                delivered, rest = self._stream(stream, send_batch, batch_bytes)
+                if rest:
+                    self.memory[key] = [bytearray(rest), entry[1]]
+                return delivered
+
+            f = self.open_locked(key, create=False)
+            if f is None:
+                return 0
+            try:
+                size = os.fstat(f.fileno()).st_size
+                delivered, rest = self._stream(f, send_batch, batch_bytes)
+                if rest:
+                    f.seek(0)
+                    f.write(rest)
+                    f.truncate()
+                else:
+                    # Removed while still locked, so no writer can lose a record
+                    os.remove(self.path(key))
+            finally:
+                f.close()
+
+        with self.usage_lock:
+            self.usage = max(0, self.usage - size + len(rest))
+        return delivered
+
+    def _stream(self, stream, send_batch, batch_bytes):
+        """Returns (messages delivered, undelivered record bytes)."""
+        cutoff = time.time() - self.ttl
+        delivered = 0
+        batch = []
+        batch_size = 0
+        offset = 0      # start of the first record not handed to send_batch
+
+        while True:
+            header = stream.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            length, stamp = RECORD.unpack(header)
+            body = stream.read(length)
+            if len(body) < length:
+                # Torn tail from a crash mid-write
+                break
+            if stamp >= cutoff:
+                sender, text = json.loads(body)
+                batch.append((stamp, sender, text))
+                batch_size += length
+
+            if batch_size >= batch_bytes:
+                if not send_batch(batch):
+                    stream.seek(offset)
+                    return delivered, stream.read()
+                delivered += len(batch)
+                batch = []
+                batch_size = 0
+                offset = stream.tell()
+
+        if batch:
+            if not send_batch(batch):
+                stream.seek(offset)
+                return delivered, stream.read()
+            delivered += len(batch)
+        return delivered, b""
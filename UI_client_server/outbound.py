@@ -0,0 +1,216 @@
+"""
+Bounded per-client outbound queues.
+
+Every connection owns one OutboundQueue that is drained by its own writer,
+so a slow consumer only delays itself instead of every client after it in
+broadcast_packet().
+
+A queued frame is either a bytes-like object or a tuple of them (e.g. a
+frame header and a large body). Broadcasts put the very same objects into
+every recipient's queue, and writers hand a whole batch to the kernel with
+one scatter-gather sendmsg() call instead of joining it first.
+"""
+import threading
+import time
+from collections import deque
+
+HIGH_WATER = 256 * 1024     # queued bytes before a client counts as congested
+LOW_WATER = 64 * 1024       # congestion clears once the queue drains below this
+SLOW_CONSUMER_GRACE = 10.0  # seconds a client may stay congested ("disconnect")
+BACKPRESSURE_WINDOW = 0.05  # seconds a blocking producer waits out a burst
+MAX_BATCH = 64 * 1024       # bytes handed to the writer per wakeup
+
+POLICIES = ("drop", "disconnect")
+
+IOV_MAX = 1024              # buffers per sendmsg() call
+
+
+def frame_size(frame):
+    if type(frame) is tuple:
+        return sum(len(part) for part in frame)
+    return len(frame)
+
+
+def flatten(batch):
+    """Turn a batch of frames into one flat list of buffers."""
+    buffers = []
+    for frame in batch:
+        if type(frame) is tuple:
+            buffers.extend(frame)
+        else:
+            buffers.append(frame)
+    return buffers
+
+
+def send_buffers(sock, buffers):
+    """Write all buffers to a blocking socket, batching them with sendmsg()."""
+    try:
+        while buffers:
+            sent = sock.sendmsg(buffers[:IOV_MAX])
+            # Drop what went out completely and keep the unsent tail
+            index = 0
+            while index < len(buffers) and sent >= len(buffers[index]):
+                sent -= len(buffers[index])
+                index += 1
+            buffers = buffers[index:]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+    except (AttributeError, NotImplementedError):
+        # e.g. TLS sockets cannot scatter-gather
+        sock.sendall(b"".join(buffers))
+
+
+class OutboundQueue:
+    """
+    Frames waiting to be written to one client.
+
+    Control frames (CMD:DISCONNECT, LIST:) go to a separate lane that is
+    always drained first and is never dropped. A control frame with a key
+    replaces an older queued frame with the same key, so e.g. a burst of
+    user list updates only sends the newest one.
+
+    Data frames are dropped while the queue is congested: congestion starts
+    when the queue grows past high_water and ends when it drains below
+    low_water. A blocking producer (the client's own reader thread, never a
+    broadcast to many clients or the event loop) first waits up to
+    BACKPRESSURE_WINDOW at the start of each congestion episode, so short
+    bursts of replies are absorbed instead of dropped. With the "disconnect"
+    policy a client that stays congested for longer than grace seconds is
+    flagged for eviction.
+    """
+
+    def __init__(
+        self,
+        high_water=HIGH_WATER,
+        low_water=LOW_WATER,
+        policy="drop",
+        grace=SLOW_CONSUMER_GRACE
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        if low_water > high_water:
+            raise ValueError("low_water must not exceed high_water")
+
+        self.high_water = high_water
+        self.low_water = low_water
+        self.policy = policy
+        self.grace = grace
+
+        self.cond = threading.Condition()
+        self.control = deque()      # (key, frame)
+        self.data = deque()
+        self.queued_bytes = 0
+
+        self.congested_since = None
+        self.evict = False
+        self.closed = False
+
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+
+    def put(self, frame, control=False, key=None, block=False):
+        """Queue one frame. Returns False if it was dropped."""
+        size = frame_size(frame)
+        with self.cond:
+            if self.closed:
+                return False
+
+            if control:
+                if key is not None:
+                    for i, (old_key, old_frame) in enumerate(self.control):
+                        if old_key == key:
+                            self.queued_bytes -= frame_size(old_frame)
+                            del self.control[i]
+                            break
+                self.control.append((key, frame))
+            else:
+                if self.congested_since is None and self.queued_bytes + size > self.high_water:
+                    self.congested_since = time.monotonic()
+
+                if self.congested_since is not None and block:
+                    deadline = self.congested_since + BACKPRESSURE_WINDOW
+                    while self.congested_since is not None and not self.closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+
+                if self.congested_since is not None:
+                    self.dropped_frames += 1
+                    self.dropped_bytes += size
+                    if (
+                        self.policy == "disconnect"
+                        and time.monotonic() - self.congested_since > self.grace
+                    ):
+                        self.evict = True
+                    return False
+
+                self.data.append(frame)
+
+            self.queued_bytes += size
+            self.cond.notify()
+            return True
+
+    def take(self, block=True, max_bytes=MAX_BATCH):
+        """
+        Remove and return the next batch of frames, control frames first.
+        Blocks until something is queued unless block is False.
+        Returns an empty list once the queue is closed and drained.
+        """
+        with self.cond:
+            if block:
+                while not self.control and not self.data and not self.closed:
+                    self.cond.wait()
+
+            batch = []
+            size = 0
+            while self.control:
+                frame = self.control.popleft()[1]
+                batch.append(frame)
+                size += frame_size(frame)
+            while self.data and size < max_bytes:
+                frame = self.data.popleft()
+                batch.append(frame)
+                size += frame_size(frame)
+
+            self.queued_bytes -= size
+            self.sent_frames += len(batch)
+            self.sent_bytes += size
+
+            if self.congested_since is not None and self.queued_bytes <= self.low_water:
+                self.congested_since = None
+                self.cond.notify_all()
+
+            return batch
+
+    def close(self):
+        """Stop accepting frames; the writer drains what is left and exits."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def clear(self):
+        """Discard everything still queued (the peer is gone)."""
+        with self.cond:
+            self.control.clear()
+            self.data.clear()
+            self.queued_bytes = 0
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.control) + len(self.data)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": len(self.control) + len(self.data),
+                "queued_bytes": self.queued_bytes,
+                "congested": self.congested_since is not None,
+                "sent_frames": self.sent_frames,
+                "sent_bytes": self.sent_bytes,
+                "dropped_frames": self.dropped_frames,
+                "dropped_bytes": self.dropped_bytes,
+            }
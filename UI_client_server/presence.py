@@ -0,0 +1,144 @@
+"""
+Versioned presence updates.
+
+Instead of broadcasting the whole user list on every join and leave, the
+server numbers every presence change and sends it as a small delta:
+
+    CMD:PRESENCE:<seq>:JOIN:<user>:<avatar>
+    CMD:PRESENCE:<seq>:LEAVE:<user>
+    CMD:PRESENCE:<seq>:AVATAR:<user>:<avatar>
+
+A client that sees a gap in the sequence numbers asks for a full snapshot
+with CMD:PRESENCE_SYNC and gets
+
+    CMD:PRESENCE_SNAPSHOT:<seq>:<json list of [user, avatar]>
+
+Only clients that negotiated the "presence" feature in the HELLO handshake
+get deltas; everyone else keeps receiving LIST: and CMD:UPDATE_AVATAR:.
+
+Clients that negotiated "join_snapshot" get everything they need right
+after logging in as one frame instead of a snapshot, a history page and a
+room list:
+
+    CMD:JOIN_SNAPSHOT:{"seq":..,"users":[[user, avatar], ...],
+                       "history":[[seq, time, sender, text], ...],"more":..,
+                       "rooms":[[room, members], ...]}
+
+"history"/"more" and "rooms" are only there if the client negotiated the
+history and rooms features.
+"""
+import json
+
+FEATURE_PRESENCE = "presence"
+FEATURE_JOIN_SNAPSHOT = "join_snapshot"
+
+EVENT_PREFIX = "CMD:PRESENCE:"
+SNAPSHOT_PREFIX = "CMD:PRESENCE_SNAPSHOT:"
+SYNC_REQUEST = "CMD:PRESENCE_SYNC"
+JOIN_SNAPSHOT_PREFIX = "CMD:JOIN_SNAPSHOT:"
+
+JOIN = "JOIN"
+LEAVE = "LEAVE"
+AVATAR = "AVATAR"
+
+
+def format_event(seq, kind, name, avatar=None):
+    if kind == LEAVE:
+        return f"{EVENT_PREFIX}{seq}:{LEAVE}:{name}"
+    return f"{EVENT_PREFIX}{seq}:{kind}:{name}:{avatar}"
+
+
+def parse_event(message):
+    """Return (seq, kind, name, avatar) for a presence delta."""
+    seq, kind, rest = message[len(EVENT_PREFIX):].split(":", 2)
+    if kind == LEAVE:
+        return int(seq), kind, rest, None
+    # Avatar names never contain ':', usernames might
+    name, avatar = rest.rsplit(":", 1)
+    return int(seq), kind, name, avatar
+
+
+def format_snapshot(seq, sessions):
+    entries = [[session.name, session.avatar] for session in sessions]
+    return f"{SNAPSHOT_PREFIX}{seq}:{json.dumps(entries, separators=(',', ':'))}"
+
+
+def parse_snapshot(message):
+    """Return (seq, [(user, avatar), ...]) for a presence snapshot."""
+    seq, payload = message[len(SNAPSHOT_PREFIX):].split(":", 1)
+    return int(seq), [tuple(entry) for entry in json.loads(payload)]
+
+
+def format_join_snapshot(seq, sessions, history=None, more=False, rooms=None):
+    snapshot = {"seq": seq, "users": [[session.name, session.avatar] for session in sessions]}
+    if history is not None:
+        snapshot["history"] = history
+        snapshot["more"] = more
+    if rooms is not None:
+        snapshot["rooms"] = rooms
+    return JOIN_SNAPSHOT_PREFIX + json.dumps(snapshot, separators=(",", ":"))
+
+
+def parse_join_snapshot(message):
+    """
+    Return the snapshot as a dict: seq and users [(user, avatar), ...],
+    plus history [(seq, time, sender, text), ...], more and rooms
+    [(room, member count), ...] when the server sent them.
+    """
+    snapshot = json.loads(message[len(JOIN_SNAPSHOT_PREFIX):])
+    snapshot["users"] = [tuple(entry) for entry in snapshot["users"]]
+    for field in ("history", "rooms"):
+        if field in snapshot:
+            snapshot[field] = [tuple(entry) for entry in snapshot[field]]
+    return snapshot
+
+
+class PresenceState:
+    """
+    Client side view of who is online, updated in place from presence
+    deltas. users is the ordered list of names, avatars maps name -> avatar.
+    """
+
+    def __init__(self, users, avatars):
+        self.users = users
+        self.avatars = avatars
+        self.seq = None
+
+    def reset(self):
+        self.seq = None
+        self.users.clear()
+        self.avatars.clear()
+
+    def apply_snapshot(self, seq, entries):
+        self.users[:] = [name for name, _ in entries]
+        self.avatars.clear()
+        self.avatars.update(entries)
+        self.seq = seq
+
+    def apply_event(self, seq, kind, name, avatar=None):
+        """
+        Apply one delta. Returns False when events were missed and the
+        caller should request a snapshot.
+        """
+        if self.seq is None:
+            # Deltas that raced ahead of our first snapshot
+            return True
+        if seq <= self.seq:
+            return True
+
+        in_order = seq == self.seq + 1
+        self.seq = seq
+
+        if kind == JOIN:
+            if name not in self.avatars:
+                self.users.append(name)
+            self.avatars[name] = avatar
+        elif kind == LEAVE:
+            if name in self.avatars:
+                del self.avatars[name]
+                self.users.remove(name)
+        elif kind == AVATAR:
+            if name in self.avatars:
+                self.avatars[name] = avatar
+
+        return in_order
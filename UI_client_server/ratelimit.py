@@ -0,0 +1,179 @@
+"""
+Admission control and per-client rate limiting.
+
+Every chat line a client sends is fanned out to everyone, so one client
+flooding the server costs N sends per message. Limits, all token buckets:
+
+- messages and bytes per connection: over the limit messages are dropped
+  (the client is told once); a client that keeps flooding is disconnected
+  (file chunks of an upload in progress are paced by the upload window
+  instead; binary frames for any other upload count as messages)
+- new connections per source address, and open connections per address
+- open connections in total
+
+Connections over a limit are refused with an error line
+"CMD:ERROR:<code>:<text>" before the handshake, so both framed and legacy
+clients can read it, and every rejection is counted by the server.
+
+Loopback addresses are exempt from the per-address limits unless
+limit_loopback is set, so local benchmarks can open thousands of clients.
+"""
+import ipaddress
+import threading
+import time
+
+from framing import ERROR_PREFIX
+
+MESSAGE_RATE = 20.0             # messages per second per connection
+MESSAGE_BURST = 50
+BYTE_RATE = 1024 * 1024         # bytes per second per connection
+BYTE_BURST = 4 * 1024 * 1024
+MAX_DROPPED = 200               # messages dropped in a row before disconnecting
+
+MAX_CONNECTIONS = 10000         # open connections in total
+MAX_PER_ADDRESS = 64            # open connections per source address
+ACCEPT_RATE = 5.0               # new connections per second per source address
+ACCEPT_BURST = 20
+MAX_TRACKED = 65536             # addresses remembered before idle ones are pruned
+
+SERVER_FULL = "server_full"
+ADDRESS_FULL = "address_full"
+CONNECT_RATE = "connect_rate"
+RATE_LIMITED = "rate_limited"
+FLOODING = "flooding"
+
+REASONS = {
+    SERVER_FULL: "The server is full, try again later.",
+    ADDRESS_FULL: "Too many connections from your address.",
+    CONNECT_RATE: "Too many connection attempts, try again in a moment.",
+    RATE_LIMITED: "You are sending messages too fast, some were dropped.",
+    FLOODING: "Disconnected for sending too many messages.",
+}
+
+
+def format_error(code):
+    return f"{ERROR_PREFIX}{code}:{REASONS[code]}"
+
+
+class TokenBucket:
+    """
+    Holds up to burst tokens, refilled at rate per second. A request larger
+    than the whole bucket is let through once it is full, leaving a debt.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic() if now is None else now
+
+    def has(self, amount, now):
+        """Whether consume(amount, now) would succeed; takes nothing."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens >= min(amount, self.burst)
+
+    def consume(self, amount=1, now=None):
+        if now is None:
+            now = time.monotonic()
+        if not self.has(amount, now):
+            return False
+        self.tokens -= amount
+        return True
+
+    def full(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class MessageLimiter:
+    """Message and byte budget of one connection. A rate of 0 disables that limit."""
+
+    __slots__ = ("messages", "bytes", "dropped")
+
+    def __init__(self, message_rate=MESSAGE_RATE, message_burst=MESSAGE_BURST,
+                 byte_rate=BYTE_RATE, byte_burst=BYTE_BURST):
+        self.messages = TokenBucket(message_rate, message_burst) if message_rate else None
+        self.bytes = TokenBucket(byte_rate, byte_burst) if byte_rate else None
+        self.dropped = 0        # messages dropped since the last one that got through
+
+    def allow(self, nbytes):
+        now = time.monotonic()
+        messages, size = self.messages, self.bytes
+        # Both budgets are checked before either is charged, so a message
+        # refused for its size costs no message token
+        if (messages is not None and not messages.has(1, now)) or (
+            size is not None and not size.has(nbytes, now)
+        ):
+            self.dropped += 1
+            return False
+        if messages is not None:
+            messages.consume(1, now)
+        if size is not None:
+            size.consume(nbytes, now)
+        self.dropped = 0
+        return True
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class AdmissionControl:
+    """
+    Decides whether to accept a new connection. admit() returns None or
+    the rejection code; every admitted connection must be released again.
+    Limits of 0 are disabled.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_per_address=MAX_PER_ADDRESS,
+                 accept_rate=ACCEPT_RATE, accept_burst=ACCEPT_BURST, limit_loopback=False):
+        self.max_connections = max_connections
+        self.max_per_address = max_per_address
+        self.accept_rate = accept_rate
+        self.accept_burst = accept_burst
+        self.limit_loopback = limit_loopback
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.addresses = {}     # host -> [open connections, TokenBucket of new connections]
+        self.prune_at = MAX_TRACKED
+
+    def admit(self, host):
+        now = time.monotonic()
+        with self.lock:
+            if self.max_connections and self.connections >= self.max_connections:
+                return SERVER_FULL
+
+            if self.limit_loopback or not is_loopback(host):
+                entry = self.addresses.get(host)
+                if entry is None:
+                    if len(self.addresses) >= self.prune_at:
+                        self._prune(now)
+                    entry = self.addresses[host] = [0, TokenBucket(self.accept_rate, self.accept_burst, now)]
+                if self.max_per_address and entry[0] >= self.max_per_address:
+                    return ADDRESS_FULL
+                if self.accept_rate and not entry[1].consume(1, now):
+                    return CONNECT_RATE
+                entry[0] += 1
+
+            self.connections += 1
+            return None
+
+    def release(self, host):
+        with self.lock:
+            self.connections -= 1
+            entry = self.addresses.get(host)
+            if entry is not None:
+                entry[0] -= 1
+
+    def _prune(self, now):
+        # Forget addresses without connections whose rate budget has fully recovered
+        self.addresses = {
+            host: entry for host, entry in self.addresses.items()
+            if entry[0] or not entry[1].full(now)
+        }
+        self.prune_at = max(MAX_TRACKED, 2 * len(self.addresses))
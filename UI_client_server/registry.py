@@ -0,0 +1,141 @@
+"""
+Thread-safe registry of logged in chat sessions.
+
+Keeps two indexes, case-folded username -> session and connection ->
+session, so joins, duplicate-name checks and private message routing are
+O(1) instead of scanning every client. Fan-out code iterates an immutable
+snapshot that is rebuilt at most once per membership change.
+
+With several server processes the registry also holds remote sessions:
+users connected to another worker, with conn set to None and node naming
+where they live. They show up in user lists but never in fan-out.
+"""
+import threading
+import time
+
+
+class Session:
+    __slots__ = ("conn", "name", "key", "avatar", "joined_at", "node")
+
+    def __init__(self, conn, name, avatar, node=None):
+        self.conn = conn
+        self.name = name
+        self.key = name_key(name)
+        self.avatar = avatar
+        self.joined_at = time.time()
+        self.node = node
+
+    @property
+    def remote(self):
+        return self.conn is None
+
+    def __repr__(self):
+        return f"Session({self.name!r}, avatar={self.avatar!r})"
+
+
+def name_key(name):
+    return name.casefold()
+
+
+class SessionRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_name = {}
+        self.by_conn = {}
+        self._snapshot = ()
+        self._everyone = ()
+        self._dirty = False
+
+    def register(self, conn, name, avatar="Boy"):
+        """Atomically claim a username. Returns the new Session, or None if taken."""
+        key = name_key(name)
+        with self.lock:
+            if key in self.by_name or conn in self.by_conn:
+                return None
+            session = Session(conn, name, avatar)
+            self.by_name[key] = session
+            self.by_conn[conn] = session
+            self._dirty = True
+            return session
+
+    def unregister(self, conn):
+        """Remove a connection's session. Returns it, or None if it was not registered."""
+        with self.lock:
+            session = self.by_conn.pop(conn, None)
+            if session is None:
+                return None
+            del self.by_name[session.key]
+            self._dirty = True
+            return session
+
+    def add_remote(self, name, avatar, node):
+        """Record a user that lives on another node. Returns None on a name clash."""
+        key = name_key(name)
+        with self.lock:
+            if key in self.by_name:
+                return None
+            session = Session(None, name, avatar, node)
+            self.by_name[key] = session
+            self._dirty = True
+            return session
+
+    def remove_remote(self, name):
+        """Forget a remote user. Returns its session, or None if unknown."""
+        key = name_key(name)
+        with self.lock:
+            session = self.by_name.get(key)
+            if session is None or not session.remote:
+                return None
+            del self.by_name[key]
+            self._dirty = True
+            return session
+
+    def remove_node(self, node):
+        """Forget every remote user of a node that went away."""
+        with self.lock:
+            gone = [s for s in self.by_name.values() if s.remote and s.node == node]
+            for session in gone:
+                del self.by_name[session.key]
+            if gone:
+                self._dirty = True
+            return gone
+
+    def find(self, name):
+        return self.by_name.get(name_key(name))
+
+    def session_for(self, conn):
+        return self.by_conn.get(conn)
+
+    def set_avatar(self, conn, avatar):
+        session = self.by_conn.get(conn)
+        if session is not None:
+            session.avatar = avatar
+        return session
+
+    def _refresh(self):
+        with self.lock:
+            if self._dirty:
+                self._snapshot = tuple(self.by_conn.values())
+                self._everyone = tuple(self.by_name.values())
+                self._dirty = False
+
+    def snapshot(self):
+        """Immutable tuple of the local sessions in join order."""
+        if self._dirty:
+            self._refresh()
+        return self._snapshot
+
+    def everyone(self):
+        """Immutable tuple of local and remote sessions, for user lists."""
+        if self._dirty:
+            self._refresh()
+        return self._everyone
+
+    def names(self):
+        return [session.name for session in self.everyone()]
+
+    def __len__(self):
+        return len(self.by_conn)
+
+    def __contains__(self, name):
+        return name_key(name) in self.by_name
@@ -0,0 +1,186 @@
+"""
+Named chat rooms.
+
+Public chat lines still go to everyone; a room message only goes to the
+members of that room. RoomIndex keeps a room -> members index (plus
+user -> rooms for logouts), and every room caches an immutable tuple of
+its local connections, rebuilt at most once per membership change, so
+fanning out a room message costs O(room size) no matter how many users
+are online.
+
+Client commands:
+
+    CMD:JOIN_ROOM:<room>
+    CMD:LEAVE_ROOM:<room>
+    CMD:ROOM:<room>:<text>
+    CMD:ROOMS                       ask for the room list
+
+Server messages for clients that negotiated the "rooms" feature:
+
+    CMD:ROOM_MSG:<room>:<sender>:<text>
+    CMD:ROOM_JOINED:<room>
+    CMD:ROOM_LEFT:<room>
+    CMD:ROOMS:<json list of [room, member count]>
+
+Other clients get "[#room] sender:text" and [System] notices instead.
+A room exists while it has members; room names are 1-32 letters, digits,
+'-' or '_' and compare case-insensitively like usernames.
+"""
+import json
+import re
+import threading
+
+from registry import name_key
+
+FEATURE_ROOMS = "rooms"
+
+JOIN_PREFIX = "CMD:JOIN_ROOM:"
+LEAVE_PREFIX = "CMD:LEAVE_ROOM:"
+SEND_PREFIX = "CMD:ROOM:"
+LIST_REQUEST = "CMD:ROOMS"
+
+MESSAGE_PREFIX = "CMD:ROOM_MSG:"
+JOINED_PREFIX = "CMD:ROOM_JOINED:"
+LEFT_PREFIX = "CMD:ROOM_LEFT:"
+LIST_PREFIX = "CMD:ROOMS:"
+
+MAX_ROOMS_PER_USER = 32
+
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
+
+def valid_room(name):
+    return ROOM_NAME.fullmatch(name) is not None
+
+
+def format_message(room, sender, text):
+    return f"{MESSAGE_PREFIX}{room}:{sender}:{text}"
+
+
+def parse_message(message):
+    """Return (room, sender, text). The text may contain ':', like a plain chat line."""
+    room, rest = message[len(MESSAGE_PREFIX):].split(":", 1)
+    sender, text = rest.split(":", 1)
+    return room, sender, text
+
+
+def format_list(rooms):
+    return LIST_PREFIX + json.dumps(rooms, separators=(",", ":"))
+
+
+def parse_list(message):
+    """Return [(room, member count), ...]."""
+    return [tuple(entry) for entry in json.loads(message[len(LIST_PREFIX):])]
+
+
+class Room:
+    __slots__ = ("name", "local", "remote", "_fanout")
+
+    def __init__(self, name):
+        self.name = name
+        self.local = {}         # name key -> Session of a member on this server
+        self.remote = set()     # name keys of members on other workers or nodes
+        self._fanout = None
+
+    def fanout(self):
+        """Immutable tuple of the local members' sessions."""
+        fanout = self._fanout
+        if fanout is None:
+            fanout = self._fanout = tuple(self.local.values())
+        return fanout
+
+    def __len__(self):
+        return len(self.local) + len(self.remote)
+
+
+class RoomIndex:
+    def __init__(self, max_rooms_per_user=MAX_ROOMS_PER_USER):
+        self.lock = threading.Lock()
+        self.rooms = {}         # room key -> Room
+        self.by_user = {}       # name key -> set of room keys
+        self.max_rooms_per_user = max_rooms_per_user
+
+    def join(self, room_name, name, session=None):
+        """
+        Add a member (local with a session, remote without).
+        Returns (room, created), or (None, False) if they were already in
+        it or are in too many rooms.
+        """
+        key = name_key(room_name)
+        user = name_key(name)
+        with self.lock:
+            joined = self.by_user.get(user, ())
+            if key in joined or (session is not None and len(joined) >= self.max_rooms_per_user):
+                return None, False
+
+            room = self.rooms.get(key)
+            created = room is None
+            if created:
+                room = self.rooms[key] = Room(room_name)
+
+            if session is not None:
+                room.local[user] = session
+                room._fanout = None
+            else:
+                room.remote.add(user)
+            self.by_user.setdefault(user, set()).add(key)
+            return room, created
+
+    def leave(self, room_name, name):
+        """Remove a member. Returns (room, removed) or (None, False) if not a member."""
+        key = name_key(room_name)
+        user = name_key(name)
+        with self.lock:
+            return self._leave(key, user)
+
+    def leave_all(self, name):
+        """Remove a user from every room (logout). Returns [(room, removed), ...]."""
+        user = name_key(name)
+        with self.lock:
+            return [self._leave(key, user) for key in list(self.by_user.get(user, ()))]
+
+    def _leave(self, key, user):
+        joined = self.by_user.get(user)
+        room = self.rooms.get(key)
+        if room is None or joined is None or key not in joined:
+            return None, False
+
+        joined.discard(key)
+        if not joined:
+            del self.by_user[user]
+        if room.local.pop(user, None) is not None:
+            room._fanout = None
+        room.remote.discard(user)
+
+        removed = not room
+        if removed:
+            del self.rooms[key]
+        return room, removed
+
+    def get(self, room_name):
+        return self.rooms.get(name_key(room_name))
+
+    def rooms_of(self, name):
+        """Names of the rooms a user is in."""
+        with self.lock:
+            rooms = [self.rooms[key] for key in self.by_user.get(name_key(name), ())]
+        return [room.name for room in rooms]
+
+    def local_memberships(self):
+        """[[room, user], ...] for every member on this server."""
+        with self.lock:
+            return [
+                [room.name, session.name]
+                for room in self.rooms.values()
+                for session in room.local.values()
+            ]
+
+    def directory(self):
+        """[[room, member count], ...] sorted by name."""
+        with self.lock:
+            rooms = [[room.name, len(room)] for room in self.rooms.values()]
+        rooms.sort(key=lambda entry: name_key(entry[0]))
+        return rooms
+
+    def __len__(self):
+        return len(self.rooms)
@@ -1,22 +1,272 @@
+import argparse
+import asyncio
+import shutil
 import socket
+import subprocess
+import sys
+import tempfile
 import threading
 import os
+import signal
 import time
 
+from framing import ERROR_PREFIX, LEGACY, FRAME_BINARY, FRAME_TEXT, FramingError, StreamDecoder, negotiate
+from presence import (
+    FEATURE_PRESENCE,
+    FEATURE_JOIN_SNAPSHOT,
+    SNAPSHOT_PREFIX,
+    JOIN_SNAPSHOT_PREFIX,
+    SYNC_REQUEST,
+    JOIN,
+    LEAVE,
+    AVATAR,
+    format_event,
+    format_join_snapshot,
+    format_snapshot
+)
+from compression import FEATURE_DEFLATE, select_codec
+from files import (
+    FEATURE_FILES,
+    OFFER_PREFIX as FILE_OFFER,
+    CANCEL_PREFIX as FILE_CANCEL,
+    ACK_PREFIX as FILE_ACK,
+    READY_PREFIX as FILE_READY,
+    ERROR_PREFIX as FILE_ERROR,
+    GET_PREFIX as FILE_GET,
+    SIZE_PREFIX as FILE_SIZE,
+    ACK_EVERY,
+    MAX_FILE_SIZE,
+    MAX_UPLOADS,
+    BlobStore,
+    format_notice as format_file_notice,
+    format_status as format_file_status,
+    human_size,
+    parse_offer,
+    send_file,
+    unpack_chunk
+)
+from registry import SessionRegistry, name_key
+from rooms import (
+    FEATURE_ROOMS,
+    JOIN_PREFIX as ROOM_JOIN,
+    LEAVE_PREFIX as ROOM_LEAVE,
+    SEND_PREFIX as ROOM_SEND,
+    LIST_REQUEST as ROOM_LIST_REQUEST,
+    LIST_PREFIX as ROOM_LIST,
+    MESSAGE_PREFIX as ROOM_MESSAGE,
+    JOINED_PREFIX,
+    LEFT_PREFIX,
+    RoomIndex,
+    format_list,
+    format_message as format_room_message,
+    valid_room
+)
+from bus import CLAIM_TIMEOUT, BusClient, BusHub
+from federation import FederationNode, parse_address
+from metrics import MetricsRegistry, serve_metrics
+from history import (
+    FEATURE_HISTORY,
+    REQUEST_PREFIX as HISTORY_REQUEST,
+    PUBLIC,
+    RING_SIZE,
+    MAX_SEGMENTS,
+    HistoryStore,
+    conversation_key,
+    format_page,
+    parse_request,
+    private_conversation
+)
+from mailboxes import FULL, MAILBOX_TTL, MAX_MAILBOX_BYTES, MailboxStore
+from heartbeat import (
+    FEATURE_HEARTBEAT,
+    PING,
+    PONG,
+    PING_INTERVAL,
+    IDLE_TIMEOUT,
+    HeartbeatMonitor,
+    enable_keepalive
+)
+from ratelimit import (
+    ACCEPT_RATE,
+    BYTE_RATE,
+    MAX_CONNECTIONS,
+    MAX_DROPPED,
+    MAX_PER_ADDRESS,
+    MESSAGE_BURST,
+    MESSAGE_RATE,
+    FLOODING,
+    RATE_LIMITED,
+    REASONS,
+    AdmissionControl,
+    MessageLimiter,
+    format_error
+)
+from tls import HANDSHAKE_TIMEOUT, TLSSocket, server_context
+from outbound import (
+    OutboundQueue,
+    frame_size,
+    HIGH_WATER,
+    LOW_WATER,
+    MAX_BATCH,
+    SLOW_CONSUMER_GRACE,
+    POLICIES,
+    flatten,
+    send_buffers
+)
+
 HOST = '0.0.0.0'
 PORT = 5000
+BACKLOG = socket.SOMAXCONN      # the kernel caps it at net.core.somaxconn
+
+SERVER_MODES = ("threaded", "async")
+SUPPORTED_FEATURES = (
+    FEATURE_PRESENCE,
+    FEATURE_JOIN_SNAPSHOT,
+    FEATURE_HISTORY,
+    FEATURE_ROOMS,
+    FEATURE_DEFLATE,
+    FEATURE_HEARTBEAT,
+    FEATURE_FILES
+)
+
+# Logged in users: name -> session and connection -> session indexes
+registry = SessionRegistry()
+
+# Room -> members and user -> rooms indexes
+rooms = RoomIndex()
+ROOM_COMMANDS = (ROOM_SEND, ROOM_JOIN, ROOM_LEAVE, ROOM_LIST_REQUEST)
+
+# Recent messages per conversation, persisted with --history-dir
+history = HistoryStore()
+HISTORY_BACKFILL = 50
+
+# Private messages for users who are offline, persisted with --mailbox-dir
+mailbox = MailboxStore()
+
+# Shared files by SHA-256, in --files-dir or a temporary directory
+blobs = None
+
+# Presence changes are numbered so clients can detect missed deltas
+presence_lock = threading.Lock()
+presence_seq = 0
+
+# Outbound queue settings applied to every new connection
+queue_settings = {
+    "high_water": HIGH_WATER,
+    "low_water": LOW_WATER,
+    "policy": "drop",
+    "grace": SLOW_CONSUMER_GRACE,
+}
+
+# Frames that jump ahead of queued chat traffic
+CONTROL_PREFIXES = ("CMD:DISCONNECT", "LIST:", SNAPSHOT_PREFIX, JOIN_SNAPSHOT_PREFIX, ROOM_LIST, PING, PONG)
 
-clients = {}
-avatars = {}
+# Only the newest queued frame of these kinds matters
+COALESCE_KEYS = {
+    "LIST:": "LIST",
+    SNAPSHOT_PREFIX: "PRESENCE_SNAPSHOT",
+    ROOM_LIST: "ROOMS",
+    PING: "PING",
+    PONG: "PONG"
+}
 
+# Per-connection message limits and who may connect at all (see ratelimit.py)
+limit_settings = {
+    "message_rate": MESSAGE_RATE,
+    "message_burst": MESSAGE_BURST,
+    "byte_rate": BYTE_RATE,
+}
+admission = AdmissionControl()
+
+# Set while the asyncio backend is running, so shutdown does not block the loop
+event_loop = None
+loop_thread_id = None
+
+# Link to the other worker processes (--workers) or federated nodes (--peers),
+# None for a single standalone process
+cluster = None
+reuse_port = False
+
+# Set by --tls-cert: clients connect over TLS (see tls.py)
+tls_context = None
+
+# Live instrumentation, exported with --metrics-port
+metrics = MetricsRegistry()
+accepted_connections = metrics.counter(
+    "chat_accepted_connections_total", "TCP connections accepted")
+open_connections = metrics.gauge(
+    "chat_open_connections", "Open client connections, logged in or not")
+messages_in = metrics.counter(
+    "chat_messages_received_total", "Messages received from clients", ("command",))
+bytes_in = metrics.counter(
+    "chat_bytes_received_total", "Payload bytes received from clients", ("command",))
+messages_out = metrics.counter(
+    "chat_messages_sent_total", "Messages queued for clients", ("kind",))
+bytes_out = metrics.counter(
+    "chat_bytes_sent_total", "Payload bytes queued for clients", ("kind",))
+send_failures = metrics.counter(
+    "chat_send_failures_total", "Sends to a client that raised", ("error",))
+handler_errors = metrics.counter(
+    "chat_handler_errors_total", "Exceptions caught while serving clients", ("where", "error"))
+mailbox_deposits = metrics.counter(
+    "chat_mailbox_deposits_total", "Private messages for offline users", ("result",))
+mailbox_delivered = metrics.counter(
+    "chat_mailbox_delivered_total", "Queued private messages delivered on login")
+rejected_connections = metrics.counter(
+    "chat_rejected_connections_total", "Connections refused by admission control", ("reason",))
+rate_limited = metrics.counter(
+    "chat_rate_limited_messages_total", "Messages over a client's rate limit", ("action",))
+file_uploads = metrics.counter(
+    "chat_file_uploads_total", "Shared files by how they were stored", ("result",))
+file_downloads = metrics.counter(
+    "chat_file_downloads_total", "File download requests", ("result",))
+file_bytes = metrics.counter(
+    "chat_file_bytes_total", "File bytes received and sent", ("direction",))
+idle_disconnects = metrics.counter(
+    "chat_idle_disconnects_total", "Connections dropped after the idle timeout")
+tls_handshakes = metrics.counter(
+    "chat_tls_handshakes_total", "Completed TLS handshakes", ("resumed",))
+broadcast_seconds = metrics.histogram(
+    "chat_broadcast_fanout_seconds", "Time to queue one broadcast for every recipient")
+
+# Children of the per-message counters, looked up once here rather than on
+# every message: incoming_command() / outgoing_kind() -> (messages, bytes)
+INCOMING_COMMANDS = (
+    "chat", "private", "avatar", "presence_sync", "history", "room", "file", "command",
+    "hello", "login", "heartbeat", "file_chunk", "file_get"
+)
+OUTGOING_KINDS = (
+    "chat", "private", "presence", "system", "history", "heartbeat", "room", "control", "login"
+)
+received_counters = {
+    command: (messages_in.labels(command), bytes_in.labels(command))
+    for command in INCOMING_COMMANDS
+}
+sent_counters = {
+    kind: (messages_out.labels(kind), bytes_out.labels(kind))
+    for kind in OUTGOING_KINDS
+}
+file_bytes_in = file_bytes.labels("in")
+file_bytes_out = file_bytes.labels("out")
+
+# Queue counters of clients that already left
+closed_queue_totals = {"sent_bytes": 0, "dropped_frames": 0}
+
+
+def start_server(mode="threaded"):
+    heartbeats.start()
+    if mode == "async":
+        asyncio.run(serve_async())
+        return
 
-def start_server():
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
     try:
         server.bind((HOST, PORT))
-        server.listen()
+        server.listen(BACKLOG)
         print(f"Server running on {HOST}:{PORT}")
     except OSError:
         print(f"Port {PORT} is busy. Close running Python processes and try again.")
@@ -25,69 +275,565 @@ def start_server():
     while True:
         try:
             client_socket, addr = server.accept()
-            threading.Thread(
-                target=handle_client,
-                args=(client_socket,),
-                daemon=True
-            ).start()
         except Exception:
             break
+        accept_client(client_socket, addr[0])
+
+
+def accept_client(client_socket, host):
+    """Admit a fresh connection and start its reader thread."""
+    accepted_connections.inc()
+    reason = admission.admit(host)
+    if reason is not None:
+        reject_connection(client_socket, reason)
+        return
+
+    conn = None
+    try:
+        enable_keepalive(client_socket, heartbeats.interval, heartbeats.timeout)
+        if tls_context is not None:
+            client_socket = TLSSocket(client_socket, tls_context, server_side=True)
+        conn = ThreadedConnection(client_socket, host)
+        threading.Thread(target=handle_client, args=(conn,), daemon=True).start()
+    except Exception as e:
+        # Only this client is lost; the server keeps accepting
+        handler_errors.labels("accept", type(e).__name__).inc()
+        if conn is not None:
+            remove_client(conn)
+            conn.close()
+        else:
+            admission.release(host)
+            client_socket.close()
+
+
+def reject_connection(sock, reason):
+    """Refuse a fresh connection with an error line, without spending a thread on it."""
+    rejected_connections.labels(reason).inc()
+    # A TLS client could not read the line before the handshake
+    if tls_context is None:
+        try:
+            sock.setblocking(False)
+            sock.send(f"{format_error(reason)}\n".encode())
+        except OSError:
+            pass
+    sock.close()
 
 
 def handle_client(client_socket):
+    client_socket.reader_id = threading.get_ident()
     try:
-        data = client_socket.recv(1024).decode()
+        if tls_context is not None:
+            client_socket.start_tls()
+
+        while True:
+            if not client_socket.recv_into_decoder():
+                break
+
+            for frame_type, payload in client_socket.decoder.messages():
+                if not handle_frame(client_socket, frame_type, payload):
+                    return
+
+    except Exception as e:
+        handler_errors.labels("handle_client", type(e).__name__).inc()
+    finally:
+        remove_client(client_socket)
+
 
+def handle_frame(sock, frame_type, payload):
+    """Handle one incoming message. Returns False once reading should stop."""
+    if frame_type == FRAME_BINARY:
+        # Chunks of an upload in progress are paced by the upload window,
+        # any other binary frame counts against the limits like a message
+        count_received("file_chunk", len(payload))
+        if receive_file_chunk(sock, payload) or sock.limiter.allow(len(payload)):
+            return True
+        return throttle(sock)
+
+    if not sock.limiter.allow(len(payload)):
+        return throttle(sock)
+
+    frame_type, payload = sock.codec.decode(frame_type, payload)
+    if frame_type != FRAME_TEXT:
+        return True
+
+    text = payload.decode(errors="replace")
+
+    # Receiving anything already refreshed the connection's last_seen
+    if text in (PING, PONG):
+        count_received("heartbeat", len(payload))
+        if text == PING:
+            send_packet(sock, PONG)
+        return True
+
+    if sock.username is None:
         # Emergency shutdown command
-        if "!!KILL_SERVER!!" in data:
-            broadcast_packet("CMD:DISCONNECT:Server has been closed by the host.")
-            time.sleep(1)
-            os._exit(0)
-            return
+        if "!!KILL_SERVER!!" in text:
+            shutdown_server()
+            return False
+
+        # Only the very first line may open the framed protocol
+        if not sock.handshake_done:
+            sock.handshake_done = True
+            if text.startswith(FILE_GET):
+                count_received("file_get", len(payload))
+                serve_file(sock, text[len(FILE_GET):].strip())
+                return False
+
+            handshake = negotiate(text.strip(), SUPPORTED_FEATURES)
+            count_received("hello" if handshake else "login", len(payload))
+            if handshake:
+                reply, codec, features = handshake
+                send_packet(sock, reply, control=True)
+                sock.codec = select_codec(codec, features)
+                sock.features = features
+                sock.decoder.framed = codec.framed
+                return True
 
-        if "\n" in data:
-            username = data.split("\n")[0].strip()
-            rest = data.split("\n", 1)[1]
         else:
-            username = data.strip()
-            rest = ""
+            count_received("login", len(payload))
 
-        if not username or any(username.lower() == name.lower() for name in clients.values()):
-            client_socket.send("Error\n".encode())
-            client_socket.close()
+        username = text.strip()
+        if cluster is not None and username:
+            return claim_username(sock, username)
+        return finish_login(sock, username)
+
+    count_received(incoming_command(text), len(payload))
+    process_message(sock, sock.username, text)
+    return True
+
+
+def throttle(sock):
+    """Drop a message over the client's limit; disconnect clients that keep flooding."""
+    if sock.limiter.dropped >= MAX_DROPPED:
+        rate_limited.labels("disconnected").inc()
+        send_packet(sock, f"CMD:DISCONNECT:{REASONS[FLOODING]}")
+        sock.close()
+        return False
+
+    rate_limited.labels("dropped").inc()
+    if sock.limiter.dropped == 1:
+        send_packet(sock, f"[System] {REASONS[RATE_LIMITED]}", control=True)
+    return True
+
+
+def incoming_command(text):
+    if text.startswith("to:"):
+        return "private"
+    if text.startswith("CMD:AVATAR:"):
+        return "avatar"
+    if text.startswith(SYNC_REQUEST):
+        return "presence_sync"
+    if text.startswith(HISTORY_REQUEST):
+        return "history"
+    if text.startswith(ROOM_SEND):
+        return "room"
+    if text.startswith((FILE_OFFER, FILE_CANCEL)):
+        return "file"
+    if text.startswith("CMD:") or "!!KILL_SERVER!!" in text:
+        return "command"
+    return "chat"
+
+
+def count_received(command, nbytes):
+    messages, size = received_counters[command]
+    messages.inc()
+    size.inc(nbytes)
+
+
+def finish_login(sock, username):
+    if not register_client(sock, username):
+        return False
+    sock.username = username
+    return True
+
+
+def claim_username(sock, username):
+    """Reserve the name on every worker before registering it here."""
+    future = cluster.claim(username)
+    if event_loop is None:
+        try:
+            future.result(timeout=CLAIM_TIMEOUT)
+        except Exception:
+            # Timed out: give up (the bus client releases a late grant)
+            future.cancel()
+        return login_claimed(sock, username, claim_result(future))
+
+    # Never block the event loop: reading resumes once the hub answers,
+    # or the claim is given up after CLAIM_TIMEOUT
+    sock.claim_timer = event_loop.call_later(CLAIM_TIMEOUT, future.cancel)
+    future.add_done_callback(
+        lambda f: event_loop.call_soon_threadsafe(sock.claim_answered, username, f)
+    )
+    return False
+
+
+def claim_result(future):
+    """Whether a finished claim was granted; False if refused, failed or given up."""
+    if future.cancelled() or future.exception() is not None:
+        return False
+    return future.result()
+
+
+def login_claimed(sock, username, claimed):
+    if not claimed:
+        send_packet(sock, "Error", control=True)
+        sock.close()
+        return False
+    if finish_login(sock, username):
+        return True
+    cluster.release(username)
+    return False
+
+
+class ThreadedConnection:
+    """
+    Blocking client socket with its own outbound queue and writer thread.
+    Reads happen on the handle_client thread, writes only on the writer.
+    """
+
+    def __init__(self, sock, address=None):
+        self.sock = sock
+        self.address = address
+        self.username = None
+        self.codec = LEGACY
+        self.features = set()
+        self.handshake_done = False
+        self.decoder = StreamDecoder()
+        self.queue = OutboundQueue(**queue_settings)
+        self.limiter = MessageLimiter(**limit_settings)
+        self.uploads = {}
+        self.reader_id = None       # thread running handle_client for this connection
+        open_connections.inc()
+        heartbeats.watch(self)
+        threading.Thread(target=self.writer_loop, daemon=True).start()
+
+    def start_tls(self):
+        # On the reader thread, and bounded so a silent client cannot hold it
+        self.sock.settimeout(HANDSHAKE_TIMEOUT)
+        self.sock.do_handshake()
+        self.sock.settimeout(None)
+        tls_handshakes.labels(str(self.sock.session_reused).lower()).inc()
+
+    def recv_into_decoder(self):
+        nbytes = self.decoder.recv_into(self.sock)
+        self.last_seen = time.monotonic()
+        return nbytes
+
+    def send(self, data, control=False, key=None):
+        # Only this client's own reader waits out a burst; a broadcast from
+        # another client's thread must not stall on one slow recipient
+        block = threading.get_ident() == self.reader_id
+        if not self.queue.put(data, control, key, block=block) and self.queue.evict:
+            self.abort()
+        return len(data)
+
+    def writer_loop(self):
+        try:
+            while True:
+                batch = self.queue.take()
+                if not batch:
+                    break
+                send_buffers(self.sock, flatten(batch))
+        except OSError:
+            self.queue.clear()
+        finally:
+            self.abort()
+            self.sock.close()
+
+    def abort(self):
+        # Wakes up the reader blocked in recv(), which then removes the client
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_file(self, header, f, size):
+        # Only used on a fresh transfer connection, so the writer has nothing queued
+        try:
+            self.sock.sendall(header)
+            send_file(self.sock, f, size)
+        finally:
+            f.close()
+            self.close()
+
+    def close(self):
+        # The writer flushes what is queued, then closes the socket
+        self.queue.close()
+
+
+class AsyncClientProtocol(asyncio.BufferedProtocol):
+    """
+    Event-loop counterpart of handle_client.
+    Exposes send()/close() like a socket, so the shared helpers below
+    (process_message, broadcast_packet, remove_client) work unchanged.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.address = None
+        self.username = None
+        self.codec = LEGACY
+        self.features = set()
+        self.handshake_done = False
+        self.decoder = StreamDecoder()
+        self.queue = OutboundQueue(**queue_settings)
+        self.limiter = MessageLimiter(**limit_settings)
+        self.uploads = {}
+        self.flush_scheduled = False
+        self.paused = False
+        self.stalled = None
+        self.claim_timer = None     # gives up on a name claim the hub does not answer
+
+    def connection_made(self, transport):
+        self.transport = transport
+        accepted_connections.inc()
+        open_connections.inc()
+        tls = transport.get_extra_info("ssl_object")
+        if tls is not None:
+            tls_handshakes.labels(str(tls.session_reused).lower()).inc()
+        enable_keepalive(transport.get_extra_info("socket"), heartbeats.interval, heartbeats.timeout)
+        heartbeats.watch(self)
+
+        # connection_lost still runs for a refused connection, hence after the bookkeeping above
+        host = transport.get_extra_info("peername")[0]
+        reason = admission.admit(host)
+        if reason is not None:
+            rejected_connections.labels(reason).inc()
+            transport.write(f"{format_error(reason)}\n".encode())
+            transport.close()
             return
+        self.address = host
+        # Keep the transport buffer small so backlog builds up in our queue,
+        # where the slow consumer policy applies
+        transport.set_write_buffer_limits(high=LOW_WATER)
 
-        clients[client_socket] = username
-        avatars[username] = "Boy"
+    def get_buffer(self, sizehint):
+        # The loop reads straight into the decoder's preallocated buffer
+        return self.decoder.get_buffer(sizehint)
 
-        send_packet(client_socket, f"Welcome {username}!")
-        broadcast_packet(f"[System] {username} joined!", exclude=client_socket)
-        send_user_list()
+    def buffer_updated(self, nbytes):
+        self.last_seen = time.monotonic()
+        self.decoder.buffer_updated(nbytes)
+        self.process(self.decoder.messages())
 
-        # Send existing avatars to the new client
-        for user, avatar in avatars.items():
-            if user != username:
-                send_packet(client_socket, f"CMD:UPDATE_AVATAR:{user}:{avatar}")
+    def process(self, messages):
+        try:
+            for frame_type, payload in messages:
+                if not handle_frame(self, frame_type, payload):
+                    self.transport.pause_reading()
+                    # Kept so a pending name claim can continue where we stopped
+                    self.stalled = messages
+                    return
+        except FramingError:
+            handler_errors.labels("decoder", "FramingError").inc()
+            self.transport.abort()
 
-        if rest.strip():
-            process_message(client_socket, username, rest)
+    def claim_answered(self, username, future):
+        self.claim_timer.cancel()
+        claimed = claim_result(future)
+        if self.transport.is_closing():
+            if claimed:
+                cluster.release(username)
+            return
+        if login_claimed(self, username, claimed):
+            messages, self.stalled = self.stalled, None
+            self.transport.resume_reading()
+            self.process(messages)
 
-        while True:
-            data = client_socket.recv(1024).decode()
-            if not data:
+    def connection_lost(self, exc):
+        self.queue.clear()
+        remove_client(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def send(self, data, control=False, key=None):
+        # May be called from any thread; the loop does the actual writing
+        if self.queue.put(data, control, key):
+            if self.queue.queued_bytes >= MAX_BATCH and threading.get_ident() == loop_thread_id:
+                # A long burst from one reader must not starve the writer
+                self.flush()
+            elif not self.flush_scheduled:
+                self.flush_scheduled = True
+                event_loop.call_soon_threadsafe(self.flush)
+        elif self.queue.evict:
+            self.abort()
+        return len(data)
+
+    def flush(self):
+        self.flush_scheduled = False
+        while not self.paused and not self.transport.is_closing():
+            batch = self.queue.take(block=False)
+            if not batch:
                 break
+            self.transport.writelines(flatten(batch))
 
-            while "\n" in data:
-                message, data = data.split("\n", 1)
-                process_message(client_socket, username, message)
+        if self.queue.closed and not self.queue and not self.transport.is_closing():
+            self.transport.close()
 
-            if data.strip():
-                process_message(client_socket, username, data)
+    def abort(self):
+        event_loop.call_soon_threadsafe(self.transport.abort)
 
-    except Exception:
-        pass
-    finally:
-        remove_client(client_socket)
+    def send_file(self, header, f, size):
+        event_loop.create_task(self.stream_file(header, f, size))
+
+    async def stream_file(self, header, f, size):
+        # loop.sendfile() uses os.sendfile, or reads and writes over TLS
+        try:
+            self.transport.write(header)
+            if size:
+                await event_loop.sendfile(self.transport, f, 0, size)
+        except Exception as e:
+            handler_errors.labels("sendfile", type(e).__name__).inc()
+        finally:
+            f.close()
+            self.transport.close()
+
+    def close(self):
+        self.queue.close()
+        event_loop.call_soon_threadsafe(self.flush)
+
+
+async def serve_async():
+    global event_loop, loop_thread_id
+    event_loop = asyncio.get_running_loop()
+    loop_thread_id = threading.get_ident()
+
+    try:
+        server = await event_loop.create_server(
+            AsyncClientProtocol,
+            HOST,
+            PORT,
+            reuse_address=True,
+            reuse_port=reuse_port or None,
+            backlog=BACKLOG,
+            ssl=tls_context,
+            ssl_handshake_timeout=HANDSHAKE_TIMEOUT if tls_context else None
+        )
+        print(f"Server running on {HOST}:{PORT} (async)")
+    except OSError:
+        print(f"Port {PORT} is busy. Close running Python processes and try again.")
+        return
+
+    async with server:
+        await server.serve_forever()
+
+
+def queue_stats():
+    return {session.name: session.conn.queue.stats() for session in registry.snapshot()}
+
+
+def dump_queue_stats(*_):
+    for name, stats in queue_stats().items():
+        print(
+            f"[QUEUE] {name}: depth={stats['depth']} bytes={stats['queued_bytes']} "
+            f"dropped={stats['dropped_frames']} congested={stats['congested']}",
+            flush=True
+        )
+
+
+def register_client(sock, username):
+    session = registry.register(sock, username) if username else None
+    if session is None:
+        send_packet(sock, "Error", control=True)
+        sock.close()
+        return False
+
+    # The handshake reply must reach the client before any queued LIST
+    send_packet(sock, f"Welcome {username}!", control=True)
+    broadcast_packet(f"[System] {username} joined!", exclude=sock)
+
+    snapshot = FEATURE_JOIN_SNAPSHOT in sock.features
+    if snapshot:
+        # Users, history and rooms go out as one frame; the slow parts are
+        # read here, outside the presence lock
+        extras = {}
+        if FEATURE_HISTORY in sock.features:
+            extras["history"], extras["more"] = history.page(
+                conversation_key(username, PUBLIC), 0, HISTORY_BACKFILL
+            )
+        if FEATURE_ROOMS in sock.features:
+            extras["rooms"] = rooms.directory()
+        publish_presence(JOIN, session, join_extras=extras)
+    else:
+        publish_presence(JOIN, session)
+
+    if FEATURE_HISTORY in sock.features and not snapshot:
+        send_history_page(sock, username, PUBLIC, 0, HISTORY_BACKFILL)
+
+    if mailbox.pending(username):
+        start_mailbox_delivery(sock, username)
+
+    if FEATURE_PRESENCE not in sock.features and not snapshot:
+        # Existing avatars for the new client, as one write
+        send_batch(sock, [
+            f"CMD:UPDATE_AVATAR:{other.name}:{other.avatar}"
+            for other in registry.everyone() if other.conn is not sock
+        ])
+
+    if FEATURE_ROOMS in sock.features and len(rooms) and not snapshot:
+        send_packet(sock, format_list(rooms.directory()))
+
+    return True
+
+
+def publish_presence(kind, session, join_extras=None):
+    """
+    Announce a join, leave or avatar change.
+    Clients that negotiated presence deltas get one numbered event (the
+    joining client gets a full snapshot instead), older clients get the
+    full LIST: or a CMD:UPDATE_AVATAR: frame. With join_extras (history
+    and rooms) the joining client gets a join snapshot. Changes of local
+    users are also passed on to the other workers.
+    """
+    global presence_seq
+
+    if cluster is not None and not session.remote:
+        cluster.publish("presence", kind=kind, name=session.name, avatar=session.avatar)
+
+    with presence_lock:
+        presence_seq += 1
+        event = Packet(format_event(presence_seq, kind, session.name, session.avatar))
+        avatar_update = Packet(f"CMD:UPDATE_AVATAR:{session.name}:{session.avatar}")
+        everyone = registry.everyone()
+        user_list = None
+
+        for other in registry.snapshot():
+            conn = other.conn
+            if join_extras is not None and other is session:
+                send_packet(conn, format_join_snapshot(presence_seq, everyone, **join_extras))
+            elif FEATURE_PRESENCE in conn.features:
+                if kind == JOIN and other is session:
+                    send_packet(conn, format_snapshot(presence_seq, everyone))
+                else:
+                    send_packet(conn, event)
+            elif kind == AVATAR:
+                send_packet(conn, avatar_update)
+            else:
+                if user_list is None:
+                    user_list = Packet("LIST:" + ",".join(s.name for s in everyone))
+                send_packet(conn, user_list)
+
+
+def send_presence_snapshot(sock):
+    with presence_lock:
+        send_packet(sock, format_snapshot(presence_seq, registry.everyone()))
+
+
+def shutdown_server(propagate=True):
+    if cluster is not None and propagate:
+        cluster.publish("shutdown")
+    broadcast_packet("CMD:DISCONNECT:Server has been closed by the host.")
+    if event_loop is not None:
+        # Let the loop flush the disconnect notices before exiting
+        event_loop.call_later(1, os._exit, 0)
+        return
+    time.sleep(1)
+    os._exit(0)
 
 
 def process_message(sock, username, msg):
@@ -97,22 +843,278 @@ def process_message(sock, username, msg):
 
     # Backup shutdown command
     if "!!KILL_SERVER!!" in msg:
-        broadcast_packet("CMD:DISCONNECT:Server has been closed by the host.")
-        time.sleep(1)
-        os._exit(0)
+        shutdown_server()
         return
 
     if msg.startswith("CMD:AVATAR:"):
         new_avatar = msg.split("CMD:AVATAR:")[-1].strip()
-        avatars[username] = new_avatar
-        broadcast_packet(f"CMD:UPDATE_AVATAR:{username}:{new_avatar}")
+        session = registry.set_avatar(sock, new_avatar)
+        if session is not None:
+            publish_presence(AVATAR, session)
+        return
+
+    if msg == SYNC_REQUEST:
+        send_presence_snapshot(sock)
+        return
+
+    if msg.startswith(HISTORY_REQUEST):
+        try:
+            conversation, before, limit = parse_request(msg)
+        except ValueError:
+            return
+        send_history_page(sock, username, conversation, before, limit)
+        return
+
+    if msg.startswith(ROOM_COMMANDS):
+        handle_room_command(sock, username, msg)
+        return
+
+    if msg.startswith(FILE_OFFER):
+        handle_file_offer(sock, username, msg)
+        return
+
+    if msg.startswith(FILE_CANCEL):
+        try:
+            upload = sock.uploads.pop(int(msg[len(FILE_CANCEL):]), None)
+        except ValueError:
+            return
+        if upload is not None:
+            upload.abort()
+            file_uploads.labels("cancelled").inc()
         return
 
     if msg.startswith("to:"):
         handle_private_message(sock, username, msg)
         return
 
+    history.append(PUBLIC, username, msg)
     broadcast_packet(f"{username}:{msg}", exclude=sock)
+    if cluster is not None:
+        cluster.publish("broadcast", message=f"{username}:{msg}", sender=username, text=msg)
+
+
+def send_history_page(sock, username, conversation, before, limit):
+    messages, more = history.page(conversation_key(username, conversation), before, limit)
+    send_packet(sock, format_page(conversation, messages, more))
+
+
+def handle_room_command(sock, username, msg):
+    if msg == ROOM_LIST_REQUEST:
+        send_packet(sock, format_list(rooms.directory()))
+    elif msg.startswith(ROOM_SEND):
+        room_name, sep, text = msg[len(ROOM_SEND):].partition(":")
+        if sep and text.strip():
+            send_room_message(sock, username, room_name, text)
+    elif msg.startswith(ROOM_JOIN):
+        join_room(sock, username, msg[len(ROOM_JOIN):].strip())
+    elif msg.startswith(ROOM_LEAVE):
+        leave_room(sock, username, msg[len(ROOM_LEAVE):].strip())
+
+
+def join_room(sock, username, room_name):
+    if not valid_room(room_name):
+        send_packet(sock, f"[System] Invalid room name: {room_name}")
+        return
+
+    room, created = rooms.join(room_name, username, registry.session_for(sock))
+    if room is None:
+        room = rooms.get(room_name)
+        if room is not None and name_key(username) in room.local:
+            send_room_ack(sock, JOINED_PREFIX, "joined", room.name)
+        else:
+            send_packet(sock, "[System] You are in too many rooms.")
+        return
+
+    if cluster is not None:
+        cluster.publish("room", kind=JOIN, room=room.name, name=username)
+
+    send_room_ack(sock, JOINED_PREFIX, "joined", room.name)
+    room_broadcast(room, f"[System] {username} joined #{room.name}.", exclude=sock)
+    publish_room_list(room, created)
+
+
+def leave_room(sock, username, room_name):
+    room, removed = rooms.leave(room_name, username)
+    if room is None:
+        send_packet(sock, f"[System] You are not in #{room_name}.")
+        return
+
+    if cluster is not None:
+        cluster.publish("room", kind=LEAVE, room=room.name, name=username)
+
+    send_room_ack(sock, LEFT_PREFIX, "left", room.name)
+    room_broadcast(room, f"[System] {username} left #{room.name}.")
+    publish_room_list(room, removed)
+    if not removed and FEATURE_ROOMS in sock.features:
+        send_packet(sock, format_list(rooms.directory()))
+
+
+def send_room_ack(sock, prefix, verb, room_name):
+    if FEATURE_ROOMS in sock.features:
+        send_packet(sock, f"{prefix}{room_name}", control=True)
+    else:
+        send_packet(sock, f"[System] You {verb} #{room_name}.")
+
+
+def send_room_message(sock, username, room_name, text):
+    room = rooms.get(room_name)
+    if room is None or name_key(username) not in room.local:
+        send_packet(sock, f"[System] You are not in #{room_name}.")
+        return
+
+    room_broadcast(room, username=username, text=text, exclude=sock)
+    if cluster is not None:
+        cluster.publish("room_message", room=room.name, sender=username, text=text)
+
+
+def publish_room_list(room, everyone):
+    """
+    Send the new room list. A room that appeared or disappeared concerns
+    everyone; a member count change only the members of that room.
+    """
+    packet = Packet(format_list(rooms.directory()))
+    for session in registry.snapshot() if everyone else room.fanout():
+        if FEATURE_ROOMS in session.conn.features:
+            send_packet(session.conn, packet)
+
+
+def handle_file_offer(sock, username, msg):
+    try:
+        offer = parse_offer(msg)
+    except ValueError:
+        send_packet(sock, "[System] Invalid file offer.")
+        return
+
+    upload_id, target = offer["id"], offer["to"]
+    error = None
+    if blobs is None or FEATURE_FILES not in sock.features:
+        error = "File sharing is not available on this server."
+    elif not 0 < offer["size"] <= MAX_FILE_SIZE:
+        error = f"Files must be between 1 byte and {human_size(MAX_FILE_SIZE)}."
+    elif upload_id in sock.uploads or len(sock.uploads) >= MAX_UPLOADS:
+        error = f"At most {MAX_UPLOADS} uploads at a time."
+    else:
+        error = check_file_target(username, target)
+    if error is not None:
+        file_uploads.labels("refused").inc()
+        send_packet(sock, format_file_status(FILE_ERROR, upload_id, error), control=True)
+        return
+
+    # Content addressed: a file the store already has needs no upload
+    if blobs.has(offer["sha256"]):
+        file_uploads.labels("deduplicated").inc()
+        send_packet(sock, format_file_status(FILE_READY, upload_id, offer["sha256"]), control=True)
+        share_file(username, offer)
+        return
+
+    try:
+        sock.uploads[upload_id] = blobs.begin(offer)
+    except OSError:
+        send_packet(sock, format_file_status(FILE_ERROR, upload_id, "The server cannot store files."), control=True)
+        return
+    send_packet(sock, format_file_status(FILE_ACK, upload_id, 0), control=True)
+
+
+def check_file_target(username, target):
+    """None if username may share a file with target, else the reason why not."""
+    # Workers share one file store, federated nodes do not: a file only
+    # goes to users on this node
+    federated = isinstance(cluster, FederationNode)
+    if target == PUBLIC:
+        if federated:
+            return "Files can only be shared with rooms or users on this server."
+        return None
+    if target.startswith("@"):
+        session = registry.find(target[1:])
+        if session is None:
+            return f"{target[1:]} is offline."
+        if session.remote and federated:
+            return f"{session.name} is on another server."
+        return None
+    if target.startswith("#"):
+        room = rooms.get(target[1:])
+        if room is None or name_key(username) not in room.local:
+            return f"You are not in {target}."
+        if room.remote and federated:
+            return f"{target} has members on other servers."
+        return None
+    return "Unknown recipient."
+
+
+def receive_file_chunk(sock, payload):
+    """Store one chunk; False if it is not part of an upload in progress."""
+    try:
+        upload_id, data = unpack_chunk(payload)
+    except ValueError:
+        return False
+    upload = sock.uploads.get(upload_id)
+    if upload is None:
+        # Cancelled or failed already (the rest of the window is still
+        # arriving), or never offered
+        return False
+
+    try:
+        upload.write(data)
+        file_bytes_in.inc(len(data))
+        if upload.complete:
+            del sock.uploads[upload_id]
+            upload.finish()
+    except (ValueError, OSError) as e:
+        sock.uploads.pop(upload_id, None)
+        upload.abort()
+        file_uploads.labels("failed").inc()
+        reason = str(e) if isinstance(e, ValueError) else "The server cannot store files."
+        send_packet(sock, format_file_status(FILE_ERROR, upload_id, reason), control=True)
+        return True
+
+    if upload.complete:
+        file_uploads.labels("stored").inc()
+        send_packet(sock, format_file_status(FILE_READY, upload_id, upload.offer["sha256"]), control=True)
+        share_file(sock.username, upload.offer)
+    elif upload.received - upload.acked >= ACK_EVERY:
+        upload.acked = upload.received
+        send_packet(sock, format_file_status(FILE_ACK, upload_id, upload.received), control=True)
+    return True
+
+
+def share_file(sender, offer, relay=True):
+    """Tell the recipients on this server about a stored file (and the other workers)."""
+    target = offer["to"]
+    if target == PUBLIC:
+        recipients = registry.snapshot()
+    elif target.startswith("#"):
+        room = rooms.get(target[1:])
+        recipients = room.fanout() if room is not None else ()
+    else:
+        session = registry.find(target[1:])
+        recipients = (session,) if session is not None and not session.remote else ()
+
+    rich = Packet(format_file_notice(offer["sha256"], offer["name"], offer["size"], sender, target))
+    plain = Packet(f"[System] {sender} shared {offer['name']} ({human_size(offer['size'])}).")
+    sender_key = name_key(sender)
+    for session in recipients:
+        if name_key(session.name) != sender_key:
+            send_packet(session.conn, rich if FEATURE_FILES in session.conn.features else plain)
+
+    if relay and cluster is not None:
+        cluster.publish("file", sender=sender, offer=offer)
+
+
+def serve_file(sock, digest):
+    """A transfer connection asked for a file: send it and close."""
+    # The client only listens from now on, which must not look like a dead connection
+    heartbeats.forget(sock)
+    f = blobs.open(digest) if blobs is not None else None
+    if f is None:
+        file_downloads.labels("not_found").inc()
+        send_packet(sock, f"{ERROR_PREFIX}not_found:File not found.", control=True)
+        sock.close()
+        return
+
+    size = os.fstat(f.fileno()).st_size
+    file_downloads.labels("sent").inc()
+    file_bytes_out.inc(size)
+    sock.send_file(f"{FILE_SIZE}{size}\n".encode(), f, size)
 
 
 def handle_private_message(sender_sock, sender_name, msg):
@@ -124,49 +1126,734 @@ def handle_private_message(sender_sock, sender_name, msg):
         target = parts[0][3:]
         content = parts[1]
 
-        for sock, name in clients.items():
-            if name == target:
-                send_packet(sock, f"{sender_name}:{content} (Private)")
-                return
+        session = registry.find(target)
+        if session is not None:
+            history.append(private_conversation(sender_name, session.name), sender_name, content)
+            if session.remote:
+                # Only the worker that owns the user gets the message
+                cluster.publish("private", sender=sender_name, target=session.name, message=content)
+            else:
+                send_packet(session.conn, f"{sender_name}:{content} (Private)")
+            return
 
-        send_packet(sender_sock, f"[System] User {target} not found.")
+        deposit_private(sender_sock, sender_name, target, content)
 
-    except Exception:
-        pass
+    except Exception as e:
+        handler_errors.labels("handle_private_message", type(e).__name__).inc()
 
 
-def send_packet(sock, message):
+def deposit_private(sender_sock, sender_name, target, content):
+    """Keep a private message for a user who is not logged in anywhere."""
+    result = mailbox.deposit(target, sender_name, content)
+    mailbox_deposits.labels(result).inc()
+    if result == FULL:
+        send_packet(sender_sock, f"[System] The mailbox of {target} is full, message not delivered.")
+        return
+
+    history.append(private_conversation(sender_name, target), sender_name, content)
+    send_packet(sender_sock, f"[System] {target} is offline, the message will be delivered at their next login.")
+
+    # They may have logged in while the message was being stored
+    session = registry.find(target)
+    if session is not None and not session.remote:
+        start_mailbox_delivery(session.conn, session.name)
+
+
+def start_mailbox_delivery(sock, username):
+    # Reading a big mailbox must hold up neither the login nor the event loop
+    threading.Thread(target=deliver_mailbox, args=(sock, username), daemon=True).start()
+
+
+def deliver_mailbox(sock, username):
+    codec = sock.codec
+
+    def send_batch(records):
+        if sock.queue.closed:
+            return False
+        frames = b"".join(
+            codec.encode(f"{sender}:{text} (Private)") for _, sender, text in records
+        )
+        # One queued write per batch. The control lane never drops it, and
+        # the mailbox size limit bounds how much can pile up there.
+        sock.send(frames, control=True)
+        count_sent("private", len(records), len(frames))
+        return True
+
     try:
-        sock.send(f"{message}\n".encode())
-    except Exception:
-        pass
+        count = mailbox.deliver(username, send_batch)
+    except Exception as e:
+        handler_errors.labels("deliver_mailbox", type(e).__name__).inc()
+        return
+
+    if count:
+        mailbox_delivered.inc(count)
+        send_packet(sock, f"[System] Private messages received while you were offline: {count}.")
+
+
+class Packet:
+    """
+    One outgoing message, encoded at most once per wire codec.
+    A broadcast shares the same frame bytes with every recipient's queue.
+    """
+
+    __slots__ = ("message", "control", "key", "frames", "kind")
+
+    def __init__(self, message, control=None):
+        if control is None:
+            control = message.startswith(CONTROL_PREFIXES)
+
+        self.message = message
+        self.control = control
+        self.key = None
+        self.frames = {}
+        self.kind = outgoing_kind(message)
+
+        if control:
+            for prefix, coalesce_key in COALESCE_KEYS.items():
+                if message.startswith(prefix):
+                    self.key = coalesce_key
+                    break
+
+    def frame_for(self, codec):
+        frame = self.frames.get(codec)
+        if frame is None:
+            frame = self.frames[codec] = codec.encode_shared(self.message)
+        return frame
+
+
+def outgoing_kind(message):
+    if message.startswith(("CMD:PRESENCE", "LIST:", "CMD:UPDATE_AVATAR:")):
+        return "presence"
+    if message.startswith("[System]"):
+        return "system"
+    if message.startswith("CMD:HISTORY_PAGE:"):
+        return "history"
+    if message in (PING, PONG):
+        return "heartbeat"
+    if message.startswith((ROOM_MESSAGE, "[#")):
+        return "room"
+    if message.startswith("CMD:"):
+        return "control"
+    if message.startswith(("Welcome ", "Error")):
+        return "login"
+    if message.endswith(" (Private)"):
+        return "private"
+    return "chat"
+
+
+def count_sent(kind, count, nbytes):
+    messages, size = sent_counters[kind]
+    messages.inc(count)
+    size.inc(nbytes)
+
+
+def send_packet(sock, message, control=None):
+    packet = message if isinstance(message, Packet) else Packet(message, control)
+    try:
+        frame = packet.frame_for(sock.codec)
+        sock.send(frame, packet.control, packet.key)
+        count_sent(packet.kind, 1, frame_size(frame))
+    except Exception as e:
+        send_failures.labels(type(e).__name__).inc()
+
+
+def send_batch(sock, messages):
+    """Several messages to one client as a single queued write."""
+    if not messages:
+        return
+    kind = outgoing_kind(messages[0])
+    try:
+        frame = b"".join(sock.codec.encode(message) for message in messages)
+        sock.send(frame, False, None)
+        count_sent(kind, len(messages), len(frame))
+    except Exception as e:
+        send_failures.labels(type(e).__name__).inc()
 
 
 def broadcast_packet(message, exclude=None):
-    for sock in list(clients.keys()):
-        if sock != exclude:
-            send_packet(sock, message)
+    started = time.perf_counter()
+    packet = Packet(message)
+    frames = packet.frames
+    control = packet.control
+    key = packet.key
+    frame = None
+    sent = 0
 
+    # Hot loop: the frame lookup and send are inlined from send_packet
+    for session in registry.snapshot():
+        conn = session.conn
+        if conn is exclude:
+            continue
+        frame = frames.get(conn.codec) or packet.frame_for(conn.codec)
+        try:
+            conn.send(frame, control, key)
+            sent += 1
+        except Exception as e:
+            send_failures.labels(type(e).__name__).inc()
 
-def send_user_list():
-    users = ",".join(clients.values())
-    broadcast_packet(f"LIST:{users}")
+    if sent:
+        count_sent(packet.kind, sent, sent * frame_size(frame))
+    broadcast_seconds.observe(time.perf_counter() - started)
 
 
-def remove_client(sock):
-    if sock in clients:
-        name = clients[sock]
-        del clients[sock]
-        avatars.pop(name, None)
+def room_broadcast(room, notice=None, username=None, text=None, exclude=None):
+    """
+    Fan a chat line (username and text) or a [System] notice out to the
+    room's members on this server. Costs O(room size), not O(users online).
+    """
+    started = time.perf_counter()
+    if notice is not None:
+        rich = plain = Packet(notice)
+    else:
+        rich = Packet(format_room_message(room.name, username, text))
+        plain = Packet(f"[#{room.name}] {username}:{text}")
+    sent = {}     # packet -> [recipients, last frame]
+
+    for session in room.fanout():
+        conn = session.conn
+        if conn is exclude:
+            continue
+        packet = rich if FEATURE_ROOMS in conn.features else plain
+        frame = packet.frame_for(conn.codec)
+        try:
+            conn.send(frame, packet.control, packet.key)
+            sent.setdefault(packet, [0, frame])[0] += 1
+        except Exception as e:
+            send_failures.labels(type(e).__name__).inc()
+
+    for packet, (count, frame) in sent.items():
+        count_sent(packet.kind, count, count * frame_size(frame))
+    broadcast_seconds.observe(time.perf_counter() - started)
+
 
+def remove_client(sock):
+    open_connections.dec()
+    heartbeats.forget(sock)
+    for upload in sock.uploads.values():
+        upload.abort()
+    sock.uploads.clear()
+    if sock.address is not None:
+        admission.release(sock.address)
+    session = registry.unregister(sock)
+    if session is not None:
+        stats = sock.queue.stats()
+        closed_queue_totals["sent_bytes"] += stats["sent_bytes"]
+        closed_queue_totals["dropped_frames"] += stats["dropped_frames"]
         try:
             sock.close()
         except Exception:
             pass
 
-        broadcast_packet(f"[System] {name} left.")
-        send_user_list()
+        broadcast_packet(f"[System] {session.name} left.")
+        publish_presence(LEAVE, session)
+        leave_all_rooms(session.name)
+
+
+ping_packet = Packet(PING)
+
+
+def ping_client(conn):
+    send_packet(conn, ping_packet)
+
+
+def reap_client(conn):
+    # Ends up in remove_client, like any other disconnect
+    idle_disconnects.inc()
+    conn.abort()
+
+
+heartbeats = HeartbeatMonitor(ping_client, reap_client)
+
+
+def leave_all_rooms(name):
+    for room, removed in rooms.leave_all(name):
+        publish_room_list(room, removed)
+
+
+def local_queues():
+    return [(session.name, session.conn.queue) for session in registry.snapshot()]
+
+
+def queue_total(field):
+    # Clients that left keep counting, so the totals never go down
+    return closed_queue_totals[field] + sum(
+        getattr(queue, field) for _, queue in local_queues()
+    )
+
+
+metrics.gauge(
+    "chat_connected_clients", "Logged in clients on this server",
+    function=lambda: len(registry))
+metrics.gauge(
+    "chat_remote_users", "Users logged in on other workers or nodes",
+    function=lambda: len(registry.everyone()) - len(registry.snapshot()))
+# No per-user labels: one series per username would grow without bound.
+# Per-client depths are printed on SIGUSR1 (dump_queue_stats)
+metrics.gauge(
+    "chat_client_queue_frames", "Frames waiting in the clients' outbound queues",
+    function=lambda: sum(len(queue) for _, queue in local_queues()))
+metrics.gauge(
+    "chat_client_queue_bytes", "Bytes waiting in the clients' outbound queues",
+    function=lambda: sum(queue.queued_bytes for _, queue in local_queues()))
+metrics.gauge(
+    "chat_client_queue_bytes_max", "Bytes waiting in the fullest client's outbound queue",
+    function=lambda: max((queue.queued_bytes for _, queue in local_queues()), default=0))
+metrics.gauge(
+    "chat_congested_clients", "Clients whose queue is over the high water mark",
+    function=lambda: sum(queue.congested_since is not None for _, queue in local_queues()))
+metrics.counter(
+    "chat_queue_written_bytes_total", "Bytes handed from outbound queues to sockets",
+    function=lambda: queue_total("sent_bytes"))
+metrics.counter(
+    "chat_queue_dropped_frames_total", "Frames dropped for slow consumers",
+    function=lambda: queue_total("dropped_frames"))
+
+
+def on_cluster_presence(event):
+    kind, name, avatar = event["kind"], event["name"], event.get("avatar")
+    if kind == JOIN:
+        session = registry.add_remote(name, avatar, event.get("node"))
+        if session is not None:
+            broadcast_packet(f"[System] {name} joined!")
+            publish_presence(JOIN, session)
+    elif kind == LEAVE:
+        session = registry.remove_remote(name)
+        if session is not None:
+            broadcast_packet(f"[System] {name} left.")
+            publish_presence(LEAVE, session)
+            leave_all_rooms(name)
+    elif kind == AVATAR:
+        session = registry.find(name)
+        if session is not None and session.remote:
+            session.avatar = avatar
+            publish_presence(AVATAR, session)
+
+
+def on_cluster_snapshot(event):
+    # Users that were already online on the other workers when we started
+    for name, avatar, node in event["users"]:
+        session = registry.add_remote(name, avatar, node)
+        if session is not None:
+            publish_presence(JOIN, session)
+    # Ask the others which rooms their users are in
+    cluster.publish("rooms_request")
+
+
+def on_cluster_broadcast(event):
+    if "sender" in event:
+        history.append(PUBLIC, event["sender"], event["text"])
+    broadcast_packet(event["message"])
+
+
+def on_cluster_private(event):
+    session = registry.find(event["target"])
+    if session is None or session.remote:
+        cluster.publish(
+            "not_found",
+            sender=event["sender"],
+            target=event["target"],
+            message=event["message"]
+        )
+        return
+    history.append(private_conversation(event["sender"], session.name), event["sender"], event["message"])
+    send_packet(session.conn, f"{event['sender']}:{event['message']} (Private)")
+
+
+def on_cluster_not_found(event):
+    # The target left before the message reached them: keep it in their mailbox
+    session = registry.find(event["sender"])
+    if session is None or session.remote:
+        return
+    if "message" in event:
+        deposit_private(session.conn, event["sender"], event["target"], event["message"])
+    else:
+        send_packet(session.conn, f"[System] User {event['target']} not found.")
+
+
+def on_cluster_room(event):
+    name, room_name = event["name"], event["room"]
+    if event["kind"] == JOIN:
+        room, changed = rooms.join(room_name, name)
+        verb = "joined"
+    else:
+        room, changed = rooms.leave(room_name, name)
+        verb = "left"
+    if room is not None:
+        room_broadcast(room, f"[System] {name} {verb} #{room.name}.")
+        publish_room_list(room, changed)
+
+
+def on_cluster_rooms(event):
+    # Memberships of another worker or node, in reply to rooms_request
+    for room_name, name in event["members"]:
+        rooms.join(room_name, name)
+    # Only happens when a worker or node comes up, so refresh everyone
+    publish_room_list(None, True)
+
+
+def on_cluster_rooms_request(event):
+    members = rooms.local_memberships()
+    if members:
+        cluster.publish("rooms", members=members)
+
+
+def on_cluster_room_message(event):
+    room = rooms.get(event["room"])
+    if room is not None:
+        room_broadcast(room, username=event["sender"], text=event["text"])
+
+
+def on_cluster_file(event):
+    share_file(event["sender"], event["offer"], relay=False)
+
+
+def on_cluster_lost():
+    # Without the hub names are no longer unique, so stop serving
+    print("Lost the worker bus, shutting down.", flush=True)
+    shutdown_server(propagate=False)
+
+
+def cluster_handlers():
+    return {
+        "presence": on_cluster_presence,
+        "snapshot": on_cluster_snapshot,
+        "broadcast": on_cluster_broadcast,
+        "private": on_cluster_private,
+        "not_found": on_cluster_not_found,
+        "room": on_cluster_room,
+        "rooms": on_cluster_rooms,
+        "rooms_request": on_cluster_rooms_request,
+        "room_message": on_cluster_room_message,
+        "file": on_cluster_file,
+        "shutdown": lambda event: shutdown_server(propagate=False),
+    }
+
+
+def join_cluster(path, node):
+    global cluster, reuse_port
+    reuse_port = True
+    cluster = BusClient(path, node, cluster_handlers(), on_lost=on_cluster_lost)
+
+
+def join_federation(name, port, peers):
+    global cluster
+    cluster = FederationNode(name, HOST, port, peers, cluster_handlers())
+    print(f"Federation node {name} listening for peers on port {port}")
+
+
+def strip_option(argv, option):
+    """Remove "--option value" and "--option=value" from an argument list."""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            result.append(arg)
+    return result
+
+
+def run_workers(count, mailbox_dir=None, files_dir=None):
+    """
+    Supervise count worker processes that share the port via SO_REUSEPORT
+    and talk over a BusHub. Crashed workers are restarted; once one exits
+    cleanly (the kill command) the others are stopped too. The workers
+    share one mailbox directory and one file store (temporary ones unless
+    mailbox_dir / files_dir are set).
+    """
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+        print("--workers needs SO_REUSEPORT and Unix sockets (Linux, BSD, macOS).")
+        return
+
+    bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+    bus_path = os.path.join(bus_dir, "bus.sock")
+    hub = BusHub(bus_path)
+    hub.start()
+
+    base = [sys.executable, os.path.abspath(__file__)] + strip_option(sys.argv[1:], "--workers")
+    if mailbox_dir is None:
+        base += ["--mailbox-dir", os.path.join(bus_dir, "mailboxes")]
+    if files_dir is None:
+        base += ["--files-dir", os.path.join(bus_dir, "files")]
+
+    def spawn(node):
+        return subprocess.Popen(base + ["--bus", bus_path, "--node-id", str(node)])
+
+    workers = {node: spawn(node) for node in range(count)}
+    print(f"Started {count} workers on port {PORT}", flush=True)
+
+    # kill <pid> on the supervisor stops the workers too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        stopping = False
+        while workers:
+            time.sleep(0.5)
+            for node, proc in list(workers.items()):
+                code = proc.poll()
+                if code is None:
+                    continue
+                if code == 0 or stopping:
+                    stopping = True
+                    del workers[node]
+                else:
+                    print(f"Worker {node} exited with {code}, restarting.", flush=True)
+                    workers[node] = spawn(node)
+            if stopping:
+                # Give the others a moment to flush their disconnect notices
+                deadline = time.monotonic() + 3
+                for proc in workers.values():
+                    try:
+                        proc.wait(max(0, deadline - time.monotonic()))
+                    except subprocess.TimeoutExpired:
+                        proc.terminate()
+                workers.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in workers.values():
+            proc.terminate()
+        hub.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="GUI chat server")
+    parser.add_argument(
+        "--mode",
+        choices=SERVER_MODES,
+        default="threaded",
+        help="threaded: one thread per client, async: single asyncio event loop"
+    )
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--queue-high",
+        type=int,
+        default=HIGH_WATER,
+        help="bytes queued for one client before its chat traffic is dropped"
+    )
+    parser.add_argument(
+        "--queue-low",
+        type=int,
+        default=LOW_WATER,
+        help="bytes the queue must drain below before delivery resumes"
+    )
+    parser.add_argument(
+        "--slow-policy",
+        choices=POLICIES,
+        default="drop",
+        help="drop: skip messages for slow clients, disconnect: evict them"
+    )
+    parser.add_argument(
+        "--slow-grace",
+        type=float,
+        default=SLOW_CONSUMER_GRACE,
+        help="seconds a client may stay over the limit before eviction"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="worker processes sharing the port (SO_REUSEPORT), one per core"
+    )
+    parser.add_argument(
+        "--federation-port",
+        type=int,
+        help="port for links from other chat server nodes (enables federation)"
+    )
+    parser.add_argument(
+        "--peers",
+        default="",
+        help="comma separated host:port federation addresses of the other nodes"
+    )
+    parser.add_argument(
+        "--node-name",
+        help="this node's name in the federation (default: hostname:federation port)"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics "
+             "(with --workers, worker N uses PORT + N)"
+    )
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="address for the metrics endpoint")
+    parser.add_argument(
+        "--history-dir",
+        help="keep chat history in segment files here so it survives restarts"
+    )
+    parser.add_argument(
+        "--history-size",
+        type=int,
+        default=RING_SIZE,
+        help="messages kept in memory per conversation"
+    )
+    parser.add_argument(
+        "--history-segments",
+        type=int,
+        default=MAX_SEGMENTS,
+        help="4 MiB log segments kept on disk before the oldest is deleted"
+    )
+    parser.add_argument(
+        "--mailbox-dir",
+        help="keep private messages for offline users here so they survive restarts"
+    )
+    parser.add_argument(
+        "--mailbox-size",
+        type=int,
+        default=MAX_MAILBOX_BYTES,
+        help="bytes of undelivered messages kept per user"
+    )
+    parser.add_argument(
+        "--mailbox-ttl",
+        type=float,
+        default=MAILBOX_TTL / 3600,
+        help="hours an undelivered private message is kept"
+    )
+    parser.add_argument(
+        "--files-dir",
+        help="keep shared files here (default: a temporary directory)"
+    )
+    parser.add_argument(
+        "--ping-interval",
+        type=float,
+        default=PING_INTERVAL,
+        help="seconds of silence before a client is pinged"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=IDLE_TIMEOUT,
+        help="seconds of silence before a client is disconnected"
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=BACKLOG,
+        help="connections the kernel queues while the server is busy accepting"
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=MAX_CONNECTIONS,
+        help="open connections before new ones are refused (per worker), 0 = no limit"
+    )
+    parser.add_argument(
+        "--max-per-address",
+        type=int,
+        default=MAX_PER_ADDRESS,
+        help="open connections per client IP address, 0 = no limit"
+    )
+    parser.add_argument(
+        "--accept-rate",
+        type=float,
+        default=ACCEPT_RATE,
+        help="new connections per second per client IP address, 0 = no limit"
+    )
+    parser.add_argument(
+        "--limit-loopback",
+        action="store_true",
+        help="apply the per-address limits to 127.0.0.1/::1 too (exempt by default)"
+    )
+    parser.add_argument(
+        "--message-rate",
+        type=float,
+        default=MESSAGE_RATE,
+        help="messages per second a client may send, 0 = no limit"
+    )
+    parser.add_argument(
+        "--message-burst",
+        type=int,
+        default=MESSAGE_BURST,
+        help="messages a client may send at once before --message-rate applies"
+    )
+    parser.add_argument(
+        "--byte-rate",
+        type=int,
+        default=BYTE_RATE,
+        help="bytes per second a client may send, 0 = no limit"
+    )
+    parser.add_argument("--tls-cert", help="certificate chain (PEM); clients then connect over TLS")
+    parser.add_argument("--tls-key", help="private key for --tls-cert if not in the same file")
+    # Set by --workers on the processes it starts
+    parser.add_argument("--bus", help=argparse.SUPPRESS)
+    parser.add_argument("--node-id", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    PORT = args.port
+    BACKLOG = args.backlog
+    queue_settings.update(
+        high_water=args.queue_high,
+        low_water=args.queue_low,
+        policy=args.slow_policy,
+        grace=args.slow_grace
+    )
+    limit_settings.update(
+        message_rate=args.message_rate,
+        message_burst=args.message_burst,
+        byte_rate=args.byte_rate
+    )
+    admission = AdmissionControl(
+        max_connections=args.max_connections,
+        max_per_address=args.max_per_address,
+        accept_rate=args.accept_rate,
+        limit_loopback=args.limit_loopback
+    )
+
+    # kill -USR1 <pid> prints every client's queue depth and drop counts
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, dump_queue_stats)
+
+    if args.federation_port and args.workers > 1:
+        parser.error("--workers and --federation-port cannot be combined")
+
+    if args.tls_key and not args.tls_cert:
+        parser.error("--tls-key needs --tls-cert")
+
+    if args.workers > 1 and not args.bus:
+        run_workers(args.workers, args.mailbox_dir, files_dir=args.files_dir)
+    else:
+        if args.tls_cert:
+            try:
+                tls_context = server_context(args.tls_cert, args.tls_key)
+            except (OSError, ValueError) as e:
+                print(f"Cannot set up TLS: {e}")
+                sys.exit(1)
+        history_dir = args.history_dir
+        if history_dir and args.bus:
+            # Every worker keeps its own copy of the history
+            history_dir = os.path.join(history_dir, f"worker-{args.node_id}")
+        history = HistoryStore(
+            history_dir,
+            ring_size=args.history_size,
+            max_segments=args.history_segments
+        )
+        heartbeats = HeartbeatMonitor(ping_client, reap_client, args.ping_interval, args.idle_timeout)
+        try:
+            blobs = BlobStore(args.files_dir or tempfile.mkdtemp(prefix="chat-files-"))
+        except OSError as e:
+            print(f"Cannot use the files directory: {e}")
+            sys.exit(1)
+        mailbox = MailboxStore(
+            args.mailbox_dir,
+            max_bytes=args.mailbox_size,
+            ttl=args.mailbox_ttl * 3600
+        )
+        if args.metrics_port:
+            try:
+                serve_metrics(metrics, args.metrics_port + args.node_id, args.metrics_host)
+            except OSError:
+                print(f"Metrics port {args.metrics_port + args.node_id} is busy.")
+                sys.exit(1)
+        if args.bus:
+            join_cluster(args.bus, args.node_id)
+        elif args.federation_port:
+            peers = [parse_address(peer) for peer in args.peers.split(",") if peer.strip()]
+            node_name = args.node_name or f"{socket.gethostname()}:{args.federation_port}"
+            try:
+                join_federation(node_name, args.federation_port, peers)
+            except OSError:
+                print(f"Federation port {args.federation_port} is busy.")
+                sys.exit(1)
+        start_server(args.mode)
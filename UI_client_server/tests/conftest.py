@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# The modules import each other by their plain names (from framing import ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+GUI_MODULES = (
+    "customtkinter", "tkinter", "PIL", "PIL.Image", "PIL.ImageDraw", "PIL.ImageFont",
+    "avatars", "GUI_client"
+)
+
+
+@pytest.fixture
+def gui():
+    """GUI_client imported over the headless stand-ins of bench_gui.py."""
+    saved = {name: sys.modules.pop(name, None) for name in GUI_MODULES}
+    try:
+        import bench_gui
+        yield bench_gui.import_gui()
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
@@ -0,0 +1,99 @@
+import sys
+
+import pytest
+
+import avatars
+from avatars import AVATAR_MAP, AvatarImages
+
+
+@pytest.fixture
+def atlas_loads(monkeypatch):
+    loads = []
+
+    def load_atlas(directory=None):
+        loads.append(directory)
+        return {name: f"tile:{name}" for name in AVATAR_MAP}
+
+    monkeypatch.setattr(avatars, "load_atlas", load_atlas)
+    return loads
+
+
+def test_images_are_made_on_first_lookup(atlas_loads):
+    made = []
+    images = AvatarImages(lambda tile: made.append(tile) or f"image of {tile}", directory="cache")
+    assert atlas_loads == [] and made == []
+
+    assert "Fox" in images and "Nope" not in images
+    assert atlas_loads == []
+
+    assert images["Fox"] == "image of tile:Fox"
+    assert images["Fox"] == "image of tile:Fox"
+    assert images.get("Cat") == "image of tile:Cat"
+    assert atlas_loads == ["cache"]
+    assert made == ["tile:Fox", "tile:Cat"]
+
+
+def test_unknown_avatars(atlas_loads):
+    images = AvatarImages(str)
+    with pytest.raises(KeyError):
+        images["Nope"]
+    assert images.get("Nope", "default") == "default"
+    assert atlas_loads == []
+
+
+def test_items_cover_every_avatar_in_order(atlas_loads):
+    images = AvatarImages(str)
+    assert [name for name, _ in images.items()] == list(AVATAR_MAP)
+    assert len(atlas_loads) == 1
+
+
+@pytest.fixture
+def pil():
+    return pytest.importorskip("PIL.Image")
+
+
+def test_atlas_is_cached_once_the_font_is_found(pil, tmp_path, monkeypatch):
+    renders = []
+    real_render = avatars.render_atlas
+
+    def render_atlas(font, font_size, tile):
+        renders.append(font)
+        return real_render(font, font_size, tile)[0], True
+
+    monkeypatch.setattr(avatars, "render_atlas", render_atlas)
+    tiles = avatars.load_atlas(str(tmp_path), tile=20)
+    assert list(tiles) == list(AVATAR_MAP)
+    assert all(tile.size == (20, 20) for tile in tiles.values())
+    assert [path.name for path in tmp_path.iterdir()] == [avatars.atlas_name(tile=20)]
+
+    again = avatars.load_atlas(str(tmp_path), tile=20)
+    assert len(renders) == 1
+    assert again["Fox"].tobytes() == tiles["Fox"].tobytes()
+
+
+def test_fallback_font_is_not_cached(pil, tmp_path):
+    avatars.load_atlas(str(tmp_path), font="no-such-font.ttf", tile=20)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_atlas_name_depends_on_the_layout(pil):
+    assert avatars.atlas_name(tile=20) != avatars.atlas_name(tile=30)
+    assert avatars.atlas_name(font="a.ttf") != avatars.atlas_name(font="b.ttf")
+
+
+def test_gui_loads_avatars_after_the_login_window(gui, monkeypatch):
+    import bench_gui
+    # The avatars module GUI_client was imported with, over the stand-ins
+    gui_avatars = sys.modules["avatars"]
+    loads = []
+    load_atlas = gui_avatars.load_atlas
+    monkeypatch.setattr(gui_avatars, "load_atlas", lambda directory=None: loads.append(directory) or load_atlas(directory))
+
+    app = gui.ChatClientGUI(bench_gui.STUB)
+    assert loads == []
+    assert not app.started
+
+    app.finish_startup()
+    app.finish_startup()
+    assert len(loads) == 1
+    assert app.started
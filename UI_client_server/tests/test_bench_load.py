@@ -0,0 +1,68 @@
+import argparse
+from types import SimpleNamespace
+
+import pytest
+
+import bench_load
+from bench_load import DEFAULT_MIX, SimClient, Stats, parse_mix, percentile, summarize_ms
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(bench_load.time, "perf_counter_ns", lambda: 10_000)
+    bench = SimpleNamespace(protocol="gui", args=SimpleNamespace(legacy=False), stats=Stats())
+    bench.stats.measuring = True
+    bench.stats.since_ns = 1_000
+    return SimClient(bench, "sim0")
+
+
+def test_parse_mix_reads_weights_and_defaults_to_one():
+    assert parse_mix(DEFAULT_MIX) == {"broadcast": 70.0, "private": 25.0, "avatar": 5.0}
+    assert parse_mix(" private , idle=2.5 ") == {"private": 1.0, "idle": 2.5}
+
+
+def test_parse_mix_rejects_unknown_operations():
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_mix("broadcast=70,shout=30")
+
+
+def test_percentile_on_empty_and_small_inputs():
+    assert percentile([], 0.5) is None
+    assert percentile([7], 0.999) == 7
+    assert percentile([1, 2, 3, 4], 0.5) == 3
+    # Never past the last value
+    assert percentile([1, 2, 3, 4], 1.0) == 4
+
+
+def test_summarize_ms_on_empty_and_small_inputs():
+    assert summarize_ms([]) == {"count": 0}
+    assert summarize_ms([2_000_000]) == {
+        "count": 1, "mean": 2.0, "p50": 2.0, "p99": 2.0, "p999": 2.0, "max": 2.0
+    }
+    summary = summarize_ms([3_000_000, 1_000_000])
+    assert summary["count"] == 2
+    assert summary["mean"] == pytest.approx(2.0)
+    assert summary["p50"] == pytest.approx(3.0)
+    assert summary["max"] == pytest.approx(3.0)
+
+
+def test_on_message_measures_every_marker_in_a_payload(client):
+    client.on_message(b"LT|4000|xx LT|7000|yy LT|9500|")
+    stats = client.bench.stats
+    assert stats.delivered == 3
+    assert stats.latencies == [6_000, 3_000, 500]
+
+
+def test_on_message_skips_old_and_broken_markers(client):
+    # Sent before measuring started, not a number, and cut off
+    client.on_message(b"LT|500|a LT|abc|b LT|8000|c LT|9000")
+    stats = client.bench.stats
+    assert stats.delivered == 1
+    assert stats.latencies == [2_000]
+
+
+def test_on_message_ignores_messages_outside_the_measurement(client):
+    client.bench.stats.measuring = False
+    client.on_message(b"LT|4000|")
+    assert client.bench.stats.delivered == 0
+    assert client.bench.stats.latencies == []
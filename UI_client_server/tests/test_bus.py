@@ -0,0 +1,150 @@
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import pytest
+
+from bus import BusClient, BusHub, BusPeer
+
+OPS = ("presence", "broadcast", "private", "not_found", "snapshot", "shutdown")
+
+
+@pytest.fixture
+def bus_path():
+    # Short path: Unix socket names are limited to about 100 bytes
+    directory = tempfile.mkdtemp(prefix="bus-")
+    yield os.path.join(directory, "bus.sock")
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def hub(bus_path):
+    hub = BusHub(bus_path)
+    hub.start()
+    yield hub
+    hub.close()
+
+
+class Worker:
+    def __init__(self, path, node):
+        self.received = queue.Queue()
+        self.lost = threading.Event()
+        handlers = {op: self.received.put for op in OPS}
+        self.client = BusClient(path, node, handlers, on_lost=self.lost.set)
+        # The hub answers the hello once the worker is registered for relays
+        self.snapshot = self.next("snapshot")
+
+    def next(self, op, timeout=2):
+        deadline = time.monotonic() + timeout
+        while True:
+            message = self.received.get(timeout=max(0.01, deadline - time.monotonic()))
+            if message["op"] == op:
+                return message
+
+    def claim(self, name):
+        return self.client.claim(name).result(timeout=2)
+
+    def close(self):
+        self.client.peer.sock.shutdown(socket.SHUT_RDWR)
+        self.client.peer.close()
+
+
+def test_a_name_is_claimed_once_across_workers(hub):
+    a, b = Worker(hub.path, 0), Worker(hub.path, 1)
+    assert a.claim("Alice")
+    assert not b.claim("alice")
+
+    # Only the worker holding a name can release it; a claim on the same
+    # connection makes sure the hub handled the release before
+    b.client.release("alice")
+    assert b.claim("sync-b") and not b.claim("alice")
+    a.client.release("Alice")
+    assert a.claim("sync-a")
+    assert b.claim("ALICE")
+
+
+def test_presence_is_relayed_with_the_node(hub):
+    a, b = Worker(hub.path, 0), Worker(hub.path, 1)
+    assert a.claim("alice")
+    a.client.publish("presence", kind="JOIN", name="alice", avatar="Fox")
+    event = b.next("presence")
+    assert (event["name"], event["avatar"], event["node"]) == ("alice", "Fox", 0)
+
+    # A worker that connects later gets the joined users in its snapshot
+    c = Worker(hub.path, 2)
+    assert c.snapshot["users"] == [["alice", "Fox", 0]]
+
+    a.client.publish("presence", kind="LEAVE", name="alice")
+    assert b.next("presence")["kind"] == "LEAVE"
+    assert b.claim("alice")
+
+
+def test_private_messages_go_to_the_owner_or_back(hub):
+    a, b = Worker(hub.path, 0), Worker(hub.path, 1)
+    assert b.claim("bob")
+    b.client.publish("presence", kind="JOIN", name="bob", avatar="Dog")
+    a.next("presence")
+
+    a.client.publish("private", sender="alice", target="Bob", message="hi")
+    assert b.next("private")["message"] == "hi"
+
+    a.client.publish("private", sender="alice", target="nobody", message="hello?")
+    missed = a.next("not_found")
+    assert (missed["target"], missed["message"]) == ("nobody", "hello?")
+
+
+def test_a_dead_worker_releases_its_users(hub):
+    a, b = Worker(hub.path, 0), Worker(hub.path, 1)
+    assert a.claim("alice")
+    a.client.publish("presence", kind="JOIN", name="alice", avatar="Fox")
+    b.next("presence")
+
+    a.close()
+    event = b.next("presence")
+    assert (event["kind"], event["name"], event["node"]) == ("LEAVE", "alice", 0)
+    assert b.claim("alice")
+
+
+def test_losing_the_hub_fails_pending_claims(bus_path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(bus_path)
+    server.listen()
+    lost = threading.Event()
+    client = BusClient(bus_path, 0, {}, on_lost=lost.set)
+    conn, _ = server.accept()
+
+    future = client.claim("alice")
+    conn.close()
+    server.close()
+    assert future.result(timeout=2) is False
+    assert lost.wait(2)
+
+
+def test_a_grant_after_the_claim_was_given_up_is_released(bus_path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(bus_path)
+    server.listen()
+    client = BusClient(bus_path, 0, {})
+    peer = BusPeer(server.accept()[0])
+    messages = peer.messages()
+    assert next(messages)["op"] == "hello"
+
+    future = client.claim("alice")
+    claim = next(messages)
+    assert future.cancel()
+    peer.send({"op": "claimed", "id": claim["id"], "ok": True})
+    assert next(messages) == {"op": "release", "name": "alice"}
+
+    # A refusal that comes too late needs nothing
+    future = client.claim("bob")
+    claim = next(messages)
+    future.cancel()
+    peer.send({"op": "claimed", "id": claim["id"], "ok": False})
+    client.release("marker")
+    assert next(messages)["name"] == "marker"
+    peer.close()
+    server.close()
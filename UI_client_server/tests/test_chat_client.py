@@ -0,0 +1,289 @@
+import queue
+import socket
+import threading
+
+import pytest
+
+import chat_client
+from chat_client import (
+    CLOSED,
+    CONNECTED,
+    CONNECTING,
+    DISCONNECT,
+    FAILED,
+    FALLBACK,
+    MESSAGE,
+    RECONNECTING,
+    REJECTED,
+    SEND,
+    STOPPED,
+    WELCOME,
+    ChatClient,
+    ClientSession,
+    reconnect_delay
+)
+from compression import DEFLATE
+from framing import (
+    FRAME_BINARY,
+    FRAME_TEXT,
+    FRAMED,
+    LEGACY,
+    StreamDecoder,
+    build_hello,
+    encode_frame,
+    negotiate,
+    read_message
+)
+
+
+def texts(events):
+    return [(kind, value.decode() if isinstance(value, bytes) else value) for kind, value in events]
+
+
+def test_handshake_and_login():
+    session = ClientSession("alice", features=("deflate", "rooms"))
+    assert session.start() == f"{build_hello(2, ('deflate', 'rooms'))}\n".encode()
+
+    events = session.feed(f"{build_hello(2, ['deflate'])}\n".encode())
+    assert session.codec is DEFLATE
+    assert session.server_features == {"deflate"}
+    assert events == [(SEND, DEFLATE.encode("alice"))]
+
+    events = session.feed(FRAMED.encode("Welcome alice!") + FRAMED.encode("hi"))
+    assert session.logged_in
+    assert events == [(WELCOME, "Welcome alice!"), (MESSAGE, (FRAME_TEXT, b"hi"))]
+
+
+def test_a_version_1_server_keeps_lines():
+    session = ClientSession("alice", features=("deflate",))
+    session.start()
+    assert session.feed(f"{build_hello(1)}\n".encode()) == [(SEND, b"alice\n")]
+    assert session.codec is LEGACY
+    assert texts(session.feed(b"Welcome alice!\nhi\n")) == [(WELCOME, "Welcome alice!"), (MESSAGE, (FRAME_TEXT, b"hi"))]
+
+
+def test_an_old_server_takes_hello_for_a_username():
+    session = ClientSession("alice")
+    session.start()
+    assert texts(session.feed(b"Welcome CMD:HELLO:2:!\n")) == [(FALLBACK, "Welcome CMD:HELLO:2:!")]
+
+    legacy = ClientSession("alice", hello=False)
+    assert legacy.start() == b"alice\n"
+    assert texts(legacy.feed(b"Welcome alice!\n")) == [(WELCOME, "Welcome alice!")]
+
+
+def test_refusals():
+    session = ClientSession("alice")
+    session.start()
+    assert session.feed(b"CMD:ERROR:server_full:The server is full.\n") == [(REJECTED, "The server is full.")]
+
+    session = ClientSession("alice", hello=False)
+    assert session.feed(b"Username taken.\n") == [(REJECTED, "Username taken.")]
+
+
+def logged_in_session():
+    session = ClientSession("alice")
+    session.start()
+    session.feed(f"{build_hello(2)}\n".encode())
+    session.feed(FRAMED.encode("Welcome alice!"))
+    return session
+
+
+def test_pings_are_answered_and_disconnects_reported():
+    session = logged_in_session()
+    events = session.feed(FRAMED.encode("CMD:PING") + FRAMED.encode("CMD:DISCONNECT:Bye now"))
+    assert events == [(SEND, FRAMED.encode("CMD:PONG")), (DISCONNECT, "Bye now")]
+
+
+def test_binary_frames_need_the_framed_protocol():
+    session = logged_in_session()
+    assert session.encode_frame(b"\0", FRAME_BINARY) == encode_frame(b"\0", FRAME_BINARY)
+
+    legacy = ClientSession("alice", hello=False)
+    with pytest.raises(ConnectionError):
+        legacy.encode_frame(b"\0", FRAME_BINARY)
+
+
+def test_raw_sessions_take_every_read_as_one_message():
+    session = ClientSession("alice", hello=False, raw=True)
+    assert session.start() == b"alice"
+    assert session.feed(b"Welcome alice!") == [(WELCOME, "Welcome alice!")]
+    assert session.feed(b"a:b\nc") == [(MESSAGE, (FRAME_TEXT, b"a:b\nc"))]
+
+
+@pytest.mark.parametrize("attempt", range(12))
+def test_reconnect_delay_bounds(attempt):
+    ceiling = min(8.0, 0.5 * 2 ** attempt)
+    for _ in range(50):
+        assert ceiling / 2 <= reconnect_delay(attempt, base=0.5, cap=8.0) <= ceiling
+
+
+class FakeServer:
+    """
+    A listening socket; every accepted connection is handed to
+    script(conn, index) on a thread of its own.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.received = queue.Queue()
+        self.thread = threading.Thread(target=self.accept, daemon=True)
+        self.thread.start()
+
+    def accept(self):
+        index = 0
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn, index), daemon=True).start()
+            index += 1
+
+    def serve(self, conn, index):
+        with conn:
+            try:
+                self.script(self, conn, index)
+            except OSError:
+                pass
+
+    def login(self, conn):
+        """Server side of the HELLO and the login; returns (decoder, username)."""
+        decoder = StreamDecoder()
+        _, line = read_message(conn, decoder)
+        reply, codec, _ = negotiate(line.decode(), ())
+        conn.sendall(f"{reply}\n".encode())
+        decoder.framed = codec.framed
+        _, name = read_message(conn, decoder)
+        name = name.decode()
+        conn.sendall(FRAMED.encode(f"Welcome {name}!"))
+        return decoder, name
+
+    def collect(self, conn, decoder):
+        """Put everything the client sends on self.received until it leaves."""
+        while True:
+            message = read_message(conn, decoder)
+            if message is None:
+                return
+            self.received.put(message[1].decode())
+
+    def close(self):
+        self.listener.close()
+
+
+class Recorder:
+    def __init__(self):
+        self.statuses = queue.Queue()
+        self.messages = queue.Queue()
+
+    def on_status(self, status, detail):
+        self.statuses.put((status, detail))
+
+    def wait_for(self, status):
+        """The statuses up to and including the next one of the given kind."""
+        seen = []
+        while True:
+            entry = self.statuses.get(timeout=5)
+            seen.append(entry)
+            if entry[0] == status:
+                return seen
+
+
+@pytest.fixture
+def run_client(monkeypatch):
+    monkeypatch.setattr(chat_client, "reconnect_delay", lambda attempt: 0.01)
+    started = []
+
+    def run(script, **kwargs):
+        server = FakeServer(script)
+        recorder = Recorder()
+        client = ChatClient(
+            "127.0.0.1", server.port, "alice",
+            on_message=recorder.messages.put, on_status=recorder.on_status, timeout=5, **kwargs
+        )
+        client.start()
+        started.append((client, server))
+        return client, server, recorder
+
+    yield run
+    for client, server in started:
+        client.stop()
+        server.close()
+
+
+def test_client_logs_in_and_chats(run_client):
+    def script(server, conn, index):
+        decoder, _ = server.login(conn)
+        conn.sendall(FRAMED.encode("bob:hi") + FRAMED.encode("CMD:PING"))
+        server.collect(conn, decoder)
+
+    client, server, recorder = run_client(script, avatar="Fox")
+    assert [status for status, _ in recorder.wait_for(CONNECTED)] == [CONNECTING, CONNECTED]
+    assert recorder.messages.get(timeout=5) == "bob:hi"
+    assert server.received.get(timeout=5) == "CMD:AVATAR:Fox"
+    assert server.received.get(timeout=5) == "CMD:PONG"
+
+    client.send("hello all")
+    assert server.received.get(timeout=5) == "hello all"
+
+    client.stop()
+    recorder.wait_for(STOPPED)
+    with pytest.raises(ConnectionError):
+        client.send("too late")
+
+
+def test_client_reconnects_and_restores_the_session(run_client):
+    names = queue.Queue()
+
+    def script(server, conn, index):
+        decoder, name = server.login(conn)
+        names.put(name)
+        if index == 0:
+            return      # drop the first connection right after the login
+        server.collect(conn, decoder)
+
+    client, server, recorder = run_client(script, avatar="Cat")
+    seen = recorder.wait_for(CONNECTED)
+    seen += recorder.wait_for(CONNECTED)
+    assert [status for status, _ in seen] == [CONNECTING, CONNECTED, RECONNECTING, CONNECTING, CONNECTED]
+    assert [detail for status, detail in seen if status == CONNECTING] == [0, 1]
+    assert [names.get(timeout=5), names.get(timeout=5)] == ["alice", "alice"]
+    assert server.received.get(timeout=5) == "CMD:AVATAR:Cat"
+
+
+def test_a_closed_session_is_not_retried(run_client):
+    def script(server, conn, index):
+        server.login(conn)
+        conn.sendall(FRAMED.encode("CMD:DISCONNECT:Kicked"))
+
+    client, server, recorder = run_client(script)
+    assert recorder.wait_for(CLOSED)[-1] == (CLOSED, "Kicked")
+    client.thread.join(5)
+    assert not client.thread.is_alive()
+
+
+def test_a_rejected_first_login_fails(run_client):
+    def script(server, conn, index):
+        decoder = StreamDecoder()
+        read_message(conn, decoder)
+        conn.sendall(b"CMD:ERROR:server_full:The server is full.\n")
+
+    client, server, recorder = run_client(script)
+    assert recorder.wait_for(FAILED)[-1] == (FAILED, "The server is full.")
+
+
+def test_client_falls_back_for_servers_without_hello(run_client):
+    def script(server, conn, index):
+        decoder = StreamDecoder()
+        _, line = read_message(conn, decoder)
+        conn.sendall(b"Welcome " + line + b"!\n")
+        if index == 1:
+            server.collect(conn, decoder)
+
+    client, server, recorder = run_client(script)
+    assert recorder.wait_for(CONNECTED)[-1] == (CONNECTED, "Welcome alice!")
+    assert client.server_features == set()
+    client.send("old school")
+    assert server.received.get(timeout=5) == "old school"
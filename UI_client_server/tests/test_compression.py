@@ -0,0 +1,98 @@
+import random
+import zlib
+
+import pytest
+
+import compression
+from compression import (
+    COMPRESS_MIN,
+    DEFLATE,
+    DICTIONARY,
+    compress,
+    inflate,
+    select_codec
+)
+from framing import (
+    FRAME_BINARY,
+    FRAME_DEFLATE,
+    FRAME_TEXT,
+    FRAMED,
+    HEADER,
+    LEGACY,
+    SPLIT_FRAME_SIZE,
+    FramingError,
+    StreamDecoder
+)
+
+TEXTS = [
+    "hi",
+    "CMD:PRESENCE_SNAPSHOT:" + "alice:Fox bob:Cat " * 20,
+    "émoji 🦊 and ünïcode " * 30,
+    "x" * (SPLIT_FRAME_SIZE * 2),
+]
+
+
+def receive(data):
+    decoder = StreamDecoder(framed=True)
+    decoder.feed(data)
+    return [DEFLATE.decode(frame_type, payload) for frame_type, payload in decoder.messages()]
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_round_trip(text):
+    assert receive(DEFLATE.encode(text)) == [(FRAME_TEXT, text.encode())]
+
+
+def test_small_messages_stay_plain_text():
+    text = "a" * (COMPRESS_MIN - 1)
+    assert DEFLATE.encode(text) == FRAMED.encode(text)
+
+
+def test_messages_that_do_not_shrink_stay_plain_text(monkeypatch):
+    monkeypatch.setattr(compression, "compress", lambda payload: payload + b"!")
+    text = "a" * COMPRESS_MIN * 2
+    assert DEFLATE.encode(text) == FRAMED.encode(text)
+
+
+def test_large_messages_are_compressed():
+    text = "CMD:PRESENCE:1:JOIN:alice:Fox " * 50
+    frame = DEFLATE.encode(text)
+    length, frame_type = HEADER.unpack_from(frame)
+    assert frame_type == FRAME_DEFLATE
+    assert length == len(frame) - HEADER.size < len(text) // 4
+
+
+def test_encode_shared_splits_large_bodies():
+    text = "y" * SPLIT_FRAME_SIZE * 20
+    assert DEFLATE.encode_shared(text) == DEFLATE.encode(text)
+
+    # Random hex compresses to about half, which is still past the split size
+    noise = random.Random(1).randbytes(SPLIT_FRAME_SIZE * 2).hex()
+    header, body = DEFLATE.encode_shared(noise)
+    assert HEADER.unpack(header)[1] == FRAME_DEFLATE
+    assert header + body == DEFLATE.encode(noise)
+
+
+def test_binary_frames_pass_through():
+    assert DEFLATE.decode(FRAME_BINARY, b"\x00\x01") == (FRAME_BINARY, b"\x00\x01")
+
+
+def test_peers_may_use_any_window():
+    payload = b"hello world " * 100
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=DICTIONARY)
+    assert inflate(compressor.compress(payload) + compressor.flush()) == payload
+
+
+def test_inflate_refuses_bombs_and_garbage():
+    bomb = compress(b"\0" * 100000)
+    assert inflate(bomb) == b"\0" * 100000
+    with pytest.raises(FramingError):
+        inflate(bomb, limit=1000)
+    with pytest.raises(FramingError):
+        inflate(b"\xff\xff\xff\xff")
+
+
+def test_select_codec():
+    assert select_codec(FRAMED, {"deflate"}) is DEFLATE
+    assert select_codec(FRAMED, set()) is FRAMED
+    assert select_codec(LEGACY, {"deflate"}) is LEGACY
@@ -0,0 +1,143 @@
+import collections
+import queue
+import threading
+import time
+
+import pytest
+
+from federation import FederationNode, home_node, parse_address
+from registry import name_key
+
+OPS = ("presence", "snapshot", "broadcast", "private", "not_found")
+
+
+def test_home_node_is_stable_and_spreads_names():
+    nodes = ["n1", "n2", "n3"]
+    homes = [home_node(f"user{i}", nodes) for i in range(300)]
+    assert homes == [home_node(f"user{i}", list(reversed(nodes))) for i in range(300)]
+    counts = collections.Counter(homes)
+    assert set(counts) == set(nodes)
+    assert min(counts.values()) > 50
+
+
+def test_home_node_only_moves_names_of_a_lost_node():
+    nodes = ["n1", "n2", "n3"]
+    for i in range(200):
+        before = home_node(f"user{i}", nodes)
+        if before != "n3":
+            assert home_node(f"user{i}", ["n1", "n2"]) == before
+
+
+def test_parse_address():
+    assert parse_address("10.0.0.1:6001") == ("10.0.0.1", 6001)
+    assert parse_address(":6001") == ("127.0.0.1", 6001)
+    assert parse_address(" host.example:7 ") == ("host.example", 7)
+
+
+class Node:
+    def __init__(self, name, peers=()):
+        self.received = queue.Queue()
+        handlers = {op: (lambda message, op=op: self.received.put((op, message))) for op in OPS}
+        self.fed = FederationNode(name, "127.0.0.1", 0, peers, handlers)
+        self.address = self.fed.server.getsockname()
+
+    def next(self, op, timeout=3):
+        deadline = time.monotonic() + timeout
+        while True:
+            got, message = self.received.get(timeout=max(0.01, deadline - time.monotonic()))
+            if got == op:
+                return message
+
+    def join(self, name, avatar="Boy"):
+        assert self.fed.claim(name).result(timeout=3)
+        self.fed.publish("presence", kind="JOIN", name=name, avatar=avatar)
+
+    def close(self):
+        self.fed.server.close()
+        with self.fed.lock:
+            links = list(self.fed.links.values())
+        for link in links:
+            link.peer.sock.shutdown(2)
+            link.peer.close()
+
+
+def wait_for(condition, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def pair():
+    a = Node("a")
+    b = Node("b", [a.address])
+    wait_for(lambda: a.fed.members() == ["a", "b"] and b.fed.members() == ["b", "a"])
+    yield a, b
+    a.close()
+    b.close()
+
+
+def names_homed_on(node, count=40):
+    return [f"user{i}" for i in range(count) if home_node(name_key(f"user{i}"), ["a", "b"]) == node]
+
+
+def test_a_name_is_claimed_once_whichever_node_is_home(pair):
+    a, b = pair
+    for name in names_homed_on("a", 10)[:2] + names_homed_on("b", 10)[:2]:
+        assert a.fed.claim(name).result(timeout=3)
+        assert not b.fed.claim(name.upper()).result(timeout=3)
+
+
+def test_presence_and_private_messages_between_nodes(pair):
+    a, b = pair
+    a.join("alice", "Fox")
+    event = b.next("presence")
+    assert (event["name"], event["kind"], event["node"]) == ("alice", "JOIN", "a")
+
+    b.fed.publish("private", sender="bob", target="ALICE", message="hi")
+    assert a.next("private")["message"] == "hi"
+
+    b.fed.publish("private", sender="bob", target="nobody", message="x")
+    assert b.next("not_found")["target"] == "nobody"
+
+    b.fed.publish("broadcast", sender="bob", message="hello all")
+    assert a.next("broadcast")["message"] == "hello all"
+
+
+def test_a_leave_frees_the_name(pair):
+    a, b = pair
+    name = names_homed_on("b")[0]
+    a.join(name)
+    b.next("presence")
+    a.fed.publish("presence", kind="LEAVE", name=name)
+    b.next("presence")
+    assert b.fed.claim(name).result(timeout=3)
+
+
+def test_losing_a_node_announces_its_users_gone(pair):
+    a, b = pair
+    a.join("alice")
+    b.next("presence")
+    a.close()
+    event = b.next("presence")
+    assert (event["name"], event["kind"]) == ("alice", "LEAVE")
+    assert b.fed.members() == ["b"]
+    assert b.fed.claim("alice").result(timeout=3)
+
+
+def test_a_grant_after_the_claim_was_given_up_is_released(pair, monkeypatch):
+    a, b = pair
+    name = names_homed_on("b")[0]
+    # Hold the home node's answer until the claim has been given up
+    cancelled = threading.Event()
+    reserve = b.fed.reserve
+    monkeypatch.setattr(b.fed, "reserve", lambda *args: cancelled.wait(3) and reserve(*args))
+
+    future = a.fed.claim(name)
+    assert future.cancel()
+    cancelled.set()
+    wait_for(lambda: a.fed.pending == {})
+    wait_for(lambda: name_key(name) not in b.fed.directory)
+    assert b.fed.claim(name).result(timeout=3)
@@ -0,0 +1,166 @@
+import hashlib
+import io
+import os
+import socket
+import threading
+
+import pytest
+
+from files import (
+    ACK_PREFIX,
+    CHUNK_SIZE,
+    SIZE_PREFIX,
+    BlobStore,
+    clean_name,
+    download,
+    file_digest,
+    format_notice,
+    format_offer,
+    format_status,
+    human_size,
+    pack_chunk,
+    parse_notice,
+    parse_offer,
+    parse_status,
+    send_file,
+    unpack_chunk,
+    valid_digest
+)
+
+DATA = os.urandom(3 * CHUNK_SIZE + 123)
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def test_offer_round_trip():
+    offer = parse_offer(format_offer(7, "a.png", len(DATA), DIGEST, "@bob"))
+    assert offer == {"id": 7, "name": "a.png", "size": len(DATA), "sha256": DIGEST, "to": "@bob"}
+
+
+@pytest.mark.parametrize("fields", [
+    {"id": -1},
+    {"id": 2 ** 32},
+    {"size": -5},
+    {"sha256": "abc"},
+    {"sha256": DIGEST.upper()},
+])
+def test_malformed_offers_are_refused(fields):
+    offer = {"upload_id": 1, "name": "a", "size": 1, "digest": DIGEST, "target": "all"}
+    offer.update({{"id": "upload_id", "sha256": "digest"}.get(key, key): value for key, value in fields.items()})
+    with pytest.raises(ValueError):
+        parse_offer(format_offer(**offer))
+    with pytest.raises(ValueError):
+        parse_offer("CMD:FILE_OFFER:{not json")
+
+
+def test_status_and_notice_round_trip():
+    assert parse_status(format_status(ACK_PREFIX, 3, 65536), ACK_PREFIX) == (3, "65536")
+    assert parse_status(ACK_PREFIX + "3:a:b", ACK_PREFIX) == (3, "a:b")
+    notice = parse_notice(format_notice(DIGEST, "../../etc/passwd", 10, "alice", "all"))
+    assert notice == {"file": DIGEST, "name": "passwd", "size": 10, "from": "alice", "to": "all"}
+
+
+def test_chunk_round_trip():
+    payload = pack_chunk(2 ** 32 - 1, b"data")
+    upload_id, data = unpack_chunk(payload)
+    assert upload_id == 2 ** 32 - 1
+    assert bytes(data) == b"data"
+    assert unpack_chunk(pack_chunk(1, b""))[0] == 1
+    with pytest.raises(ValueError):
+        unpack_chunk(b"\0\0\0")
+
+
+def test_helpers():
+    assert clean_name("C:\\Users\\x\\photo.jpg") == "photo.jpg"
+    assert clean_name("a\x00b\nc.txt") == "abc.txt"
+    assert clean_name("../") == "file"
+    assert len(clean_name("x" * 500)) == 200
+    assert human_size(500) == "500 B"
+    assert human_size(1536) == "1.5 KB"
+    assert human_size(3 * 1024 ** 3) == "3.0 GB"
+    assert valid_digest(DIGEST) and not valid_digest("../" + DIGEST[3:])
+
+
+def upload(store, data, digest=None, chunk=CHUNK_SIZE):
+    offer = {"id": 1, "name": "x", "size": len(data), "sha256": digest or hashlib.sha256(data).hexdigest(), "to": "all"}
+    up = store.begin(offer)
+    for i in range(0, len(data), chunk):
+        up.write(data[i:i + chunk])
+    assert up.complete
+    up.finish()
+
+
+def test_blob_store(tmp_path):
+    store = BlobStore(str(tmp_path))
+    assert not store.has(DIGEST)
+    upload(store, DATA)
+    assert store.has(DIGEST)
+    assert file_digest(store.path(DIGEST)) == (DIGEST, len(DATA))
+    with store.open(DIGEST) as f:
+        assert f.read() == DATA
+    assert store.open("../" * 21 + "x") is None
+    # Nothing is left in the incoming directory
+    assert os.listdir(store.temp_dir) == []
+
+
+def test_bad_uploads_are_discarded(tmp_path):
+    store = BlobStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        upload(store, DATA, digest="0" * 64)
+    assert not store.has("0" * 64)
+
+    up = store.begin({"id": 1, "name": "x", "size": 4, "sha256": DIGEST, "to": "all"})
+    with pytest.raises(ValueError):
+        up.write(b"12345")
+    up.write(b"1234")
+    up.abort()
+    assert os.listdir(store.temp_dir) == []
+
+
+def serve(sock, reply, data):
+    with sock:
+        sock.recv(1024)
+        sock.sendall(reply.encode())
+        send_file(sock, io.BytesIO(data), len(data))
+
+
+def fetch(reply, data):
+    server, client = socket.socketpair()
+    thread = threading.Thread(target=serve, args=(server, reply, data))
+    thread.start()
+    out = io.BytesIO()
+    progress = []
+    try:
+        with client:
+            size = download(client, DIGEST, out, lambda received, total: progress.append(received))
+    finally:
+        thread.join(5)
+    return size, out.getvalue(), progress
+
+
+def test_download():
+    size, data, progress = fetch(f"{SIZE_PREFIX}{len(DATA)}\n", DATA)
+    assert size == len(DATA)
+    assert data == DATA
+    assert progress[-1] == len(DATA)
+
+
+def test_download_refusals_and_corruption():
+    with pytest.raises(FileNotFoundError, match="No such file"):
+        fetch("CMD:ERROR:not_found:No such file\n", b"")
+    with pytest.raises(OSError):
+        fetch(f"{SIZE_PREFIX}{len(DATA)}\n", DATA[:-1])
+    with pytest.raises(OSError):
+        fetch(f"{SIZE_PREFIX}{len(DATA)}\n", DATA[:-1] + bytes([DATA[-1] ^ 1]))
+
+
+def test_empty_files(tmp_path):
+    store = BlobStore(str(tmp_path))
+    upload(store, b"")
+    digest = hashlib.sha256(b"").hexdigest()
+    assert store.has(digest)
+
+    server, client = socket.socketpair()
+    with server, client:
+        send_file(server, io.BytesIO(b""), 0)
+        server.shutdown(socket.SHUT_WR)
+        assert client.recv(10) == b""
@@ -0,0 +1,263 @@
+import socket
+import threading
+
+import pytest
+
+import framing
+from framing import (
+    FRAME_BINARY,
+    FRAME_TEXT,
+    FRAMED,
+    HEADER,
+    LEGACY,
+    PROTOCOL_VERSION,
+    SPLIT_FRAME_SIZE,
+    FramingError,
+    StreamDecoder,
+    build_hello,
+    client_handshake,
+    encode_frame,
+    negotiate,
+    parse_hello,
+    read_message
+)
+
+TEXTS = ["hello", "", "multi\nline", "émoji 🦊 and ünïcode", "x" * 100000]
+
+
+def decode_all(data, framed, step=None):
+    decoder = StreamDecoder(framed=framed, size=16)
+    messages = []
+    step = step or len(data) or 1
+    for i in range(0, len(data), step):
+        decoder.feed(data[i:i + step])
+        messages.extend(decoder.messages())
+    return messages
+
+
+@pytest.mark.parametrize("step", [None, 1, 3, 4096])
+def test_framed_round_trip(step):
+    data = b"".join(FRAMED.encode(text) for text in TEXTS)
+    assert decode_all(data, framed=True, step=step) == [(FRAME_TEXT, text.encode()) for text in TEXTS]
+
+
+@pytest.mark.parametrize("step", [None, 1, 7])
+def test_legacy_round_trip(step):
+    data = b"".join(LEGACY.encode(text) for text in TEXTS)
+    expected = [(FRAME_TEXT, text.replace("\n", " ").encode()) for text in TEXTS]
+    assert decode_all(data, framed=False, step=step) == expected
+
+
+def test_binary_and_empty_frames():
+    payloads = [(FRAME_BINARY, bytes(range(256))), (FRAME_TEXT, b""), (FRAME_BINARY, b"\n\n")]
+    data = b"".join(encode_frame(payload, frame_type) for frame_type, payload in payloads)
+    assert decode_all(data, framed=True, step=5) == payloads
+
+
+def test_split_utf8_character_survives():
+    data = FRAMED.encode("🦊")
+    decoder = StreamDecoder(framed=True)
+    decoder.feed(data[:-2])
+    assert list(decoder.messages()) == []
+    decoder.feed(data[-2:])
+    assert [payload.decode() for _, payload in decoder.messages()] == ["🦊"]
+
+
+def test_encode_shared_splits_large_bodies():
+    small = FRAMED.encode_shared("hi")
+    assert small == FRAMED.encode("hi")
+
+    text = "y" * SPLIT_FRAME_SIZE
+    header, body = FRAMED.encode_shared(text)
+    assert header + body == FRAMED.encode(text)
+    assert LEGACY.encode_shared("a\nb") == b"a b\n"
+
+
+def test_oversized_frames_are_refused(monkeypatch):
+    monkeypatch.setattr(framing, "MAX_FRAME_SIZE", 10)
+    with pytest.raises(FramingError):
+        encode_frame(b"x" * 11)
+
+    decoder = StreamDecoder(framed=True)
+    decoder.feed(HEADER.pack(11, FRAME_TEXT))
+    with pytest.raises(FramingError):
+        list(decoder.messages())
+
+
+def test_overlong_line_is_refused(monkeypatch):
+    monkeypatch.setattr(framing, "MAX_LINE_SIZE", 10)
+    decoder = StreamDecoder()
+    decoder.feed(b"x" * 11)
+    with pytest.raises(FramingError):
+        list(decoder.messages())
+
+
+def test_switch_to_frames_after_the_hello_line():
+    hello = build_hello(PROTOCOL_VERSION, ["a"]) + "\n"
+    data = hello.encode() + FRAMED.encode("framed") + FRAMED.encode("again")
+    decoder = StreamDecoder()
+    decoder.feed(data)
+
+    messages = decoder.messages()
+    assert next(messages) == (FRAME_TEXT, hello.strip().encode())
+    decoder.framed = True
+    assert list(messages) == [(FRAME_TEXT, b"framed"), (FRAME_TEXT, b"again")]
+
+
+def test_next_message_takes_one_at_a_time():
+    decoder = StreamDecoder()
+    decoder.feed(b"one\ntwo\nthr")
+    assert decoder.next_message() == (FRAME_TEXT, b"one")
+    assert decoder.next_message() == (FRAME_TEXT, b"two")
+    assert decoder.next_message() is None
+    decoder.feed(b"ee\n")
+    assert decoder.next_message() == (FRAME_TEXT, b"three")
+
+
+def test_hello_parsing():
+    assert build_hello(2, ["b", "a"]) == "CMD:HELLO:2:b,a"
+    assert parse_hello("CMD:HELLO:2:a,b") == (2, {"a", "b"})
+    assert parse_hello("CMD:HELLO:2:") == (2, set())
+    assert parse_hello("CMD:HELLO:x:a") is None
+    assert parse_hello("alice") is None
+
+
+def test_negotiate():
+    reply, codec, agreed = negotiate("CMD:HELLO:9:a,b,c", ["b", "c", "d"])
+    assert reply == f"CMD:HELLO:{PROTOCOL_VERSION}:b,c"
+    assert codec is FRAMED
+    assert agreed == {"b", "c"}
+
+    # An old client keeps the legacy protocol and gets no features
+    reply, codec, agreed = negotiate("CMD:HELLO:1:a", ["a"])
+    assert (reply, codec, agreed) == ("CMD:HELLO:1:", LEGACY, set())
+
+    assert negotiate("alice", ["a"]) is None
+
+
+def serve_once(reply):
+    """A peer that reads the HELLO line and answers with reply."""
+    client, server = socket.socketpair()
+
+    def run():
+        decoder = StreamDecoder()
+        read_message(server, decoder)
+        server.sendall(reply)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return client, server, thread
+
+
+def test_client_handshake_framed():
+    client, server, thread = serve_once(b"CMD:HELLO:2:a\n" + FRAMED.encode("welcome"))
+    try:
+        codec, agreed, decoder = client_handshake(client, ["a", "b"])
+        assert codec is FRAMED
+        assert agreed == {"a"}
+        # Frames that arrived with the reply are not lost
+        assert read_message(client, decoder) == (FRAME_TEXT, b"welcome")
+    finally:
+        thread.join()
+        client.close()
+        server.close()
+
+
+def test_client_handshake_legacy_server():
+    client, server, thread = serve_once(b"Welcome CMD:HELLO:2:!\n")
+    try:
+        assert client_handshake(client) is None
+    finally:
+        thread.join()
+        client.close()
+        server.close()
+
+
+def test_client_handshake_refused():
+    client, server, thread = serve_once(b"CMD:ERROR:server_full:The server is full.\n")
+    try:
+        with pytest.raises(ConnectionRefusedError, match="The server is full."):
+            client_handshake(client)
+    finally:
+        thread.join()
+        client.close()
+        server.close()
+
+
+def test_read_message_returns_none_on_eof():
+    client, server = socket.socketpair()
+    server.sendall(b"partial")
+    server.close()
+    try:
+        assert read_message(client, StreamDecoder()) is None
+    finally:
+        client.close()
+
+
+def test_buffer_resets_once_everything_is_consumed():
+    decoder = StreamDecoder(size=64)
+    decoder.feed(b"abc\n")
+    assert list(decoder.messages()) == [(FRAME_TEXT, b"abc")]
+    assert (decoder.start, decoder.end, decoder.scanned) == (0, 0, 0)
+
+
+def test_unconsumed_tail_moves_to_the_front_instead_of_growing():
+    decoder = StreamDecoder(size=8192)
+    decoder.feed(b"x" * 4000 + b"\n" + b"tail")
+    assert len(list(decoder.messages())) == 1
+    assert decoder.start == 4001
+
+    decoder.get_buffer(6000)
+    assert len(decoder.buffer) == 8192
+    assert decoder.start == 0
+    assert bytes(decoder.buffer[:decoder.end]) == b"tail"
+    decoder.feed(b" end\n")
+    assert list(decoder.messages()) == [(FRAME_TEXT, b"tail end")]
+
+
+def test_buffer_grows_for_a_large_frame_at_once():
+    payload = b"z" * 200000
+    frame = encode_frame(payload, FRAME_BINARY)
+    decoder = StreamDecoder(framed=True, size=1024)
+    decoder.feed(frame[:100])
+    assert list(decoder.messages()) == []
+    # The pending frame's size is known, so the next buffer fits all of it
+    assert decoder.wanted == len(frame)
+    assert len(decoder.get_buffer()) >= len(frame) - 100
+    decoder.feed(frame[100:])
+    assert list(decoder.messages()) == [(FRAME_BINARY, payload)]
+
+
+def test_line_scan_resumes_where_it_stopped():
+    decoder = StreamDecoder()
+    decoder.feed(b"no newline yet")
+    assert list(decoder.messages()) == []
+    assert decoder.scanned == decoder.end
+    decoder.feed(b", now\n")
+    assert list(decoder.messages()) == [(FRAME_TEXT, b"no newline yet, now")]
+
+
+def test_buffered_protocol_interface():
+    # asyncio.BufferedProtocol: the loop writes into get_buffer() and reports the size
+    data = FRAMED.encode("one") + FRAMED.encode("two")
+    decoder = StreamDecoder(framed=True)
+    for i in range(0, len(data), 5):
+        chunk = data[i:i + 5]
+        buffer = decoder.get_buffer(len(chunk))
+        buffer[:len(chunk)] = chunk
+        decoder.buffer_updated(len(chunk))
+    assert list(decoder.messages()) == [(FRAME_TEXT, b"one"), (FRAME_TEXT, b"two")]
+
+
+def test_recv_into_from_a_socket():
+    client, server = socket.socketpair()
+    try:
+        server.sendall(b"a\nb\n")
+        server.shutdown(socket.SHUT_WR)
+        decoder = StreamDecoder()
+        assert decoder.recv_into(client) == 4
+        assert list(decoder.messages()) == [(FRAME_TEXT, b"a"), (FRAME_TEXT, b"b")]
+        assert decoder.recv_into(client) == 0
+    finally:
+        client.close()
+        server.close()
@@ -0,0 +1,141 @@
+import socket
+
+import pytest
+
+import heartbeat
+from heartbeat import FEATURE_HEARTBEAT, HeartbeatMonitor, TimerWheel, enable_keepalive
+
+
+def advance_until(wheel, ticks):
+    """{tick: expired keys} for the next ticks ticks."""
+    fired = {}
+    for _ in range(ticks):
+        expired = wheel.advance()
+        if expired:
+            fired[wheel.now] = sorted(expired)
+    return fired
+
+
+def test_timers_fire_on_their_tick():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    wheel.schedule("a", 3)
+    wheel.schedule("b", 2.5)
+    wheel.schedule("c", 0)
+    assert len(wheel) == 3
+    assert advance_until(wheel, 5) == {1: ["c"], 3: ["a", "b"]}
+    assert len(wheel) == 0
+
+
+def test_timers_longer_than_a_revolution_wait_for_their_round():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    wheel.schedule("late", 19)
+    wheel.schedule("soon", 3)
+    assert advance_until(wheel, 30) == {3: ["soon"], 19: ["late"]}
+
+
+def test_rescheduling_replaces_the_timer():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    wheel.schedule("a", 2)
+    wheel.advance()
+    wheel.schedule("a", 5)
+    assert len(wheel) == 1
+    assert advance_until(wheel, 10) == {6: ["a"]}
+
+
+def test_cancel():
+    wheel = TimerWheel(tick=1.0, slots=8)
+    wheel.schedule("a", 2)
+    wheel.cancel("a")
+    wheel.cancel("never scheduled")
+    assert advance_until(wheel, 10) == {}
+    assert len(wheel) == 0
+
+
+class Connection:
+    def __init__(self, features=(), username="alice"):
+        self.features = set(features)
+        self.username = username
+        self.last_seen = 0.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(heartbeat.time, "monotonic", lambda: now[0])
+    return now
+
+
+class Harness:
+    """A HeartbeatMonitor driven tick by tick on a fake clock."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.events = []
+        self.monitor = HeartbeatMonitor(
+            ping=lambda conn: self.events.append(("ping", conn)),
+            reap=lambda conn: self.events.append(("reap", conn)),
+            interval=3,
+            timeout=6
+        )
+
+    def run_for(self, seconds, activity=None):
+        for second in range(seconds):
+            self.clock[0] += 1
+            if activity and second in activity:
+                activity[second].last_seen = self.clock[0]
+            for conn in self.monitor.wheel.advance():
+                self.monitor.expire(conn)
+
+
+@pytest.fixture
+def harness(clock):
+    return Harness(clock)
+
+
+def test_silent_heartbeat_clients_are_pinged_then_reaped(harness):
+    conn = Connection([FEATURE_HEARTBEAT])
+    harness.monitor.watch(conn)
+    harness.run_for(3)
+    assert harness.events == [("ping", conn)]
+    harness.run_for(3)
+    assert harness.events == [("ping", conn), ("reap", conn)]
+
+
+def test_busy_clients_are_never_pinged(harness):
+    conn = Connection([FEATURE_HEARTBEAT])
+    harness.monitor.watch(conn)
+    harness.run_for(20, activity={second: conn for second in range(0, 20, 2)})
+    assert harness.events == []
+    assert len(harness.monitor.wheel) == 1
+
+
+def test_clients_without_heartbeats(harness):
+    anonymous = Connection(username=None)
+    logged_in = Connection()
+    harness.monitor.watch(anonymous)
+    harness.monitor.watch(logged_in)
+    harness.run_for(10)
+    # The logged in client is left to TCP keepalive
+    assert harness.events == [("reap", anonymous)]
+    assert len(harness.monitor.wheel) == 0
+
+
+def test_forget(harness):
+    conn = Connection([FEATURE_HEARTBEAT])
+    harness.monitor.watch(conn)
+    harness.monitor.forget(conn)
+    harness.run_for(10)
+    assert harness.events == []
+
+
+def test_keepalive_options():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        enable_keepalive(sock, idle=30, timeout=90, probes=4)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 30
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL) == 15
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT) == 4
+    finally:
+        sock.close()
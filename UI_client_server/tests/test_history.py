@@ -0,0 +1,175 @@
+import os
+
+import pytest
+
+from history import (
+    MAX_PAGE,
+    PUBLIC,
+    HistoryStore,
+    conversation_key,
+    format_page,
+    format_request,
+    parse_page,
+    parse_request,
+    private_conversation
+)
+
+
+def texts(entries):
+    return [entry[3] for entry in entries]
+
+
+def page_all(store, key, limit):
+    """Page back from the newest message to the oldest; returns them oldest first."""
+    pages = []
+    before = 0
+    while True:
+        entries, more = store.page(key, before, limit)
+        pages[:0] = entries
+        if not more:
+            return pages
+        before = entries[0][0]
+
+
+def test_request_and_page_round_trip():
+    assert parse_request(format_request("@bob", 42, 10)) == ("@bob", 42, 10)
+    assert parse_request("CMD:HISTORY:all:0:0") == ("all", 0, 1)
+    assert parse_request("CMD:HISTORY:all:0:99999") == ("all", 0, MAX_PAGE)
+    # Conversation names may contain colons, the numbers are taken from the end
+    assert parse_request(format_request("@a:b", 1, 2)) == ("@a:b", 1, 2)
+
+    messages = [(1, 1.5, "alice", "hi"), (2, 2.5, "bob", "yo: there")]
+    assert parse_page(format_page("all", messages, True)) == ("all", messages, True)
+
+
+def test_private_conversation_is_the_same_from_both_sides():
+    assert private_conversation("Alice", "bob") == private_conversation("BOB", "alice")
+    assert private_conversation("alice", "bob") != private_conversation("alice", "carol")
+    assert conversation_key("alice", "@Bob") == private_conversation("alice", "bob")
+    assert conversation_key("alice", "all") == PUBLIC
+
+
+def test_ring_keeps_the_newest_messages():
+    store = HistoryStore(ring_size=5)
+    for i in range(8):
+        store.append(PUBLIC, "alice", f"m{i}")
+    entries, more = store.page(PUBLIC, limit=10)
+    assert texts(entries) == ["m3", "m4", "m5", "m6", "m7"]
+    assert not more
+
+
+def test_paging_within_the_ring():
+    store = HistoryStore(ring_size=10)
+    seqs = [store.append(PUBLIC, "alice", f"m{i}") for i in range(10)]
+    entries, more = store.page(PUBLIC, limit=3)
+    assert texts(entries) == ["m7", "m8", "m9"]
+    assert more
+    entries, more = store.page(PUBLIC, before=seqs[7], limit=3)
+    assert texts(entries) == ["m4", "m5", "m6"]
+    assert more
+    entries, more = store.page(PUBLIC, before=seqs[2], limit=3)
+    assert texts(entries) == ["m0", "m1"]
+    assert not more
+
+
+def test_conversations_are_kept_apart():
+    store = HistoryStore()
+    dm = private_conversation("alice", "bob")
+    store.append(PUBLIC, "alice", "public")
+    store.append(dm, "alice", "private")
+    assert texts(store.page(PUBLIC)[0]) == ["public"]
+    assert texts(store.page(dm)[0]) == ["private"]
+
+
+def test_least_recently_used_conversation_is_evicted():
+    store = HistoryStore(max_conversations=2)
+    store.append("a", "x", "1")
+    store.append("b", "x", "2")
+    store.page("a")
+    store.append("c", "x", "3")
+    assert list(store.rings) == ["a", "c"]
+    # Without a directory an evicted conversation is gone
+    assert store.page("b") == ([], False)
+
+
+@pytest.fixture
+def disk_store(tmp_path):
+    stores = []
+
+    def make(**kwargs):
+        settings = {"ring_size": 4, "segment_bytes": 300, "max_segments": 100}
+        settings.update(kwargs)
+        store = HistoryStore(str(tmp_path), **settings)
+        stores.append(store)
+        return store
+
+    yield make
+    for store in stores:
+        store.close()
+
+
+def test_pages_continue_from_the_ring_onto_disk_segments(disk_store):
+    store = disk_store()
+    for i in range(40):
+        store.append(PUBLIC, "alice", f"m{i}")
+        store.append("other", "bob", f"o{i}")
+    assert len(store.segments) > 5
+
+    for limit in (1, 3, 4, 5, 7, 50):
+        assert texts(page_all(store, PUBLIC, limit)) == [f"m{i}" for i in range(40)]
+    assert texts(page_all(store, "other", 6)) == [f"o{i}" for i in range(40)]
+
+
+def test_only_the_newest_segments_are_kept(disk_store, tmp_path):
+    store = disk_store(max_segments=3)
+    for i in range(60):
+        store.append(PUBLIC, "alice", f"m{i}")
+    assert len(store.segments) == 3
+    assert len(os.listdir(tmp_path)) == 6
+
+    kept = texts(page_all(store, PUBLIC, 10))
+    assert kept[-1] == "m59"
+    assert len(kept) < 60
+    assert kept == [f"m{i}" for i in range(60 - len(kept), 60)]
+    assert store.segments[0].first_seq == 60 - len(kept) + 1
+
+
+def test_history_survives_a_restart(disk_store):
+    store = disk_store()
+    for i in range(20):
+        store.append(PUBLIC, "alice", f"m{i}")
+    store.close()
+
+    reopened = disk_store()
+    assert reopened.next_seq == 21
+    assert texts(page_all(reopened, PUBLIC, 6)) == [f"m{i}" for i in range(20)]
+    assert reopened.append(PUBLIC, "alice", "after") == 21
+
+
+def test_an_evicted_conversation_is_reloaded_from_disk(disk_store):
+    store = disk_store(max_conversations=1)
+    for i in range(6):
+        store.append("a", "x", f"a{i}")
+    store.append("b", "x", "b0")
+    assert "a" not in store.rings
+    assert texts(store.page("a", limit=10)[0]) == [f"a{i}" for i in range(6)]
+
+
+def test_a_torn_tail_is_dropped_on_recovery(disk_store):
+    store = disk_store(segment_bytes=10000)
+    for i in range(5):
+        store.append(PUBLIC, "alice", f"m{i}")
+    store.close()
+
+    segment = store.segments[-1]
+    # A crash halfway through the last record and its index entry
+    with open(segment.log_path, "r+b") as f:
+        f.truncate(segment.log_size - 3)
+    with open(segment.index_path, "r+b") as f:
+        f.truncate(segment.index_size - 5)
+
+    reopened = disk_store(segment_bytes=10000)
+    assert texts(page_all(reopened, PUBLIC, 2)) == ["m0", "m1", "m2", "m3"]
+    assert reopened.next_seq == 5
+    reopened.append(PUBLIC, "alice", "again")
+    assert texts(reopened.page(PUBLIC, limit=2)[0]) == ["m3", "again"]
@@ -0,0 +1,120 @@
+import os
+import time
+
+import pytest
+
+from mailboxes import FULL, QUEUED, RECORD, MailboxStore, encode_record
+
+
+@pytest.fixture(params=["memory", "disk"])
+def make_store(request, tmp_path):
+    def make(**kwargs):
+        directory = str(tmp_path) if request.param == "disk" else None
+        return MailboxStore(directory, **kwargs)
+    return make
+
+
+def collect(store, recipient, batch_bytes=64 * 1024, accept=None):
+    batches = []
+
+    def send_batch(batch):
+        if accept is not None and len(batches) >= accept:
+            return False
+        batches.append([text for _, _, text in batch])
+        return True
+
+    delivered = store.deliver(recipient, send_batch, batch_bytes)
+    return delivered, batches
+
+
+def test_record_layout():
+    record = encode_record("alice", "hi", 12.5)
+    length, stamp = RECORD.unpack_from(record)
+    assert stamp == 12.5
+    assert record[RECORD.size:] == b'["alice","hi"]'
+    assert length == len(record) - RECORD.size
+
+
+def test_messages_are_delivered_once_in_order(make_store):
+    store = make_store()
+    for i in range(5):
+        assert store.deposit("Bob", "alice", f"m{i}") == QUEUED
+    assert store.pending("bob")
+
+    delivered, batches = collect(store, "BOB")
+    assert delivered == 5
+    assert batches == [[f"m{i}" for i in range(5)]]
+    assert not store.pending("bob")
+    assert collect(store, "bob") == (0, [])
+
+
+def test_delivery_is_batched(make_store):
+    store = make_store()
+    for i in range(10):
+        store.deposit("bob", "alice", "x" * 100)
+    delivered, batches = collect(store, "bob", batch_bytes=300)
+    assert delivered == 10
+    assert [len(batch) for batch in batches] == [3, 3, 3, 1]
+
+
+def test_undelivered_batches_stay_queued(make_store):
+    store = make_store()
+    for i in range(6):
+        store.deposit("bob", "alice", f"{i:0>100}")
+    delivered, batches = collect(store, "bob", batch_bytes=200, accept=1)
+    assert delivered == 2
+    assert store.pending("bob")
+
+    delivered, batches = collect(store, "bob")
+    assert delivered == 4
+    assert [int(text) for text in batches[0]] == [2, 3, 4, 5]
+
+
+def test_a_full_mailbox_refuses_messages(make_store):
+    record_size = len(encode_record("alice", "x" * 50, 0))
+    store = make_store(max_bytes=3 * record_size)
+    for _ in range(3):
+        assert store.deposit("bob", "alice", "x" * 50) == QUEUED
+    assert store.deposit("bob", "alice", "x" * 50) == FULL
+    # Other mailboxes are not affected
+    assert store.deposit("carol", "alice", "x" * 50) == QUEUED
+
+
+def test_the_whole_store_has_a_limit(make_store):
+    record_size = len(encode_record("alice", "x" * 50, 0))
+    store = make_store(max_total_bytes=2 * record_size)
+    assert store.deposit("bob", "alice", "x" * 50) == QUEUED
+    assert store.deposit("carol", "alice", "x" * 50) == QUEUED
+    assert store.deposit("dave", "alice", "x" * 50) == FULL
+
+    collect(store, "bob")
+    assert store.deposit("dave", "alice", "x" * 50) == QUEUED
+
+
+def test_expired_messages_are_not_delivered(make_store, monkeypatch):
+    store = make_store(ttl=60)
+    store.deposit("bob", "alice", "old")
+    later = time.time() + 120
+    monkeypatch.setattr(time, "time", lambda: later)
+    store.deposit("carol", "alice", "new")
+    assert collect(store, "bob") == (0, [])
+    assert collect(store, "carol") == (1, [["new"]])
+
+
+def test_disk_mailboxes_are_shared_between_stores(tmp_path):
+    first = MailboxStore(str(tmp_path))
+    second = MailboxStore(str(tmp_path))
+    first.deposit("bob", "alice", "hi")
+    assert second.pending("bob")
+    assert collect(second, "bob") == (1, [["hi"]])
+    assert not first.pending("bob")
+    assert os.listdir(tmp_path) == []
+
+
+def test_a_torn_tail_is_skipped(tmp_path):
+    store = MailboxStore(str(tmp_path))
+    store.deposit("bob", "alice", "whole")
+    store.deposit("bob", "alice", "torn")
+    path = store.path("bob")
+    os.truncate(path, os.path.getsize(path) - 2)
+    assert collect(store, "bob") == (1, [["whole"]])
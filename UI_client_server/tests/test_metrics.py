@@ -0,0 +1,104 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import MetricsRegistry, serve_metrics
+
+
+def test_counter_with_labels_renders_in_text_format():
+    registry = MetricsRegistry()
+    sent = registry.counter("chat_sent_total", "Messages sent", ("kind",))
+    sent.labels("chat").inc()
+    sent.labels("chat").inc(2)
+    sent.labels('a"b\\c\nd').inc()
+    assert registry.render().splitlines() == [
+        "# HELP chat_sent_total Messages sent",
+        "# TYPE chat_sent_total counter",
+        'chat_sent_total{kind="chat"} 3',
+        'chat_sent_total{kind="a\\"b\\\\c\\nd"} 1',
+    ]
+
+
+def test_labels_returns_the_same_child():
+    counter = MetricsRegistry().counter("c", "c", ("a", "b"))
+    child = counter.labels("x", "y")
+    assert counter.labels("x", "y") is child
+    assert counter.labels("x", "z") is not child
+
+
+def test_gauge_and_function_metrics():
+    registry = MetricsRegistry()
+    gauge = registry.gauge("open", "Open")
+    gauge.inc(5)
+    gauge.dec()
+    registry.gauge("computed", "Computed", function=lambda: 2.5)
+    registry.gauge("per_lane", "Per lane", ("lane",), function=lambda: {("a",): 1, ("b",): 2.0})
+    lines = registry.render().splitlines()
+    assert "open 4" in lines
+    assert "computed 2.5" in lines
+    assert 'per_lane{lane="a"} 1' in lines
+    assert 'per_lane{lane="b"} 2' in lines
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert lines[2:] == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 3.65",
+        "latency_seconds_count 4",
+    ]
+
+
+def test_a_failing_callback_does_not_break_the_scrape():
+    registry = MetricsRegistry()
+    registry.gauge("broken", "Broken", function=lambda: 1 / 0)
+    registry.counter("fine", "Fine").inc()
+    text = registry.render()
+    assert "# broken failed: ZeroDivisionError" in text
+    assert "fine 1" in text
+
+
+def test_serve_metrics_over_http():
+    registry = MetricsRegistry()
+    registry.counter("hits_total", "Hits").inc(7)
+    server = serve_metrics(registry, 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            assert "hits_total 7" in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_metrics_have_bounded_labels():
+    serverUI = pytest.importorskip("serverUI")
+    for metric in serverUI.metrics.metrics:
+        assert "user" not in metric.label_names, metric.name
+
+    # Every command and kind the hot paths count has a cached child
+    incoming = [
+        "hi", "to:bob x", "CMD:AVATAR:Fox", serverUI.SYNC_REQUEST, serverUI.HISTORY_REQUEST,
+        serverUI.ROOM_SEND + "a", serverUI.FILE_OFFER + "{}", "CMD:OTHER", "!!KILL_SERVER!!"
+    ]
+    commands = {serverUI.incoming_command(text) for text in incoming}
+    assert len(commands) == 8
+    assert commands <= set(serverUI.received_counters)
+
+    outgoing = [
+        "CMD:PRESENCE:1:JOIN:a:b", "[System] x", "CMD:HISTORY_PAGE:x", serverUI.PING,
+        serverUI.ROOM_MESSAGE + "a", "CMD:X", "Welcome a", "a:b (Private)", "a:b"
+    ]
+    kinds = {serverUI.outgoing_kind(text) for text in outgoing}
+    assert len(kinds) == 9
+    assert kinds <= set(serverUI.sent_counters)
@@ -0,0 +1,179 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import outbound
+from outbound import OutboundQueue, flatten, frame_size, send_buffers
+
+
+def test_frame_size_and_flatten():
+    frames = [b"abc", (b"he", b"ader", b"body"), bytearray(b"xy")]
+    assert [frame_size(frame) for frame in frames] == [3, 10, 2]
+    assert flatten(frames) == [b"abc", b"he", b"ader", b"body", bytearray(b"xy")]
+
+
+def test_control_frames_go_first():
+    queue = OutboundQueue()
+    queue.put(b"data1")
+    queue.put(b"ctrl", control=True)
+    queue.put(b"data2")
+    assert queue.take(block=False) == [b"ctrl", b"data1", b"data2"]
+    assert len(queue) == 0
+    assert queue.queued_bytes == 0
+
+
+def test_keyed_control_frame_replaces_older_one():
+    queue = OutboundQueue()
+    queue.put(b"LIST:a", control=True, key="list")
+    queue.put(b"other", control=True)
+    queue.put(b"LIST:a,b", control=True, key="list")
+    assert queue.queued_bytes == len(b"other") + len(b"LIST:a,b")
+    assert queue.take(block=False) == [b"other", b"LIST:a,b"]
+
+
+def test_take_stops_at_max_bytes():
+    queue = OutboundQueue()
+    for _ in range(10):
+        queue.put(b"x" * 100)
+    batch = queue.take(block=False, max_bytes=250)
+    assert len(batch) == 3
+    assert queue.queued_bytes == 700
+
+
+def test_drops_data_above_high_water_until_below_low_water():
+    queue = OutboundQueue(high_water=1000, low_water=300)
+    for _ in range(10):
+        assert queue.put(b"x" * 100)
+    # Over high water: congested, data is dropped but control is not
+    assert not queue.put(b"x" * 100)
+    assert queue.put(b"ctrl", control=True)
+    assert queue.stats()["congested"]
+    assert queue.dropped_frames == 1
+    assert queue.dropped_bytes == 100
+
+    # Still above low water after a partial drain
+    queue.take(block=False, max_bytes=500)
+    assert queue.queued_bytes > 300
+    assert not queue.put(b"y")
+
+    queue.take(block=False, max_bytes=300)
+    assert queue.queued_bytes <= 300
+    assert not queue.stats()["congested"]
+    assert queue.put(b"y")
+
+
+def test_disconnect_policy_flags_eviction_after_grace():
+    queue = OutboundQueue(high_water=100, low_water=10, policy="disconnect", grace=0.05)
+    queue.put(b"x" * 100)
+    assert not queue.put(b"x")
+    assert not queue.evict
+    time.sleep(0.06)
+    assert not queue.put(b"x")
+    assert queue.evict
+
+
+def test_drop_policy_never_evicts():
+    queue = OutboundQueue(high_water=100, low_water=10, policy="drop", grace=0)
+    queue.put(b"x" * 100)
+    time.sleep(0.01)
+    assert not queue.put(b"x")
+    assert not queue.evict
+
+
+def test_blocking_producer_waits_out_a_short_burst(monkeypatch):
+    monkeypatch.setattr(outbound, "BACKPRESSURE_WINDOW", 5.0)
+    queue = OutboundQueue(high_water=100, low_water=10)
+    queue.put(b"x" * 100)
+    assert not queue.put(b"y" * 10)     # starts the congestion episode
+    threading.Timer(0.01, queue.take, kwargs={"block": False}).start()
+    assert queue.put(b"z", block=True)
+
+
+def test_blocking_producer_drops_when_the_window_passes(monkeypatch):
+    monkeypatch.setattr(outbound, "BACKPRESSURE_WINDOW", 0.01)
+    queue = OutboundQueue(high_water=100, low_water=10)
+    queue.put(b"x" * 100)
+    started = time.monotonic()
+    assert not queue.put(b"y", block=True)
+    assert time.monotonic() - started < 1
+
+
+def test_invalid_settings():
+    with pytest.raises(ValueError):
+        OutboundQueue(policy="wait")
+    with pytest.raises(ValueError):
+        OutboundQueue(high_water=10, low_water=20)
+
+
+def test_close_drains_then_returns_nothing():
+    queue = OutboundQueue()
+    queue.put(b"last")
+    queue.close()
+    assert not queue.put(b"late")
+    assert queue.take() == [b"last"]
+    assert queue.take() == []
+
+
+def test_clear_wakes_a_blocked_writer():
+    queue = OutboundQueue()
+    result = []
+    writer = threading.Thread(target=lambda: result.append(queue.take()))
+    writer.start()
+    time.sleep(0.01)
+    queue.clear()
+    writer.join(1)
+    assert result == [[]]
+
+
+class PartialSocket:
+    """sendmsg() that writes at most limit bytes per call."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+
+    def sendmsg(self, buffers):
+        room = self.limit
+        for buffer in buffers:
+            chunk = bytes(buffer[:room])
+            self.data += chunk
+            room -= len(chunk)
+            if not room:
+                break
+        return self.limit - room
+
+
+def test_send_buffers_resumes_partial_writes():
+    sock = PartialSocket(limit=7)
+    buffers = [b"hello ", b"scatter ", b"gather ", b"world"]
+    send_buffers(sock, list(buffers))
+    assert bytes(sock.data) == b"".join(buffers)
+
+
+def test_send_buffers_falls_back_to_sendall():
+    class NoSendmsg:
+        data = b""
+
+        def sendall(self, data):
+            self.data += data
+
+    sock = NoSendmsg()
+    send_buffers(sock, [b"a", b"b"])
+    assert sock.data == b"ab"
+
+
+def test_send_buffers_over_a_socket():
+    left, right = socket.socketpair()
+    try:
+        buffers = [bytes([i % 256]) * 10 for i in range(outbound.IOV_MAX + 10)]
+        send_buffers(left, list(buffers))
+        expected = b"".join(buffers)
+        received = b""
+        while len(received) < len(expected):
+            received += right.recv(65536)
+        assert received == expected
+    finally:
+        left.close()
+        right.close()
@@ -0,0 +1,133 @@
+import pytest
+
+from framing import FRAMED, StreamDecoder
+from presence import (
+    AVATAR,
+    JOIN,
+    LEAVE,
+    PresenceState,
+    format_event,
+    format_join_snapshot,
+    format_snapshot,
+    parse_event,
+    parse_join_snapshot,
+    parse_snapshot
+)
+from registry import Session
+
+
+def test_event_round_trip():
+    for event in [(1, JOIN, "alice", "Fox"), (2, LEAVE, "alice", None), (3, AVATAR, "bob", "Cat")]:
+        assert parse_event(format_event(*event)) == event
+
+
+def test_usernames_with_colons_survive():
+    assert parse_event(format_event(7, JOIN, "a:b:c", "Dog")) == (7, JOIN, "a:b:c", "Dog")
+    assert parse_event(format_event(8, LEAVE, "a:b")) == (8, LEAVE, "a:b", None)
+
+
+def test_snapshot_round_trip():
+    sessions = [Session(None, "alice", "Fox"), Session(None, "bö:b", "Cat")]
+    assert parse_snapshot(format_snapshot(42, sessions)) == (42, [("alice", "Fox"), ("bö:b", "Cat")])
+
+
+def make_state():
+    users, avatars = [], {}
+    state = PresenceState(users, avatars)
+    state.apply_snapshot(10, [("alice", "Fox"), ("bob", "Cat")])
+    return state, users, avatars
+
+
+def test_events_in_order_update_the_lists_in_place():
+    state, users, avatars = make_state()
+    assert state.apply_event(11, JOIN, "carol", "Dog")
+    assert state.apply_event(12, AVATAR, "alice", "Robot")
+    assert state.apply_event(13, LEAVE, "bob")
+    assert users == ["alice", "carol"]
+    assert avatars == {"alice": "Robot", "carol": "Dog"}
+    assert state.seq == 13
+
+
+def test_gap_asks_for_a_snapshot_but_still_applies():
+    state, users, _ = make_state()
+    assert not state.apply_event(12, JOIN, "carol", "Dog")
+    assert users == ["alice", "bob", "carol"]
+    assert state.seq == 12
+    assert state.apply_event(13, LEAVE, "carol")
+
+
+def test_old_and_duplicate_events_are_ignored():
+    state, users, _ = make_state()
+    assert state.apply_event(10, LEAVE, "alice")
+    assert state.apply_event(3, JOIN, "zed", "Dog")
+    assert users == ["alice", "bob"]
+
+
+def test_events_before_the_first_snapshot_are_ignored():
+    users, avatars = [], {}
+    state = PresenceState(users, avatars)
+    assert state.apply_event(5, JOIN, "early", "Fox")
+    assert users == []
+
+
+def test_rejoin_and_unknown_users():
+    state, users, avatars = make_state()
+    assert state.apply_event(11, JOIN, "alice", "Ghost")
+    assert users == ["alice", "bob"]
+    assert avatars["alice"] == "Ghost"
+    assert state.apply_event(12, LEAVE, "nobody")
+    assert state.apply_event(13, AVATAR, "nobody", "Cat")
+    assert "nobody" not in avatars
+
+
+def test_snapshot_replaces_everything_and_reset_clears():
+    state, users, avatars = make_state()
+    state.apply_snapshot(20, [("zed", "Star")])
+    assert users == ["zed"]
+    assert avatars == {"zed": "Star"}
+    state.reset()
+    assert (users, avatars, state.seq) == ([], {}, None)
+
+
+def test_join_snapshot_round_trip():
+    sessions = [Session(None, "alice", "Fox"), Session(None, "b:ob", "Cat")]
+    history = [[1, 1.5, "alice", "hi"], [2, 2.5, "b:ob", "hey: you"]]
+    rooms = [["dev", 2]]
+    snapshot = parse_join_snapshot(format_join_snapshot(9, sessions, history, True, rooms))
+    assert snapshot == {
+        "seq": 9,
+        "users": [("alice", "Fox"), ("b:ob", "Cat")],
+        "history": [(1, 1.5, "alice", "hi"), (2, 2.5, "b:ob", "hey: you")],
+        "more": True,
+        "rooms": [("dev", 2)],
+    }
+
+
+def test_join_snapshot_only_carries_negotiated_parts():
+    snapshot = parse_join_snapshot(format_join_snapshot(1, []))
+    assert snapshot == {"seq": 1, "users": []}
+    snapshot = parse_join_snapshot(format_join_snapshot(1, [], history=[]))
+    assert snapshot == {"seq": 1, "users": [], "history": [], "more": False}
+
+
+class BatchClient:
+    codec = FRAMED
+
+    def __init__(self):
+        self.writes = []
+
+    def send(self, frame, control, coalesce):
+        self.writes.append(frame)
+
+
+def test_legacy_avatar_lines_go_out_as_one_write():
+    serverUI = pytest.importorskip("serverUI")
+    client = BatchClient()
+    lines = [f"CMD:UPDATE_AVATAR:user{i}:Fox" for i in range(50)]
+    serverUI.send_batch(client, lines)
+    serverUI.send_batch(client, [])
+    assert len(client.writes) == 1
+
+    decoder = StreamDecoder(framed=True)
+    decoder.feed(client.writes[0])
+    assert [payload.decode() for _, payload in decoder.messages()] == lines
@@ -0,0 +1,154 @@
+import pytest
+
+import ratelimit
+from framing import FRAME_BINARY
+from ratelimit import (
+    ADDRESS_FULL,
+    CONNECT_RATE,
+    RATE_LIMITED,
+    SERVER_FULL,
+    AdmissionControl,
+    MessageLimiter,
+    TokenBucket,
+    format_error,
+    is_loopback
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_bucket_allows_a_burst_then_the_rate():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.consume(1, now=0) for _ in range(4)] == [True, True, True, False]
+    assert not bucket.consume(1, now=0.4)
+    assert bucket.consume(1, now=0.5)
+    # Idle time never fills it past the burst
+    assert [bucket.consume(1, now=100) for _ in range(4)] == [True, True, True, False]
+
+
+def test_bucket_lets_an_oversized_request_through_with_a_debt():
+    bucket = TokenBucket(rate=10, burst=5, now=0)
+    assert bucket.consume(50, now=0)
+    assert bucket.tokens == -45
+    assert not bucket.consume(1, now=4)
+    assert not bucket.full(now=4.9)
+    assert bucket.full(now=5)
+    assert bucket.consume(50, now=5)
+
+
+def test_limiter_counts_dropped_messages(clock):
+    limiter = MessageLimiter(message_rate=1, message_burst=2, byte_rate=0)
+    assert limiter.allow(10) and limiter.allow(10)
+    assert not limiter.allow(10)
+    assert not limiter.allow(10)
+    assert limiter.dropped == 2
+    clock[0] += 1
+    assert limiter.allow(10)
+    assert limiter.dropped == 0
+
+
+def test_limiter_byte_budget(clock):
+    limiter = MessageLimiter(message_rate=0, byte_rate=100, byte_burst=1000)
+    assert limiter.messages is None
+    assert limiter.allow(600)
+    assert not limiter.allow(600)
+    clock[0] += 2
+    assert limiter.allow(600)
+
+
+def test_a_message_over_the_byte_limit_keeps_its_message_token(clock):
+    limiter = MessageLimiter(message_rate=1, message_burst=5, byte_rate=100, byte_burst=1000)
+    assert limiter.allow(900)
+    tokens = limiter.messages.tokens
+    assert not limiter.allow(900)
+    assert not limiter.allow(900)
+    assert limiter.messages.tokens == tokens
+    assert limiter.allow(100)
+    assert limiter.messages.tokens == tokens - 1
+
+
+def test_admission_total_limit(clock):
+    admission = AdmissionControl(max_connections=2, max_per_address=0, accept_rate=0)
+    assert admission.admit("10.0.0.1") is None
+    assert admission.admit("10.0.0.2") is None
+    assert admission.admit("10.0.0.3") == SERVER_FULL
+    admission.release("10.0.0.1")
+    assert admission.admit("10.0.0.3") is None
+
+
+def test_admission_per_address_limits(clock):
+    admission = AdmissionControl(max_per_address=2, accept_rate=1, accept_burst=3)
+    assert admission.admit("10.0.0.1") is None
+    assert admission.admit("10.0.0.1") is None
+    assert admission.admit("10.0.0.1") == ADDRESS_FULL
+    assert admission.admit("10.0.0.2") is None
+
+    admission.release("10.0.0.1")
+    assert admission.admit("10.0.0.1") is None
+    admission.release("10.0.0.1")
+    # The fourth attempt within a second is over the connect rate
+    assert admission.admit("10.0.0.1") == CONNECT_RATE
+    clock[0] += 1
+    assert admission.admit("10.0.0.1") is None
+
+
+def test_loopback_is_exempt_unless_asked(clock):
+    admission = AdmissionControl(max_per_address=1)
+    assert admission.admit("127.0.0.1") is None
+    assert admission.admit("::1") is None
+    assert admission.admit("127.0.0.1") is None
+    assert admission.addresses == {}
+
+    strict = AdmissionControl(max_per_address=1, limit_loopback=True)
+    assert strict.admit("127.0.0.1") is None
+    assert strict.admit("127.0.0.1") == ADDRESS_FULL
+
+
+def test_idle_addresses_are_pruned(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit, "MAX_TRACKED", 4)
+    admission = AdmissionControl(accept_rate=1, accept_burst=1)
+    admission.prune_at = 4
+    for i in range(4):
+        assert admission.admit(f"10.0.0.{i}") is None
+    admission.release("10.0.0.0")
+    admission.release("10.0.0.1")
+
+    clock[0] += 10
+    assert admission.admit("10.0.0.9") is None
+    assert sorted(admission.addresses) == ["10.0.0.2", "10.0.0.3", "10.0.0.9"]
+
+
+def test_helpers():
+    assert format_error(RATE_LIMITED).startswith("CMD:ERROR:rate_limited:")
+    assert is_loopback("127.0.0.5")
+    assert not is_loopback("192.168.1.1")
+    assert not is_loopback("localhost")
+
+
+class FakeClient:
+    def __init__(self):
+        self.limiter = MessageLimiter(message_rate=1, message_burst=2, byte_rate=0)
+        self.uploads = {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_stray_binary_frames_are_rate_limited(clock, monkeypatch):
+    serverUI = pytest.importorskip("serverUI")
+    sent = []
+    monkeypatch.setattr(serverUI, "send_packet", lambda sock, text, **kwargs: sent.append(text))
+    monkeypatch.setattr(serverUI, "MAX_DROPPED", 3)
+
+    client = FakeClient()
+    results = [serverUI.handle_frame(client, FRAME_BINARY, b"\0" * 64) for _ in range(6)]
+    assert results == [True, True, True, True, False, False]
+    assert client.closed
+    assert sent[0] == f"[System] {ratelimit.REASONS[RATE_LIMITED]}"
+    assert sent[-1].startswith("CMD:DISCONNECT:")
@@ -0,0 +1,99 @@
+import threading
+
+from registry import SessionRegistry, name_key
+
+
+def test_register_and_look_up_case_insensitively():
+    registry = SessionRegistry()
+    session = registry.register("conn-a", "Alice", "Fox")
+    assert session.name == "Alice"
+    assert session.avatar == "Fox"
+    assert registry.find("ALICE") is session
+    assert registry.session_for("conn-a") is session
+    assert "alice" in registry
+    assert len(registry) == 1
+
+
+def test_duplicate_name_or_connection_is_refused():
+    registry = SessionRegistry()
+    registry.register("conn-a", "Alice")
+    assert registry.register("conn-b", "aLiCe") is None
+    assert registry.register("conn-a", "Bob") is None
+    assert registry.names() == ["Alice"]
+
+
+def test_name_key_casefolds():
+    assert name_key("STRASSE") == name_key("straße")
+
+
+def test_unregister_frees_the_name():
+    registry = SessionRegistry()
+    session = registry.register("conn-a", "Alice")
+    assert registry.unregister("conn-a") is session
+    assert registry.unregister("conn-a") is None
+    assert "Alice" not in registry
+    assert registry.register("conn-b", "alice") is not None
+
+
+def test_snapshot_is_rebuilt_only_after_changes():
+    registry = SessionRegistry()
+    registry.register("a", "A")
+    registry.register("b", "B")
+    first = registry.snapshot()
+    assert [s.name for s in first] == ["A", "B"]
+    assert registry.snapshot() is first
+
+    registry.set_avatar("a", "Cat")
+    assert registry.snapshot() is first
+    assert first[0].avatar == "Cat"
+
+    registry.unregister("a")
+    assert [s.name for s in registry.snapshot()] == ["B"]
+    # A snapshot taken before stays intact for whoever iterates it
+    assert [s.name for s in first] == ["A", "B"]
+
+
+def test_remote_sessions_are_listed_but_not_fanned_out():
+    registry = SessionRegistry()
+    registry.register("a", "Local")
+    remote = registry.add_remote("Far", "Dog", node=2)
+    assert remote.remote
+    assert registry.add_remote("local", "Dog", node=2) is None
+    assert registry.register("b", "far") is None
+
+    assert [s.name for s in registry.snapshot()] == ["Local"]
+    assert [s.name for s in registry.everyone()] == ["Local", "Far"]
+    assert len(registry) == 1
+
+    # A local user cannot be removed as a remote one
+    assert registry.remove_remote("Local") is None
+    assert registry.remove_remote("FAR") is remote
+    assert registry.names() == ["Local"]
+
+
+def test_remove_node_forgets_only_its_users():
+    registry = SessionRegistry()
+    registry.add_remote("x", None, node=1)
+    registry.add_remote("y", None, node=2)
+    registry.add_remote("z", None, node=1)
+    gone = registry.remove_node(1)
+    assert sorted(s.name for s in gone) == ["x", "z"]
+    assert registry.names() == ["y"]
+    assert registry.remove_node(1) == []
+
+
+def test_concurrent_claims_of_one_name_have_one_winner():
+    registry = SessionRegistry()
+    results = []
+    barrier = threading.Barrier(16)
+
+    def claim(i):
+        barrier.wait()
+        results.append(registry.register(f"conn-{i}", "Same"))
+
+    threads = [threading.Thread(target=claim, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(result is not None for result in results) == 1
@@ -0,0 +1,114 @@
+from rooms import (
+    RoomIndex,
+    format_list,
+    format_message,
+    parse_list,
+    parse_message,
+    valid_room
+)
+
+
+class Session:
+    def __init__(self, name):
+        self.name = name
+
+
+def test_message_and_list_round_trip():
+    assert parse_message(format_message("lobby", "alice", "hi: there")) == ("lobby", "alice", "hi: there")
+    rooms = [("dev", 3), ("lobby", 1)]
+    assert parse_list(format_list(rooms)) == rooms
+
+
+def test_room_names():
+    assert valid_room("dev-team_2")
+    assert valid_room("x" * 32)
+    assert not valid_room("")
+    assert not valid_room("x" * 33)
+    assert not valid_room("no:colons")
+    assert not valid_room("no spaces")
+
+
+def test_join_and_leave_create_and_remove_rooms():
+    index = RoomIndex()
+    alice = Session("Alice")
+    room, created = index.join("Lobby", "Alice", alice)
+    assert created and room.name == "Lobby"
+    room2, created = index.join("LOBBY", "bob", Session("bob"))
+    assert room2 is room and not created
+    assert len(room) == 2
+
+    # Joining twice does nothing
+    assert index.join("lobby", "alice", alice) == (None, False)
+
+    assert index.leave("lobby", "alice") == (room, False)
+    assert index.leave("lobby", "alice") == (None, False)
+    assert index.leave("lobby", "bob") == (room, True)
+    assert index.get("lobby") is None
+    assert len(index) == 0
+
+
+def test_fanout_is_cached_until_membership_changes():
+    index = RoomIndex()
+    alice, bob = Session("alice"), Session("bob")
+    room, _ = index.join("lobby", "alice", alice)
+    first = room.fanout()
+    assert first == (alice,)
+    assert room.fanout() is first
+
+    index.join("lobby", "bob", bob)
+    assert set(room.fanout()) == {alice, bob}
+
+    # Remote members are counted but never fanned out to locally
+    fanout = room.fanout()
+    index.join("lobby", "carol")
+    assert room.fanout() is fanout
+    assert len(room) == 3
+
+    index.leave("lobby", "alice")
+    assert room.fanout() == (bob,)
+
+
+def test_local_members_have_a_room_limit():
+    index = RoomIndex(max_rooms_per_user=2)
+    alice = Session("alice")
+    assert index.join("a", "alice", alice)[0] is not None
+    assert index.join("b", "alice", alice)[0] is not None
+    assert index.join("c", "alice", alice) == (None, False)
+    # Remote memberships were already accepted elsewhere
+    assert index.join("c", "alice")[0] is not None
+
+
+def test_refused_joins_leave_no_bookkeeping_behind():
+    index = RoomIndex(max_rooms_per_user=0)
+    assert index.join("a", "alice", Session("alice")) == (None, False)
+    assert index.by_user == {}
+
+    index = RoomIndex()
+    index.join("a", "bob")
+    assert index.join("a", "bob") == (None, False)
+    index.leave("a", "bob")
+    assert index.by_user == {}
+    assert index.rooms == {}
+
+
+def test_leave_all():
+    index = RoomIndex()
+    alice = Session("alice")
+    index.join("a", "alice", alice)
+    index.join("b", "alice", alice)
+    index.join("b", "bob", Session("bob"))
+    assert sorted(index.rooms_of("ALICE")) == ["a", "b"]
+
+    results = index.leave_all("alice")
+    assert sorted((room.name, removed) for room, removed in results) == [("a", True), ("b", False)]
+    assert index.rooms_of("alice") == []
+    assert index.leave_all("alice") == []
+
+
+def test_directory_and_memberships():
+    index = RoomIndex()
+    index.join("beta", "alice", Session("alice"))
+    index.join("Alpha", "bob", Session("bob"))
+    index.join("Alpha", "carol")
+    assert index.directory() == [["Alpha", 2], ["beta", 1]]
+    assert sorted(index.local_memberships()) == [["Alpha", "bob"], ["beta", "alice"]]
@@ -0,0 +1,267 @@
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from chat_client import CONNECTED, CONNECTING, FAILED, ChatClient
+from compression import DEFLATE
+from framing import FRAMED, LEGACY, SPLIT_FRAME_SIZE
+from outbound import BACKPRESSURE_WINDOW
+from registry import Session
+
+serverUI = pytest.importorskip("serverUI")
+Packet = serverUI.Packet
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "serverUI.py")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(params=["threaded", "async"])
+def server_port(request):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, SERVER, "--mode", request.param, "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    pytest.fail(f"The {request.param} server did not start")
+                time.sleep(0.05)
+        yield port
+    finally:
+        process.terminate()
+        process.wait(10)
+
+
+class Client:
+    def __init__(self, port, name, **kwargs):
+        self.messages = queue.Queue()
+        self.statuses = queue.Queue()
+        self.client = ChatClient(
+            "127.0.0.1", port, name,
+            on_message=self.messages.put,
+            on_status=lambda status, detail: self.statuses.put(status),
+            reconnect=False,
+            timeout=5,
+            **kwargs
+        )
+        self.client.start()
+        while self.statuses.get(timeout=10) != CONNECTED:
+            pass
+
+    def wait_for(self, text):
+        while True:
+            if self.messages.get(timeout=10) == text:
+                return
+
+    def close(self):
+        self.client.stop()
+
+
+def read_until(sock, line):
+    """The lines a legacy client receives, up to and including line."""
+    data = b""
+    while f"\n{line}\n".encode() not in b"\n" + data:
+        chunk = sock.recv(65536)
+        assert chunk
+        data += chunk
+    lines = data.decode().split("\n")
+    return lines[:lines.index(line) + 1]
+
+
+def test_chat_reaches_framed_and_legacy_clients(server_port):
+    alice = Client(server_port, "alice", features=("presence", "deflate"))
+    bob = Client(server_port, "bob")
+    # A client from before the HELLO handshake
+    carol = socket.create_connection(("127.0.0.1", server_port), timeout=10)
+    try:
+        carol.sendall(b"carol\n")
+        assert read_until(carol, "Welcome carol!") == ["Welcome carol!"]
+        alice.wait_for("[System] carol joined!")
+
+        long_text = "hello" + " everyone" * 50
+        alice.client.send(long_text)
+        bob.wait_for(f"alice:{long_text}")
+        read_until(carol, f"alice:{long_text}")
+
+        carol.sendall(b"hi from carol\n")
+        alice.wait_for("carol:hi from carol")
+        bob.wait_for("carol:hi from carol")
+
+        alice.client.send("to:bob psst")
+        bob.wait_for("alice:psst (Private)")
+    finally:
+        carol.close()
+        alice.close()
+        bob.close()
+
+
+def test_a_taken_name_is_refused(server_port):
+    first = Client(server_port, "dave")
+    statuses = queue.Queue()
+    second = ChatClient(
+        "127.0.0.1", server_port, "DAVE",
+        on_status=lambda status, detail: statuses.put((status, detail)),
+        reconnect=False,
+        timeout=5
+    )
+    second.start()
+    try:
+        while True:
+            status, detail = statuses.get(timeout=10)
+            if status != CONNECTING:
+                break
+        assert status == FAILED
+    finally:
+        first.close()
+        second.stop()
+
+
+def test_a_packet_is_encoded_once_per_codec():
+    packet = Packet("alice:hi")
+    assert not packet.control and packet.kind == "chat"
+    frame = packet.frame_for(FRAMED)
+    assert packet.frame_for(FRAMED) is frame
+    assert packet.frame_for(LEGACY) == b"alice:hi\n"
+    assert packet.frame_for(DEFLATE) == FRAMED.encode("alice:hi")
+    assert len(packet.frames) == 3
+
+    large = Packet("x" * SPLIT_FRAME_SIZE)
+    header, body = large.frame_for(FRAMED)
+    assert header + body == FRAMED.encode("x" * SPLIT_FRAME_SIZE)
+
+
+def test_control_packets_and_coalesce_keys():
+    assert Packet("LIST:a,b").control
+    assert Packet("LIST:a,b").key == "LIST"
+    assert Packet(serverUI.PING).key == "PING"
+    assert Packet("CMD:DISCONNECT:bye").control
+    assert Packet("CMD:DISCONNECT:bye").key is None
+    assert Packet("Welcome alice!", control=True).control
+
+
+class Recipient:
+    def __init__(self, codec):
+        self.codec = codec
+        self.sent = []
+
+    def send(self, data, control=False, key=None):
+        self.sent.append((data, control, key))
+        return len(data)
+
+
+def test_a_broadcast_shares_one_frame_between_recipients(monkeypatch):
+    conns = [Recipient(FRAMED), Recipient(FRAMED), Recipient(LEGACY), Recipient(FRAMED)]
+    sessions = [Session(conn, f"user{i}", "Fox") for i, conn in enumerate(conns)]
+    monkeypatch.setattr(serverUI.registry, "snapshot", lambda: sessions)
+
+    serverUI.broadcast_packet("user0:hello", exclude=conns[0])
+    assert conns[0].sent == []
+    assert conns[1].sent[0][0] is conns[3].sent[0][0]
+    assert conns[1].sent == [(FRAMED.encode("user0:hello"), False, None)]
+    assert conns[2].sent == [(b"user0:hello\n", False, None)]
+
+
+@pytest.fixture
+def stalled_connections(monkeypatch):
+    """Threaded connections whose peers never read, each one frame short of congestion."""
+    monkeypatch.setitem(serverUI.queue_settings, "high_water", 1000)
+    monkeypatch.setitem(serverUI.queue_settings, "low_water", 100)
+    made = []
+
+    def make(count):
+        for _ in range(count):
+            sock, peer = socket.socketpair()
+            conn = serverUI.ThreadedConnection(sock)
+            conn.codec = FRAMED
+            # The writer takes this and blocks in sendmsg() for good
+            conn.queue.put(b"\0" * (8 * 1024 * 1024), control=True)
+            deadline = time.monotonic() + 5
+            while conn.queue.queued_bytes and time.monotonic() < deadline:
+                time.sleep(0.001)
+            conn.queue.put(b"\0" * 900)
+            made.append((conn, peer))
+        return [conn for conn, _ in made]
+
+    yield make
+    for conn, peer in made:
+        conn.queue.close()
+        peer.close()
+        conn.sock.close()
+
+
+def test_a_stalled_reader_does_not_delay_a_broadcast(stalled_connections, monkeypatch):
+    stalled = stalled_connections(5)
+    healthy = Recipient(FRAMED)
+    sessions = [Session(conn, f"slow{i}", "Fox") for i, conn in enumerate(stalled)]
+    sessions.append(Session(healthy, "fast", "Cat"))
+    monkeypatch.setattr(serverUI.registry, "snapshot", lambda: sessions)
+
+    started = time.monotonic()
+    serverUI.broadcast_packet("alice:" + "x" * 200)
+    elapsed = time.monotonic() - started
+
+    assert healthy.sent == [(FRAMED.encode("alice:" + "x" * 200), False, None)]
+    assert all(conn.queue.dropped_frames == 1 for conn in stalled)
+    # Waiting out each congested recipient would take 5 * BACKPRESSURE_WINDOW
+    assert elapsed < BACKPRESSURE_WINDOW
+
+
+def test_a_reply_on_the_own_reader_thread_waits_out_a_burst(stalled_connections):
+    conn, = stalled_connections(1)
+    conn.reader_id = threading.get_ident()
+    started = time.monotonic()
+    serverUI.send_packet(conn, "x" * 200)
+    assert time.monotonic() - started >= BACKPRESSURE_WINDOW
+    assert conn.queue.dropped_frames == 1
+
+
+def test_a_failed_connection_setup_only_loses_that_client(monkeypatch):
+    def fail(*args):
+        raise OSError("setsockopt failed")
+
+    monkeypatch.setattr(serverUI, "enable_keepalive", fail)
+    admitted = serverUI.admission.connections
+    sock, peer = socket.socketpair()
+    with peer:
+        serverUI.accept_client(sock, "10.1.2.3")
+        assert sock.fileno() == -1
+        assert serverUI.admission.connections == admitted
+        assert serverUI.admission.addresses["10.1.2.3"][0] == 0
+
+
+def test_federated_nodes_only_share_files_locally(monkeypatch):
+    from federation import FederationNode
+    from rooms import RoomIndex
+
+    index = RoomIndex()
+    index.join("local", "alice", Session(None, "alice", "Fox"))
+    index.join("mixed", "alice", Session(None, "alice", "Fox"))
+    index.join("mixed", "bob")
+    monkeypatch.setattr(serverUI, "rooms", index)
+
+    monkeypatch.setattr(serverUI, "cluster", None)
+    assert serverUI.check_file_target("alice", "all") is None
+    assert serverUI.check_file_target("alice", "#mixed") is None
+
+    monkeypatch.setattr(serverUI, "cluster", FederationNode.__new__(FederationNode))
+    assert serverUI.check_file_target("alice", "all") is not None
+    assert serverUI.check_file_target("alice", "#mixed") == "#mixed has members on other servers."
+    assert serverUI.check_file_target("alice", "#local") is None
@@ -0,0 +1,110 @@
+import shutil
+import socket
+import ssl
+import threading
+
+import pytest
+
+from tls import TLSSocket, client_context, generate_self_signed, server_context
+
+pytestmark = pytest.mark.skipif(shutil.which("openssl") is None, reason="needs the openssl tool")
+
+
+@pytest.fixture(scope="module")
+def contexts(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("tls")
+    certfile, keyfile = str(directory / "cert.pem"), str(directory / "key.pem")
+    generate_self_signed(certfile, keyfile)
+    return server_context(certfile, keyfile), client_context(certfile)
+
+
+def echo_server(sock, context, echo=True):
+    """Serve one TLS connection that echoes what it gets until the client leaves."""
+    server = TLSSocket(sock, context, server_side=True)
+    try:
+        server.do_handshake()
+        while echo:
+            data = server.recv(65536)
+            if not data:
+                break
+            server.sendall(data)
+    except (OSError, ConnectionError):
+        pass
+    finally:
+        sock.close()
+
+
+def connect(contexts, session=None, echo=True):
+    server_sock, client_sock = socket.socketpair()
+    thread = threading.Thread(target=echo_server, args=(server_sock, contexts[0], echo), daemon=True)
+    thread.start()
+    client = TLSSocket(client_sock, contexts[1], server_side=False, server_hostname="localhost", session=session)
+    client.settimeout(5)
+    client.do_handshake()
+    return client, thread
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def test_round_trip(contexts):
+    client, thread = connect(contexts)
+    for payload in (b"hello", bytes(range(256)) * 400):
+        client.sendall(payload)
+        assert recv_exactly(client, len(payload)) == payload
+    client.close()
+    thread.join(5)
+
+
+def test_close_reads_as_end_of_stream(contexts):
+    client, thread = connect(contexts, echo=False)
+    thread.join(5)
+    assert client.recv(100) == b""
+    client.close()
+
+
+def test_a_reconnect_resumes_the_session(contexts):
+    client, thread = connect(contexts)
+    assert not client.session_reused
+    # TLS 1.3 tickets arrive after the handshake, with the first data
+    client.sendall(b"ping")
+    assert recv_exactly(client, 4) == b"ping"
+    session = client.session
+    client.close()
+    thread.join(5)
+
+    again, thread = connect(contexts, session=session)
+    assert again.session_reused
+    again.close()
+    thread.join(5)
+
+
+def test_untrusted_certificates_are_refused(contexts, tmp_path):
+    other_cert, other_key = str(tmp_path / "other.pem"), str(tmp_path / "other.key")
+    generate_self_signed(other_cert, other_key)
+    with pytest.raises(ssl.SSLError):
+        connect((contexts[0], client_context(other_cert)))
+
+
+def test_one_thread_reads_while_another_writes(contexts):
+    client, thread = connect(contexts)
+    payloads = [bytes([i]) * 1000 for i in range(200)]
+    received = []
+
+    def reader():
+        received.append(recv_exactly(client, 1000 * len(payloads)))
+
+    read_thread = threading.Thread(target=reader)
+    read_thread.start()
+    for payload in payloads:
+        client.sendall(payload)
+    read_thread.join(10)
+    client.close()
+    thread.join(5)
+    assert received == [b"".join(payloads)]
@@ -0,0 +1,101 @@
+from transcript import (
+    BUBBLE_HEIGHT,
+    CHARS_PER_LINE,
+    LINE_HEIGHT,
+    OTHER,
+    SYSTEM,
+    SYSTEM_HEIGHT,
+    Entry,
+    Transcript,
+    estimate_height
+)
+
+
+def entries(count, height=10):
+    made = []
+    for i in range(count):
+        entry = Entry(OTHER, "alice", f"m{i}")
+        entry.height = height
+        made.append(entry)
+    return made
+
+
+def filled(count, **kwargs):
+    transcript = Transcript(**kwargs)
+    for entry in entries(count):
+        transcript.append(entry)
+    return transcript
+
+
+def test_estimates():
+    assert estimate_height(Entry(SYSTEM, None, "x" * 500)) == SYSTEM_HEIGHT
+    assert estimate_height(Entry(OTHER, "a", "hi")) == BUBBLE_HEIGHT + LINE_HEIGHT
+    wrapped = Entry(OTHER, "a", "x" * (CHARS_PER_LINE + 1) + "\n\n")
+    assert estimate_height(wrapped) == BUBBLE_HEIGHT + 4 * LINE_HEIGHT
+
+
+def test_layout_and_visible_rows():
+    transcript = filled(10)
+    assert transcript.total_height() == 100
+    assert transcript.top(3) == 30
+    assert transcript.visible(0, 10) == (0, 1)
+    assert transcript.visible(15, 35) == (1, 4)
+    assert transcript.visible(95, 500) == (9, 10)
+    assert transcript.visible(200, 300) == (10, 10)
+
+
+def test_measured_heights_shift_the_rows_below():
+    transcript = filled(10)
+    transcript.set_height(2, 50)
+    assert transcript.top(2) == 20
+    assert transcript.top(3) == 70
+    assert transcript.total_height() == 140
+    # Appending while the sums are stale still ends up consistent
+    transcript.set_height(0, 20)
+    transcript.append(entries(1)[0])
+    assert transcript.total_height() == 160
+
+
+def test_oldest_entries_are_trimmed_in_chunks():
+    transcript = filled(10, limit=10, trim=4)
+    first = transcript.entries[0]
+    last = transcript.entries[-1]
+    assert transcript.append(entries(1)[0]) == 4
+    assert len(transcript) == 7
+    assert transcript.index_of(first) is None
+    assert transcript.index_of(last) == 5
+    assert transcript.total_height() == 70
+    assert transcript.top(0) == 0
+
+
+def test_history_is_prepended_up_to_the_limit():
+    transcript = filled(3, limit=5)
+    newest = transcript.entries[0]
+    older = entries(4)
+    assert transcript.prepend(older) == 2
+    # The newest of the older messages are kept
+    assert transcript.entries[:3] == [older[2], older[3], newest]
+    assert [entry.serial for entry in transcript.entries] == [-2, -1, 0, 1, 2]
+    assert transcript.index_of(older[3]) == 1
+    assert transcript.index_of(older[0]) is None
+    assert transcript.top(2) == 20
+    assert transcript.prepend(entries(1)) == 0
+
+
+def test_prepend_into_an_empty_transcript():
+    transcript = Transcript()
+    older = entries(3)
+    assert transcript.prepend(older) == 3
+    assert transcript.index_of(older[0]) == 0
+    transcript.append(entries(1)[0])
+    assert [entry.serial for entry in transcript.entries] == [-3, -2, -1, 0]
+
+
+def test_clear():
+    transcript = filled(5)
+    kept = transcript.entries[0]
+    transcript.clear()
+    assert len(transcript) == 0
+    assert transcript.total_height() == 0
+    assert transcript.index_of(kept) is None
+    assert transcript.visible(0, 100) == (0, 0)
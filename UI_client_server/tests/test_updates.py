@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+from updates import UpdateQueue
+
+
+def test_posted_updates_run_in_order():
+    queue = UpdateQueue()
+    ran = []
+    for i in range(5):
+        queue.post(ran.append, i)
+    queue.post(lambda value=None: ran.append(value), value="kw")
+    assert len(queue) == 6
+    assert queue.drain() == 6
+    assert ran == [0, 1, 2, 3, 4, "kw"]
+    assert len(queue) == 0
+    assert queue.drain() == 0
+
+
+def test_a_tick_runs_at_most_max_batch_updates():
+    queue = UpdateQueue(max_batch=3)
+    ran = []
+    for i in range(7):
+        queue.post(ran.append, i)
+    assert queue.drain() == 3
+    assert ran == [0, 1, 2]
+    queue.drain()
+    queue.drain()
+    assert ran == list(range(7))
+
+
+def test_marks_coalesce_and_run_after_the_posted_updates():
+    queue = UpdateQueue()
+    ran = []
+    queue.mark("sidebar", lambda: ran.append("old sidebar"))
+    queue.post(ran.append, "message")
+    queue.mark("avatar", lambda: ran.append("avatar"))
+    queue.mark("sidebar", lambda: ran.append("sidebar"))
+    assert len(queue) == 3
+    assert queue.drain() == 3
+    # The last fn of a key runs, in the order the keys were first marked
+    assert ran == ["message", "sidebar", "avatar"]
+
+
+def test_marks_made_by_updates_belong_to_the_same_tick():
+    queue = UpdateQueue()
+    ran = []
+    for i in range(3):
+        queue.post(lambda i=i: (ran.append(i), queue.mark("layout", lambda: ran.append("layout"))))
+    queue.drain()
+    assert ran == [0, 1, 2, "layout"]
+    assert len(queue) == 0
+
+
+def test_a_failing_update_does_not_stop_the_others():
+    queue = UpdateQueue()
+    ran = []
+    queue.post(lambda: 1 / 0)
+    queue.post(ran.append, "after")
+    queue.mark("broken", lambda: 1 / 0)
+    queue.mark("fine", lambda: ran.append("mark"))
+    assert queue.drain() == 4
+    assert ran == ["after", "mark"]
+
+
+def test_posts_from_another_thread_keep_their_order():
+    queue = UpdateQueue(max_batch=100)
+    ran = []
+
+    def producer():
+        for i in range(5000):
+            queue.post(ran.append, i)
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    while thread.is_alive() or len(queue):
+        queue.drain()
+    thread.join()
+    assert ran == list(range(5000))
+
+
+@pytest.fixture
+def gui_app(gui):
+    import bench_gui
+    return bench_gui.make_app(gui)
+
+
+def test_the_network_thread_leaves_gui_state_to_the_tk_thread(gui_app):
+    gui_app.updates.drain()
+    lines = [
+        'CMD:PRESENCE_SNAPSHOT:1:[["alice","Fox"],["bob","Cat"]]',
+        "CMD:PRESENCE:2:JOIN:carol:Dog",
+        "CMD:UPDATE_AVATAR:alice:Ghost",
+        'CMD:ROOMS:[["dev",2]]',
+        "CMD:ROOM_JOINED:dev",
+    ]
+    for line in lines:
+        gui_app.process_message(line)
+    assert gui_app.users_online == []
+    assert gui_app.users_avatars_map == {}
+    assert gui_app.my_rooms == set()
+
+    gui_app.updates.drain()
+    assert gui_app.users_online == ["alice", "bob", "carol"]
+    assert gui_app.users_avatars_map["alice"] == "Ghost"
+    assert gui_app.my_rooms == {"dev"}
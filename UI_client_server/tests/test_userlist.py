@@ -0,0 +1,61 @@
+import random
+
+from userlist import UserIndex, sort_key
+
+
+def test_update_reports_changes():
+    index = UserIndex()
+    assert index.update(["bob", "alice"]) == ({"bob", "alice"}, set())
+    assert index.update(["bob", "alice"]) == (set(), set())
+    assert index.update(["alice", "carol"]) == ({"carol"}, {"bob"})
+    assert len(index) == 2
+    assert "carol" in index and "bob" not in index
+
+
+def test_order_ignores_case_but_is_stable():
+    index = UserIndex()
+    index.update(["bob", "Alice", "alice", "Bob", "émile", "Zed"])
+    names, total = index.page()
+    assert total == 6
+    assert names == ["Alice", "alice", "Bob", "bob", "Zed", "émile"]
+
+
+def test_small_and_large_updates_give_the_same_order():
+    rng = random.Random(7)
+    population = [f"{rng.choice('aAbBcC')}user{i}" for i in range(400)]
+    index = UserIndex()
+    online = set(population[:200])
+    index.update(online)
+    for _ in range(50):
+        # Mostly a few changes (incremental), sometimes many (rebuild)
+        changes = rng.choice([1, 3, 150])
+        for name in rng.sample(population, changes):
+            online.symmetric_difference_update({name})
+        index.update(online)
+        assert index.keys == sorted(map(sort_key, online))
+
+
+def test_prefix_search():
+    index = UserIndex()
+    index.update(["ann", "Anna", "andy", "bob", "an", "ANT"])
+    assert index.page("an") == (["an", "andy", "ann", "Anna", "ANT"], 5)
+    assert index.page("ANN") == (["ann", "Anna"], 2)
+    assert index.page("x") == ([], 0)
+    assert index.page("ann", count=1) == (["ann"], 2)
+    assert index.prefix_range("") == (0, 6)
+
+
+def test_pages_are_capped():
+    index = UserIndex()
+    index.update(f"user{i:04}" for i in range(1000))
+    names, total = index.page(count=100)
+    assert total == 1000
+    assert names == [f"user{i:04}" for i in range(100)]
+
+
+def test_clear():
+    index = UserIndex()
+    index.update(["a", "b"])
+    index.clear()
+    assert len(index) == 0
+    assert index.update(["a"]) == ({"a"}, set())
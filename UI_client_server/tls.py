@@ -0,0 +1,168 @@
+"""
+Optional TLS for the chat transport.
+
+The server enables TLS with --tls-cert/--tls-key. The asyncio backend
+hands the context to the event loop (ssl= on create_server), the
+threaded backend and the GUI client wrap their sockets in TLSSocket.
+
+Reconnect storms (every client coming back at once after a deploy) are
+kept cheap with session resumption: TLS 1.3 session tickets, encrypted
+with the server's ticket keys, let a returning client skip the
+certificate exchange and key agreement. Clients keep the SSLSession of
+their last connection and offer it when they reconnect. The ticket keys
+are the context's own: the ssl module has no API to set them, so they live
+and die with one process, and a session only resumes on the process that
+issued it (not after a restart, and with --workers only when the
+reconnect lands on the same worker). bench_tls.py compares full and
+resumed handshakes.
+"""
+import socket
+import ssl
+import subprocess
+import threading
+
+HANDSHAKE_TIMEOUT = 10.0    # seconds a client may take to finish the TLS handshake
+
+RECV_SIZE = 64 * 1024
+
+
+def server_context(certfile, keyfile=None):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+def client_context(cafile=None):
+    """Verifies the server certificate, against cafile if given (e.g. a self-signed one)."""
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+
+def generate_self_signed(certfile, keyfile, hosts=("localhost", "127.0.0.1"), key_type="ec", days=30):
+    """
+    Create a self-signed certificate for local testing (needs the openssl
+    tool). key_type is "ec" (P-256) or "rsa" (2048 bit).
+    """
+    names = ",".join(
+        f"IP:{host}" if host.replace(".", "").isdigit() or ":" in host else f"DNS:{host}"
+        for host in hosts
+    )
+    if key_type == "rsa":
+        key_options = ["-newkey", "rsa:2048"]
+    else:
+        key_options = ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256"]
+    subprocess.run(
+        ["openssl", "req", "-x509"] + key_options + [
+            "-nodes", "-keyout", keyfile, "-out", certfile, "-days", str(days),
+            "-subj", f"/CN={hosts[0]}", "-addext", f"subjectAltName={names}",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+
+class TLSSocket:
+    """
+    A TLS connection over a blocking socket that, unlike ssl.SSLSocket,
+    may be read by one thread while another writes to it: the TLS state
+    lives in an SSLObject over memory BIOs and is only touched under a
+    lock, while the blocking recv()/sendall() calls happen outside it.
+    Offers the socket methods the chat code uses.
+    """
+
+    def __init__(self, sock, context, server_side, server_hostname=None, session=None):
+        self.sock = sock
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.tls = context.wrap_bio(
+            self.incoming,
+            self.outgoing,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session
+        )
+        self.lock = threading.Lock()        # guards self.tls and the BIOs
+        self.send_lock = threading.Lock()   # keeps TLS records in order on the wire
+
+    def do_handshake(self):
+        """Complete the handshake now instead of on the first recv."""
+        while True:
+            try:
+                with self.lock:
+                    self.tls.do_handshake()
+                self._flush()
+                return
+            except ssl.SSLWantReadError:
+                self._flush()
+                if not self._fill():
+                    raise ConnectionError("Connection closed during the TLS handshake")
+
+    def _fill(self):
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            return False
+        with self.lock:
+            self.incoming.write(data)
+        return True
+
+    def _flush(self, block=True):
+        # Reading may produce records too (handshake, session tickets); if a
+        # writer is busy they simply go out with its next write
+        if not self.send_lock.acquire(blocking=block):
+            return
+        try:
+            with self.lock:
+                data = self.outgoing.read()
+            if data:
+                self.sock.sendall(data)
+        finally:
+            self.send_lock.release()
+
+    def recv_into(self, buffer, nbytes=0):
+        while True:
+            try:
+                with self.lock:
+                    return self.tls.read(nbytes or len(buffer), buffer)
+            except ssl.SSLWantReadError:
+                self._flush(block=False)
+                if not self._fill():
+                    return 0
+            except ssl.SSLZeroReturnError:
+                return 0
+
+    def recv(self, size):
+        buffer = bytearray(size)
+        nbytes = self.recv_into(buffer)
+        return bytes(buffer[:nbytes])
+
+    def sendall(self, data):
+        with self.send_lock:
+            with self.lock:
+                self.tls.write(data)
+                out = self.outgoing.read()
+            self.sock.sendall(out)
+
+    send = sendall
+
+    @property
+    def session(self):
+        return self.tls.session
+
+    @property
+    def session_reused(self):
+        return self.tls.session_reused
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
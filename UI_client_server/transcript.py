@@ -0,0 +1,179 @@
+"""
+Chat transcript model for the GUI client.
+
+Creating a handful of widgets per message and never destroying them makes
+a long session use hundreds of MB and slows scrolling to a crawl. The GUI
+keeps its messages here instead: one small Entry per message, and only
+the rows in the viewport get widgets, taken from a pool (see
+TranscriptView in GUI_client.py).
+
+The model knows the height of every row (estimated until the row was
+shown once, then measured) and keeps the running sum of heights, so the
+view finds the rows for any scroll position with a binary search. The
+sums are rebuilt lazily from the first row whose height changed.
+
+At most limit entries are kept; beyond that the oldest are dropped in
+chunks of trim entries so the rebuild is rare.
+"""
+import time
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+MAX_ENTRIES = 10000
+TRIM_CHUNK = 1000
+
+# Entry kinds
+MINE = "mine"
+OTHER = "other"
+SYSTEM = "system"
+
+# Row height estimates in pixels, corrected once a row has been shown
+SYSTEM_HEIGHT = 22
+BUBBLE_HEIGHT = 62          # name, time and padding around the text
+LINE_HEIGHT = 17
+CHARS_PER_LINE = 26         # at the bubble's wrap length
+PROGRESS_HEIGHT = 12
+FILE_HEIGHT = 30            # the Save button under a shared file
+
+
+class Entry:
+    """One message. tag is "Priv", "#room" or None; file is a file notice dict."""
+
+    __slots__ = (
+        "serial", "kind", "sender", "text", "sent_at", "tag", "height",
+        "file", "status", "progress", "image", "busy"
+    )
+
+    def __init__(self, kind, sender, text, sent_at=None, tag=None, file=None):
+        self.serial = 0
+        self.kind = kind
+        self.sender = sender
+        self.text = text
+        self.sent_at = sent_at or time.time()
+        self.tag = tag
+        self.height = 0
+        self.file = file
+        self.status = None      # transfer status under a file bubble
+        self.progress = None    # 0.0 - 1.0 while a transfer runs
+        self.image = None       # preview of a downloaded image
+        self.busy = False       # a download of this file is running
+
+
+def estimate_height(entry):
+    if entry.kind == SYSTEM:
+        height = SYSTEM_HEIGHT
+    else:
+        lines = sum(max(1, -(-len(line) // CHARS_PER_LINE)) for line in entry.text.split("\n"))
+        height = BUBBLE_HEIGHT + lines * LINE_HEIGHT
+        if entry.file is not None:
+            height += FILE_HEIGHT
+        if entry.status is not None:
+            height += LINE_HEIGHT
+    if entry.progress is not None:
+        height += PROGRESS_HEIGHT
+    return height
+
+
+class Transcript:
+    """
+    Ordered, bounded list of entries with their vertical layout. Entries
+    get consecutive serial numbers (older history pages get numbers below
+    the first entry), so an entry's index is found in O(1).
+    """
+
+    def __init__(self, limit=MAX_ENTRIES, trim=TRIM_CHUNK, estimate=estimate_height):
+        self.limit = limit
+        self.trim = min(trim, limit)
+        self.estimate = estimate
+        self.entries = []
+        self.tops = [0]             # tops[i] = y of entry i, tops[-1] = total height
+        self.dirty_from = None      # first index whose top may be stale
+        self.next_serial = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.tops = [0]
+        self.dirty_from = None
+
+    def append(self, entry):
+        """Add a new message at the bottom. Returns how many old entries were dropped."""
+        entry.serial = self.next_serial
+        self.next_serial += 1
+        if not entry.height:
+            entry.height = self.estimate(entry)
+        self.entries.append(entry)
+        if self.dirty_from is None:
+            self.tops.append(self.tops[-1] + entry.height)
+
+        if len(self.entries) <= self.limit:
+            return 0
+        del self.entries[:self.trim]
+        self._invalidate(0)
+        return self.trim
+
+    def prepend(self, entries):
+        """
+        Add older messages at the top, as far as the limit allows (the newest
+        of them first). Returns how many were added.
+        """
+        room = self.limit - len(self.entries)
+        if room <= 0 or not entries:
+            return 0
+        entries = entries[-room:]
+        first = self.entries[0].serial if self.entries else self.next_serial
+        for offset, entry in enumerate(reversed(entries), 1):
+            entry.serial = first - offset
+            if not entry.height:
+                entry.height = self.estimate(entry)
+        self.entries[:0] = entries
+        self._invalidate(0)
+        return len(entries)
+
+    def index_of(self, entry):
+        """Current index of an entry, or None once it was dropped."""
+        if not self.entries:
+            return None
+        index = entry.serial - self.entries[0].serial
+        if 0 <= index < len(self.entries) and self.entries[index] is entry:
+            return index
+        return None
+
+    def set_height(self, index, height):
+        entry = self.entries[index]
+        if entry.height != height:
+            entry.height = height
+            self._invalidate(index)
+
+    def top(self, index):
+        self._rebuild()
+        return self.tops[index]
+
+    def total_height(self):
+        self._rebuild()
+        return self.tops[-1]
+
+    def visible(self, y0, y1):
+        """(start, stop) indexes of the entries overlapping y0..y1."""
+        self._rebuild()
+        start = max(0, bisect_right(self.tops, y0) - 1)
+        stop = min(len(self.entries), bisect_left(self.tops, y1))
+        return start, max(start, stop)
+
+    def _invalidate(self, index):
+        if self.dirty_from is None or index < self.dirty_from:
+            self.dirty_from = index
+
+    def _rebuild(self):
+        start = self.dirty_from
+        if start is None:
+            return
+        tops = self.tops
+        del tops[start + 1:]
+        y = tops[start]
+        for entry in islice(self.entries, start, None):
+            y += entry.height
+            tops.append(y)
+        self.dirty_from = None
@@ -0,0 +1,68 @@
+"""
+Update pipeline between the GUI's network thread and the Tk loop.
+
+Scheduling one root.after() callback per incoming line floods the Tk
+event queue during a chat burst, and every callback redraws whatever it
+touched. Instead the listener thread posts its updates here and the Tk
+loop drains them on a fixed tick:
+
+- post(fn, ...): ordered updates (a new message, a history page), run in
+  arrival order, at most max_batch per tick so input events get a turn
+- mark(key, fn): idempotent refreshes (the sidebar, one user's avatar,
+  the transcript layout); however often a key is marked between two
+  ticks, only the last fn marked for it runs, once, after the ordered
+  updates of that tick
+
+Marks made while the ordered updates run still belong to the same tick,
+so a burst of messages costs one layout and one autoscroll per tick.
+
+The listener thread only parses: changes to the GUI's state (who is
+online, avatars, rooms) are posted too, so the Tk thread never reads that
+state while another thread changes it.
+"""
+import threading
+from collections import deque
+
+TICK = 0.025        # seconds between drains
+MAX_BATCH = 2000    # ordered updates per drain
+
+
+class UpdateQueue:
+    def __init__(self, max_batch=MAX_BATCH):
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.items = deque()
+        self.marks = {}     # key -> fn, in first-marked order
+
+    def __len__(self):
+        return len(self.items) + len(self.marks)
+
+    def post(self, fn, *args, **kwargs):
+        with self.lock:
+            self.items.append((fn, args, kwargs))
+
+    def mark(self, key, fn):
+        with self.lock:
+            self.marks[key] = fn
+
+    def drain(self):
+        """Run pending updates on the calling (Tk) thread. Returns how many ran."""
+        with self.lock:
+            count = min(len(self.items), self.max_batch)
+            batch = [self.items.popleft() for _ in range(count)]
+
+        for fn, args, kwargs in batch:
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                pass
+
+        with self.lock:
+            marks, self.marks = self.marks, {}
+
+        for fn in marks.values():
+            try:
+                fn()
+            except Exception:
+                pass
+        return count + len(marks)
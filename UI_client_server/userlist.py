@@ -0,0 +1,72 @@
+"""
+Online users model for the GUI client's sidebar.
+
+The sidebar used to rebuild a button per online user on every presence
+change, which takes seconds with a few thousand users. It now shows the
+users sorted by name and keeps one button per shown user (see UserListView
+in GUI_client.py); this index gives it the sorted order, prefix search and
+pages of it without sorting the whole list each time.
+
+Keys are (casefolded name, name), so search ignores case and names that
+only differ in case still have a fixed order.
+"""
+from bisect import bisect_left, insort
+
+PAGE_SIZE = 100             # users shown at once; "More" shows the next page
+
+# Beyond this many changes in one update the index is sorted from scratch
+REBUILD_FRACTION = 0.25
+
+PREFIX_END = chr(0x10FFFF)
+
+
+def sort_key(name):
+    return name.casefold(), name
+
+
+class UserIndex:
+    def __init__(self):
+        self.keys = []          # sorted sort_key(name) of every user
+        self.names = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def clear(self):
+        self.keys.clear()
+        self.names.clear()
+
+    def update(self, users):
+        """Make the index hold exactly users. Returns (added, removed) sets."""
+        users = set(users)
+        added = users - self.names
+        removed = self.names - users
+        if not added and not removed:
+            return added, removed
+
+        if len(added) + len(removed) > len(self.keys) * REBUILD_FRACTION:
+            self.keys = sorted(map(sort_key, users))
+        else:
+            for name in removed:
+                del self.keys[bisect_left(self.keys, sort_key(name))]
+            for name in added:
+                insort(self.keys, sort_key(name))
+        self.names = users
+        return added, removed
+
+    def prefix_range(self, prefix):
+        """(start, stop) positions of the users whose name starts with prefix, any case."""
+        prefix = prefix.casefold()
+        if not prefix:
+            return 0, len(self.keys)
+        start = bisect_left(self.keys, (prefix,))
+        stop = bisect_left(self.keys, (prefix + PREFIX_END,), start)
+        return start, stop
+
+    def page(self, prefix="", count=PAGE_SIZE):
+        """The first count names matching prefix, in order, and how many match."""
+        start, stop = self.prefix_range(prefix)
+        return [name for _, name in self.keys[start:min(stop, start + count)]], stop - start
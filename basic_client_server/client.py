@@ -1,73 +1,90 @@
-import socket
-import threading
+import os
+import queue
+import sys
 import time
 
+# Shared wire protocol helpers live next to the GUI server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "UI_client_server"))
+from chat_client import CLOSED, CONNECTED, FAILED, RECONNECTING, STOPPED, ChatClient
+
 GREEN = "\033[92m"
 RED = "\033[91m"
 RESET = "\033[0m"
 YELLOW  = "\033[93m"
 
 
-running = False     # Controls the client main loop and the listener thread
+statuses = queue.Queue()    # Login outcome, reported by the client's thread
+running = False             # Controls the client main loop
 
 
 # ========================== Functions ==========================
 
-def listen_to_server(client_socket):
+def show_message(text):
     """
-    Background thread that listens for incoming messages from the server.
-    Runs as long as the 'running' flag is True.
+    Called by the client's thread for every message from the server.
+    Prints server or private messages without breaking user input flow.
     """
+    print("\n" + text)
+
+
+def on_status(status, detail):
+    """Called by the client's thread when the connection changes."""
     global running
 
-    while running:
-        try:
-            data = client_socket.recv(1024)     # Receive incoming data from server
-        except OSError:
-            # Happens if the socket was closed while this thread is blocked on recv()
-            break
+    if status == RECONNECTING:
+        print(YELLOW + f"\nConnection lost, reconnecting in {detail:.1f}s..." + RESET)
+    elif status == CONNECTED and running:
+        print(YELLOW + "\nReconnected" + RESET)
+    elif status in (CLOSED, FAILED) and running:
+        print(RED + f"\nDisconnected: {detail}" + RESET)
+        running = False
+    if not running:
+        statuses.put((status, detail))
 
-        if not data:    # Server closed the connection
-            running = False
-            break
 
-        # Print server or private messages without breaking user input flow
-        print("\n" + data.decode())
+def log_in(name):
+    """
+    Connect and register name. The client runs on its own thread and
+    reconnects (logging in again) if the connection drops later.
+    Returns the client, or None if the server refused the name.
+    """
+    client = ChatClient(
+        HOST,
+        PORT,
+        name,
+        raw=True,       # The server may not support framing
+        on_message=show_message,
+        on_status=on_status
+    )
+    client.start()
+
+    while True:
+        status, detail = statuses.get()
+        if status == CONNECTED:
+            print(detail)
+            return client
+        if status in (FAILED, CLOSED, STOPPED):
+            print(detail)
+            return None
 
 
 # ========================== Client Setup ==========================
 
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)   # Create TCP socket
-
 HOST = "127.0.0.1"
 PORT = 5000
 
-client_socket.connect((HOST, PORT))     # Connect to server
-
 
 # ---------- Username registration ----------
 while True:
     name = input("Enter your name: ")
-    client_socket.send(name.encode())   # Send chosen username to server
-
-    response = client_socket.recv(1024).decode()    # Receive server response
-    print(response)
+    client = log_in(name)
 
     # Exit the loop only after successful registration
-    if "Welcome" in response:
+    if client is not None:
         break
 
 
-running = True    # Start the listener and the main client loop
-
-
-# Background thread to keep listening for messages while user types
-listener = threading.Thread(
-    target=listen_to_server,
-    args=(client_socket,),
-    daemon=True
-)
-listener.start()
+running = True    # Start the main client loop
 
 
 # ========================== Main Chat Loop ==========================
@@ -80,7 +97,7 @@ while running:
     if target.lower() == "exit":
         print(YELLOW + "Disconnecting..." + RESET)
         running = False
-        client_socket.close()
+        client.stop()
         break
 
     if not target:
@@ -95,7 +112,10 @@ while running:
 
     # Format and send private message to server
     full_message = f"to:{target} {GREEN + message + RESET}"
-    client_socket.send(full_message.encode())
+    try:
+        client.send(full_message)
+    except OSError:
+        print(RED + "Not connected, message not sent" + RESET)
 
     # Small delay to keep output readable
     time.sleep(0.5)
@@ -1,64 +1,133 @@
+import os
 import socket
+import sys
 import threading
+from collections import Counter
+
+# Shared wire protocol helpers live next to the GUI server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "UI_client_server"))
+from framing import StreamDecoder, encode_frame, negotiate, read_message
+from ratelimit import FLOODING, MAX_DROPPED, RATE_LIMITED, REASONS, AdmissionControl, MessageLimiter, format_error
+from registry import SessionRegistry
 
 RED = b"\033[91m"
 RESET = b"\033[0m"
 BLUE = b"\033[94m"
 
 
-clients = {}                     # username -> client socket
-clients_lock = threading.Lock()  # Lock to protect shared dictionary access
+registry = SessionRegistry()     # Thread-safe username <-> socket indexes
+send_lock = threading.Lock()     # Keeps writes from different threads from interleaving
+framed_clients = set()           # Sockets that negotiated length-prefixed frames
+admission = AdmissionControl()   # Connection limits: in total, per address, per second
+rejections = Counter()           # Refused connections and dropped messages by reason
 
 
 # ========================== Functions ==========================
 
-def handle_client(client_socket):
+def send_message(client_socket, data):
+    """
+    Send one message to a client.
+    Framed clients get a length-prefixed frame, legacy clients raw bytes.
+    """
+    if client_socket in framed_clients:
+        client_socket.sendall(encode_frame(data))
+    else:
+        client_socket.send(data)
+
+
+def receive_message(client_socket, decoder):
+    """
+    Return the next message from a client, or b"" once it disconnected.
+    Framed clients get exact message boundaries even when TCP coalesces
+    segments; legacy clients keep the one-recv-per-message behaviour.
+    """
+    if decoder is None:
+        return client_socket.recv(1024)
+
+    message = read_message(client_socket, decoder)
+    return message[1] if message else b""
+
+
+def handle_client(client_socket, address):
     name = None     # Will store the client's username
+    decoder = None  # Frame decoder, only for clients that negotiated framing
+    limiter = MessageLimiter()      # Token buckets for this client's messages
 
     try:
+        # ---------- Protocol negotiation ----------
+        pending = client_socket.recv(1024)
+        handshake = negotiate(pending.decode(errors="replace").strip())
+        if handshake:
+            reply, codec, _ = handshake
+            client_socket.send(f"{reply}\n".encode())   # Reply is always a plain line
+            if codec.framed:
+                decoder = StreamDecoder(framed=True)
+                framed_clients.add(client_socket)
+            pending = None
+
         # ---------- Username registration loop ----------
         while True:
-            name = client_socket.recv(1024).decode()    # Receive username from client
-
-            with clients_lock:  # Ensure thread-safe access to 'clients'
-                if name not in clients:
-                    clients[name] = client_socket       # Register new client
-                    client_socket.send(
+            data = pending if pending is not None else receive_message(client_socket, decoder)
+            pending = None
+            if not data:                        # Client left before registering
+                return
+            name = data.decode()                # Receive username from client
+
+            if registry.register(client_socket, name):     # Atomic check-and-register
+                with send_lock:
+                    send_message(
+                        client_socket,
                         BLUE + f"Welcome to the server, {name}!".encode() + RESET
                     )
-                    break
-                else:
-                    client_socket.send(RED + b"Name taken, choose another one." + RESET)
+                break
+            else:
+                send_message(client_socket, RED + b"Name taken, choose another one." + RESET)
 
         print(f"{name} connected")
 
         # ---------- Main message handling loop ----------
         while True:
-            data = client_socket.recv(1024)     # Receive data from client
+            data = receive_message(client_socket, decoder)     # Receive data from client
 
             if not data:                         # Client closed the connection
                 print(f"{name} disconnected")
                 break
 
+            # Drop messages over the rate limit, disconnect clients that keep flooding
+            if not limiter.allow(len(data)):
+                with send_lock:
+                    if limiter.dropped >= MAX_DROPPED:
+                        rejections[FLOODING] += 1
+                        send_message(client_socket, RED + REASONS[FLOODING].encode() + RESET)
+                        print(f"[LIMIT] {name} disconnected for flooding")
+                        break
+                    rejections[RATE_LIMITED] += 1
+                    if limiter.dropped == 1:
+                        send_message(client_socket, RED + REASONS[RATE_LIMITED].encode() + RESET)
+                        print(f"[LIMIT] {name} is sending too fast, dropping messages")
+                continue
+
             message = data.decode()
 
             # Private message format: "to:<target> <message>"
             if message.startswith("to:"):
                 target, msg = message[3:].split(" ", 1)
 
-                with clients_lock:  # Protect access to clients dict
-                    if target in clients:
+                session = registry.find(target)     # O(1) lookup by username
+                with send_lock:
+                    if session is not None:
                         # Forward message to target client
-                        clients[target].send(
+                        send_message(
+                            session.conn,
                             f"{name}: {msg}".encode()
                         )
 
                         # Acknowledge sender
-                        client_socket.send(b"Message delivered")
+                        send_message(client_socket, b"Message delivered")
 
                         print(f"[ROUTE] {name} -> {target}: {msg}")
                     else:
-                        client_socket.send(b"User not found")
+                        send_message(client_socket, b"User not found")
                         print(
                             f"[ERROR] {name} tried to send to {target} (user not found)"
                         )
@@ -73,9 +142,9 @@ def handle_client(client_socket):
 
     finally:
         # Cleanup: remove client and close socket
-        with clients_lock:
-            if name in clients:
-                del clients[name]
+        registry.unregister(client_socket)
+        framed_clients.discard(client_socket)
+        admission.release(address)
         client_socket.close()
 
 
@@ -85,19 +154,32 @@ server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)   # Create TCP
 
 HOST = "0.0.0.0"    # Listen on all network interfaces
 PORT = 5000
+BACKLOG = socket.SOMAXCONN      # Connections the kernel queues while we are busy
 
 server_socket.bind((HOST, PORT))    # Bind socket to host and port
-server_socket.listen()              # Start listening for connections
+server_socket.listen(BACKLOG)       # Start listening for connections
 
 print("Server is running...")
 
 while True:
     client_socket, client_address = server_socket.accept()  # Accept new client
 
+    # Refuse it with an error line when over a connection limit
+    reason = admission.admit(client_address[0])
+    if reason is not None:
+        rejections[reason] += 1
+        print(f"[LIMIT] Refused {client_address[0]}: {reason} ({rejections[reason]} so far)")
+        try:
+            client_socket.send(f"{format_error(reason)}\n".encode())
+        except OSError:
+            pass
+        client_socket.close()
+        continue
+
     # Handle each client in a separate thread
     thread = threading.Thread(
         target=handle_client,
-        args=(client_socket,)
+        args=(client_socket, client_address[0])
     )
     thread.start()
 